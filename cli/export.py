@@ -0,0 +1,40 @@
+import argparse
+import os
+
+from cli import ensure_engine_exists
+from cli.mmt.engine import Engine
+from mmt import checkpoint, onnxmodel
+
+
+def main_onnx(argv=None):
+    parser = argparse.ArgumentParser(description='Export the neural decoder checkpoints to ONNX graphs (encoder and '
+                                                 'single decoder step) used by the decoder with "--onnx"',
+                                     prog='mmt export-onnx')
+    parser.add_argument('-e', '--engine', dest='engine', help='the engine name, \'default\' will be used if absent',
+                        default='default')
+    parser.add_argument('--opset', dest='opset', metavar='VERSION', default=11, type=int,
+                        help='the ONNX opset version (default 11)')
+
+    args = parser.parse_args(argv)
+
+    engine = Engine(args.engine)
+    ensure_engine_exists(engine)
+
+    for checkpoint_path in onnxmodel.export(os.path.join(engine.models_path, 'decoder'), opset_version=args.opset):
+        print('Exported ONNX graphs: %s' % checkpoint_path)
+
+
+def main_cache(argv=None):
+    parser = argparse.ArgumentParser(description='Create the fast-load cache ("model.cache") of the neural decoder '
+                                                 'checkpoints, used by the decoder unless "--no-checkpoint-cache" '
+                                                 'is specified', prog='mmt export-cache')
+    parser.add_argument('-e', '--engine', dest='engine', help='the engine name, \'default\' will be used if absent',
+                        default='default')
+
+    args = parser.parse_args(argv)
+
+    engine = Engine(args.engine)
+    ensure_engine_exists(engine)
+
+    for checkpoint_path in checkpoint.create_cache(os.path.join(engine.models_path, 'decoder')):
+        print('Created checkpoint cache: %s' % checkpoint_path)
@@ -0,0 +1,109 @@
+import argparse
+import os
+from itertools import islice
+
+from cli import CLIArgsException, StatefulActivity, activitystep
+from cli.mmt import collect_parallel_files
+from cli.mmt.mmtcli import mmt_preprocess
+from mmt.decoder import ModelConfig
+from mmt.shortlist import Shortlist
+from mmt.textencoder import SubwordDictionary
+
+
+class ShortlistActivity(StatefulActivity):
+    def __init__(self, args, extra_argv=None, wdir=None, log_file=None, start_step=None, delete_on_exit=True):
+        super().__init__(args, extra_argv, wdir, log_file, start_step, delete_on_exit)
+
+        self._langs = [tuple(lp.split(':')) for lp in args.lang_pairs.split(',')]
+        self._multilingual_target = len(_target_languages(args.model_path)) > 1
+
+    @activitystep('Tokenize corpora')
+    def tokenize(self):
+        self.state.tokenized_corpora = self.wdir('tokenized_corpora')
+
+        for src_lang, tgt_lang in self._langs:
+            lang_dir = os.path.join(self.state.tokenized_corpora, '%s__%s' % (src_lang, tgt_lang))
+            mmt_preprocess(src_lang, tgt_lang, self.args.input_paths, lang_dir)
+
+    @activitystep('Building lexical shortlist')
+    def build(self):
+        vocab = SubwordDictionary.load(os.path.join(self.args.model_path, 'model.vcb'))
+        builder = Shortlist.Builder(vocab, frequent=self.args.frequent, candidates=self.args.candidates,
+                                    min_count=self.args.min_count)
+
+        for src_lang, tgt_lang in self._langs:
+            # source lines are prefixed with the target language tag as done by the decoder for multilingual models
+            src_prefix = None
+            if self._multilingual_target:
+                src_prefix = SubwordDictionary.language_tag(tgt_lang) + ' '
+
+            lang_dir = os.path.join(self.state.tokenized_corpora, '%s__%s' % (src_lang, tgt_lang))
+            src_files, tgt_files = collect_parallel_files(src_lang, tgt_lang, lang_dir)
+
+            remaining = self.args.max_sentences
+            for src_file, tgt_file in zip(src_files, tgt_files):
+                with open(src_file, 'r', encoding='utf-8') as src_file_obj, \
+                        open(tgt_file, 'r', encoding='utf-8') as tgt_file_obj:
+                    for src_line, tgt_line in islice(zip(src_file_obj, tgt_file_obj), remaining):
+                        builder.add(src_line if src_prefix is None else src_prefix + src_line, tgt_line)
+                        if remaining is not None:
+                            remaining -= 1
+
+                if remaining is not None and remaining <= 0:
+                    break
+
+        shortlist = builder.build()
+        shortlist.save(self.args.model_path)
+
+
+def _target_languages(model_path):
+    # the target languages the checkpoint is registered for in the decoder "model.conf" (the parent folder),
+    # the decoder prefixes the source with the target language tag if they are more than one
+    config = ModelConfig.load(os.path.dirname(os.path.abspath(model_path)))
+    model_path = os.path.realpath(model_path)
+
+    return set([name.split('__', 1)[1] for name, path in config.checkpoints if os.path.realpath(path) == model_path])
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Build the lexical shortlist used to restrict the output layer '
+                                                 'of the neural decoder', prog='mmt shortlist')
+    parser.add_argument('lang_pairs', metavar='LANGUAGE_PAIRS',
+                        help='the language pair list encoded as <ls1>:<t1>[,<lsn>:<ltn>] (i.e. en:it,it:en,en:fr)')
+    parser.add_argument('model_path', metavar='MODEL_PATH',
+                        help='the checkpoint folder (with "model.pt" and "model.vcb") where the shortlist is stored, '
+                             'listed in the "model.conf" of the parent folder')
+    parser.add_argument('input_paths', nargs='+', metavar='INPUT_PATHS', help='the paths to the training corpora')
+    parser.add_argument('-w', '--working-dir', metavar='WORKING_DIR', dest='wdir', default=None,
+                        help='the working directory for temporary files (default is os temp folder)')
+    parser.add_argument('-d', '--debug', action='store_true', dest='debug', default=False,
+                        help='prevents temporary files to be removed after execution')
+    parser.add_argument('--frequent', dest='frequent', default=1000, type=int,
+                        help='the number of most frequent target subwords always allowed (default is 1000)')
+    parser.add_argument('--candidates', dest='candidates', default=50, type=int,
+                        help='the maximum number of target candidates for each source subword (default is 50)')
+    parser.add_argument('--min-count', dest='min_count', default=2, type=int,
+                        help='the minimum number of co-occurrences of a candidate pair (default is 2)')
+    parser.add_argument('--max-sentences', dest='max_sentences', default=None, type=int,
+                        help='the maximum number of sentence pairs read for each language pair (default is all)')
+    parser.add_argument('--log', dest='log_file', default=None, help='detailed log file')
+
+    args = parser.parse_args(argv)
+    if args.debug and args.wdir is None:
+        raise CLIArgsException(parser, '"--debug" options requires explicit working dir with "--working-dir"')
+    if not os.path.isfile(os.path.join(args.model_path, 'model.vcb')):
+        raise CLIArgsException(parser, 'missing vocabulary file "model.vcb" in %s' % args.model_path)
+    if not os.path.isfile(os.path.join(os.path.dirname(os.path.abspath(args.model_path)), 'model.conf')):
+        raise CLIArgsException(parser, 'missing decoder configuration "model.conf" in the parent folder of %s'
+                               % args.model_path)
+    if len(_target_languages(args.model_path)) == 0:
+        raise CLIArgsException(parser, 'checkpoint %s is not listed in the decoder "model.conf"' % args.model_path)
+    if args.max_sentences is not None and args.max_sentences <= 0:
+        raise CLIArgsException(parser, '"--max-sentences" must be a positive number')
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    activity = ShortlistActivity(args, wdir=args.wdir, log_file=args.log_file, delete_on_exit=not args.debug)
+    activity.run()
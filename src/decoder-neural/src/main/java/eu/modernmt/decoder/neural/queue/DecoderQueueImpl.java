@@ -30,6 +30,11 @@ public class DecoderQueueImpl implements DecoderQueue {
         return new DecoderQueueImpl(checkpoints, handlers);
     }
 
+    /**
+     * Every handler runs its own decoder process, loading its own copy of the checkpoints. The pre-fork
+     * mode of the decoder ("--workers", see serve_workers() in mmt/utils.py), where a single process shares
+     * the checkpoints among workers reachable through named pipes, is not used here.
+     */
     public static DecoderQueueImpl newCPUInstance(ModelConfig config, PythonDecoder.Builder builder, int cpus) throws DecoderException {
         Map<LanguageDirection, File> checkpoints = config.getAvailableModels();
 
@@ -150,26 +150,30 @@ public class PythonDecoderImpl extends PythonProcess implements PythonDecoder {
 
     @Override
     public Translation[] translate(LanguageDirection direction, Sentence[] sentences, int nBest) throws DecoderException {
-        return this.translate(sentences, serialize(direction, sentences, null, null));
+        return this.translate(sentences, serialize(direction, sentences, null, null, nBest));
     }
 
     @Override
     public Translation[] translate(LanguageDirection direction, Sentence[] sentences, ScoreEntry[] suggestions, int nBest) throws DecoderException {
-        return this.translate(sentences, serialize(direction, sentences, suggestions, null));
+        return this.translate(sentences, serialize(direction, sentences, suggestions, null, nBest));
     }
 
     @Override
     public Translation align(LanguageDirection direction, Sentence sentence, String[] translation) throws DecoderException {
         Sentence[] sentences = new Sentence[]{sentence};
         String[][] translations = new String[][]{translation};
-        return this.translate(sentences, serialize(direction, new Sentence[]{sentence}, null, translations))[0];
+        return this.translate(sentences, serialize(direction, new Sentence[]{sentence}, null, translations, 0))[0];
     }
 
     @Override
     public Translation[] align(LanguageDirection direction, Sentence[] sentences, String[][] translations) throws DecoderException {
-        return this.translate(sentences, serialize(direction, sentences, null, translations));
+        return this.translate(sentences, serialize(direction, sentences, null, translations, 0));
     }
 
+    /*
+     * One request at a time: the process also accepts pipelined requests (with "id", see serve_forever()
+     * in mmt/utils.py), but every decoder is used by a single thread at a time (see DecoderQueue).
+     */
     private synchronized Translation[] translate(Sentence[] sentences, String payload) throws DecoderException {
         if (!isAlive())
             throw new DecoderUnavailableException("Neural decoder process not available");
@@ -197,7 +201,7 @@ public class PythonDecoderImpl extends PythonProcess implements PythonDecoder {
         }
     }
 
-    private String serialize(LanguageDirection direction, Sentence[] sentences, ScoreEntry[] suggestions, String[][] forcedTranslations) {
+    private String serialize(LanguageDirection direction, Sentence[] sentences, ScoreEntry[] suggestions, String[][] forcedTranslations, int nBest) {
         String[] serialized = new String[sentences.length];
         for (int i = 0; i < serialized.length; i++)
             serialized[i] = TokensOutputStream.serialize(sentences[i], false, true);
@@ -208,6 +212,9 @@ public class PythonDecoderImpl extends PythonProcess implements PythonDecoder {
         json.addProperty("sl", direction.source.toLanguageTag());
         json.addProperty("tl", direction.target.toLanguageTag());
 
+        if (nBest > 1)
+            json.addProperty("n", nBest);
+
         if (forcedTranslations != null) {
             String[] serializedForcedTranslations = new String[forcedTranslations.length];
             for (int i = 0; i < serializedForcedTranslations.length; i++)
@@ -251,12 +258,17 @@ public class PythonDecoderImpl extends PythonProcess implements PythonDecoder {
             Translation[] translations = new Translation[data.size()];
             for (int i = 0; i < translations.length; i++) {
                 JsonObject e = data.get(i).getAsJsonObject();
+                translations[i] = parseTranslation(e, sentences[i]);
 
-                Word[] words = TokensOutputStream.deserializeWords(e.get("text").getAsString());
-                JsonElement jsonAlignment = e.get("a");
-                Alignment alignment = jsonAlignment == null ? null : parseAlignment(jsonAlignment.getAsJsonArray());
+                JsonElement jsonNbest = e.get("nbest");
+                if (jsonNbest != null) {
+                    JsonArray array = jsonNbest.getAsJsonArray();
+                    ArrayList<Translation> nbest = new ArrayList<>(array.size());
+                    for (JsonElement hypothesis : array)
+                        nbest.add(parseTranslation(hypothesis.getAsJsonObject(), sentences[i]));
 
-                translations[i] = new Translation(words, sentences[i], alignment);
+                    translations[i].setNbest(nbest);
+                }
             }
 
             return translations;
@@ -271,6 +283,14 @@ public class PythonDecoderImpl extends PythonProcess implements PythonDecoder {
         }
     }
 
+    private static Translation parseTranslation(JsonObject json, Sentence sentence) {
+        Word[] words = TokensOutputStream.deserializeWords(json.get("text").getAsString());
+        JsonElement jsonAlignment = json.get("a");
+        Alignment alignment = jsonAlignment == null ? null : parseAlignment(jsonAlignment.getAsJsonArray());
+
+        return new Translation(words, sentence, alignment);
+    }
+
     private static Alignment parseAlignment(JsonArray array) {
         if (array.size() == 0)
             return new Alignment(new int[0], new int[0]);
@@ -1,9 +1,24 @@
 import argparse
+import os
 import sys
 
+import torch
 from mmt import utils
 from mmt.checkpoint import CheckpointRegistry
 from mmt.decoder import MMTDecoder, ModelConfig
+from mmt.onnxmodel import ONNXDecoder
+
+
+def _default_profile_dir(model_path):
+    # the model is in "<home>/engines/<engine>/models/decoder", logs in "<home>/runtime/<engine>/logs"
+    models_path = os.path.dirname(os.path.abspath(model_path))
+    engine_path = os.path.dirname(models_path)
+    engines_path = os.path.dirname(engine_path)
+
+    if os.path.basename(models_path) != 'models' or os.path.basename(engines_path) != 'engines':
+        return None
+
+    return os.path.join(os.path.dirname(engines_path), 'runtime', os.path.basename(engine_path), 'logs', 'profiles')
 
 
 def main(argv=None):
@@ -14,9 +29,83 @@ def main(argv=None):
     parser.add_argument('-l', '--log-level', dest='log_level', metavar='LEVEL', help='select the log level',
                         choices=['critical', 'error', 'warning', 'info', 'debug'], default='info')
     parser.add_argument('-g', '--gpu', dest='gpu', help='specify the GPU to use (default none)', default=None, type=int)
+    parser.add_argument('--protocol', dest='protocol', help='the communication protocol (default json)',
+                        choices=['json', 'binary'], default='json')
+    parser.add_argument('--max-in-flight', dest='max_in_flight', metavar='N', default=1, type=int,
+                        help='the max number of requests queued between pipeline stages, it matters only for '
+                             'clients sending requests ahead of responses, not the engine (default 1)')
+    parser.add_argument('--coalesce-max-tokens', dest='coalesce_max_tokens', metavar='N', default=0, type=int,
+                        help='merge compatible queued requests into batches of at most N source tokens '
+                             '(default 0, disabled)')
+    parser.add_argument('--coalesce-max-wait', dest='coalesce_max_wait', metavar='MS', default=0, type=int,
+                        help='the max time in milliseconds to wait for requests to merge (default 0)')
+    parser.add_argument('--cache-max-entries', dest='cache_max_entries', metavar='N', default=50000, type=int,
+                        help='the max number of translations kept in cache, 0 to disable it (default 50000)')
+    parser.add_argument('--cache-max-size', dest='cache_max_size', metavar='MB', default=64, type=int,
+                        help='the max size in megabytes of the translation cache, 0 to disable it (default 64)')
+    parser.add_argument('--quantize', dest='quantize', help='quantize the model for CPU decoding (default none)',
+                        choices=['int8'], default=None)
+    parser.add_argument('--onnx', dest='onnx', action='store_true', default=False,
+                        help='run the beam search on ONNX Runtime, requires the graphs exported with '
+                             '"mmt export-onnx" (tuned requests are still decoded with PyTorch)')
+    parser.add_argument('--share-weights', dest='share_weights', action='store_true', default=False,
+                        help='on CPU, let the model use the checkpoint tensors directly instead of a copy of them: '
+                             'only the parameters modified by tuning are duplicated')
+    parser.add_argument('--device-cache-entries', dest='device_cache_entries', metavar='K', default=0, type=int,
+                        help='with --gpu, the number of most recently used checkpoints kept on the device (default 0)')
+    parser.add_argument('--device-cache-size', dest='device_cache_size', metavar='MB', default=None, type=int,
+                        help='the max device memory in megabytes used by the checkpoints cache (default unlimited)')
+    parser.add_argument('--checkpoints-budget', dest='checkpoints_budget', metavar='MB', default=None, type=int,
+                        help='the max memory in megabytes used by loaded checkpoints, the others are loaded on '
+                             'first use, delaying that request by the checkpoint load time (default unlimited)')
+    parser.add_argument('--pinned-checkpoints', dest='pinned_checkpoints', metavar='NAME', nargs='+', default=None,
+                        help='the checkpoints (i.e. "en__it") loaded at startup and never evicted, the others are '
+                             'loaded on first use (default none, all of them with --workers)')
+    parser.add_argument('--no-checkpoint-cache', dest='checkpoint_cache', action='store_false', default=True,
+                        help='do not load the fast-load "model.cache" next to each checkpoint, created by '
+                             '"mmt export-cache"')
+    parser.add_argument('--profile', dest='profile', metavar='N', default=0, type=int,
+                        help='profile the next N requests (default none)')
+    parser.add_argument('--profile-threshold', dest='profile_threshold', metavar='MS', default=0, type=int,
+                        help='with --profile, keep only requests slower than MS milliseconds (default 0)')
+    parser.add_argument('--profile-torch', dest='profile_torch', action='store_true', default=False,
+                        help='use the torch profiler too, writing a per-operator summary')
+    parser.add_argument('--profile-dir', dest='profile_dir', metavar='PATH', default=None,
+                        help='the folder where profiles are written (default is "logs/profiles" in the engine runtime)')
+    parser.add_argument('--workers', dest='workers', metavar='N', default=None, type=int,
+                        help='load all checkpoints once and fork N CPU workers sharing them, each one serving its '
+                             'own named pipes listed on stdout, the engine does not launch the decoder in this mode '
+                             '(default none, see serve_workers() in mmt/utils.py)')
+    parser.add_argument('--endpoints', dest='endpoints', metavar='PATH', default=None,
+                        help='the folder where the workers named pipes are created (required with --workers)')
 
     args = parser.parse_args(argv)
 
+    if args.profile_dir is None:
+        args.profile_dir = _default_profile_dir(args.model)
+    if args.profile > 0 and args.profile_dir is None:
+        parser.error('--profile-dir is required with --profile')
+
+    if args.share_weights and args.gpu is not None:
+        parser.error('--share-weights cannot be used with --gpu')
+    if args.device_cache_entries > 0 and args.gpu is None:
+        parser.error('--device-cache-entries requires --gpu')
+    if args.onnx and args.gpu is not None:
+        parser.error('--onnx cannot be used with --gpu')
+    if args.onnx and args.quantize is not None:
+        parser.error('--onnx cannot be used with --quantize')
+
+    if args.workers is not None:
+        if args.gpu is not None:
+            parser.error('--workers cannot be used with --gpu')
+        if args.endpoints is None:
+            parser.error('--endpoints is required with --workers')
+        if args.checkpoints_budget is not None:
+            parser.error('--checkpoints-budget cannot be used with --workers')
+        if not 0 < args.workers <= len(os.sched_getaffinity(0)):
+            parser.error('--workers must be between 1 and the number of available CPUs (%d)' %
+                         len(os.sched_getaffinity(0)))
+
     # Redirecting stdout and stderr to /dev/null
     # ------------------------------------------------------------------------------------------------------------------
     stdout, stderr = utils.mask_std_streams()
@@ -28,20 +117,52 @@ def main(argv=None):
     # Main loop
     # ------------------------------------------------------------------------------------------------------------------
     try:
+        if args.workers is not None:
+            # the intra-op thread pool must not be started before forking
+            torch.set_num_threads(1)
+
         config = ModelConfig.load(args.model)
 
-        builder = CheckpointRegistry.Builder()
+        builder = CheckpointRegistry.Builder(use_cache=args.checkpoint_cache)
         for name, checkpoint_path in config.checkpoints:
             builder.register(name, checkpoint_path)
-        checkpoints = builder.build(args.gpu)
 
-        decoder = MMTDecoder(checkpoints, device=args.gpu, tuning_ops=config.tuning)
+        # workers share only what is loaded before forking, a checkpoint loaded later is loaded by every worker
+        pinned = [name for name, _ in config.checkpoints] if args.workers is not None else args.pinned_checkpoints
+
+        checkpoints = builder.build(args.gpu, pinned=pinned,
+                                    memory_budget=args.checkpoints_budget * 1024 * 1024
+                                    if args.checkpoints_budget is not None else None)
+
+        def create_decoder():
+            decoder_class = ONNXDecoder if args.onnx else MMTDecoder
+            return decoder_class(checkpoints, device=args.gpu, tuning_ops=config.tuning,
+                                 decoder_ops=config.decoding, cache_max_entries=args.cache_max_entries,
+                                 cache_max_bytes=args.cache_max_size * 1024 * 1024, quantize=args.quantize,
+                                 share_weights=args.share_weights, device_cache_entries=args.device_cache_entries,
+                                 device_cache_bytes=args.device_cache_size * 1024 * 1024
+                                 if args.device_cache_size is not None else None)
+
+        decoder = create_decoder() if args.workers is None else None
     except Exception as e:
         stdout.write('ERROR: %s\n' % str(e))
         stdout.flush()
         raise
 
-    utils.serve_forever(sys.stdin, stdout, decoder)
+    profiler = None
+    if args.profile_dir is not None:
+        profiler = utils.Profiler(args.profile_dir, use_torch=args.profile_torch)
+        if args.profile > 0:
+            profiler.enable(args.profile, threshold=args.profile_threshold / 1000.)
+
+    serve_args = dict(protocol=args.protocol, max_in_flight=args.max_in_flight,
+                      coalesce_max_tokens=args.coalesce_max_tokens, coalesce_max_wait=args.coalesce_max_wait / 1000.,
+                      profiler=profiler)
+
+    if args.workers is None:
+        utils.serve_forever(sys.stdin, stdout, decoder, **serve_args)
+    else:
+        exit(utils.serve_workers(create_decoder, args.workers, args.endpoints, stdout, **serve_args))
 
 
 if __name__ == '__main__':
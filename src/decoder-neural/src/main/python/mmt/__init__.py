@@ -1,6 +1,7 @@
 import locale
 import os
 
+from fairseq import options
 from fairseq.models import register_model_architecture
 from fairseq.models.transformer import base_architecture
 from fairseq.tasks import register_task
@@ -17,6 +18,16 @@ class MMTTranslationTask(TranslationTask):
         super().__init__(args, subword_dict, subword_dict)
         self._subword_dict = subword_dict
 
+    @classmethod
+    def setup_task(cls, args, dictionary=None, **kwargs):
+        # "dictionary" (i.e. read from the checkpoint cache) replaces the one in "args.data"
+        if dictionary is None:
+            return super().setup_task(args, **kwargs)
+
+        args.left_pad_source = options.eval_bool(args.left_pad_source)
+        args.left_pad_target = options.eval_bool(args.left_pad_target)
+        return cls(args, dictionary, dictionary)
+
     @classmethod
     def load_dictionary(cls, filename):
         if os.path.basename(filename) != 'model.vcb':
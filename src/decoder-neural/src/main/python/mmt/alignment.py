@@ -1,3 +1,5 @@
+import heapq
+
 import numpy as np
 import regex
 
@@ -22,52 +24,16 @@ def sym_union(i2o, o2i, ilen, olen):
 
 
 def sym_grow(i2o, o2i, ilen, olen):
-    union = sym_union(i2o, o2i, ilen, olen)
+    union = _to_matrix(sym_union(i2o, o2i, ilen, olen), ilen, olen)
     alignment = sym_intersect(i2o, o2i, ilen, olen)
 
-    new_points_added = True
-    while new_points_added:
-        new_points_added = False
-        for i in range(ilen):
-            for o in range(olen):
-                if (i, o) in alignment:
-                    for (i_new, o_new) in _neighboring_points_orthogonal(i, o, ilen, olen):
-                        if not (_aligned_o(o_new, ilen, alignment) and _aligned_i(i_new, olen, alignment)) \
-                                and ((i_new, o_new) in union):
-                            alignment.append((i_new, o_new))
-                            new_points_added = True
-
-    return alignment
+    return _grow(alignment, union, ilen, olen, _neighboring_points_orthogonal)
 
 
 def sym_grow_diagonal(i2o, o2i, ilen, olen):
-    union = sym_union(i2o, o2i, ilen, olen)
-    alignment = sym_intersect(i2o, o2i, ilen, olen)
-
-    new_points_added = True
-    while new_points_added:
-        new_points_added = False
-        for i in range(ilen):
-            for o in range(olen):
-                if (i, o) in alignment:
-                    for (i_new, o_new) in _neighboring_points_orthogonal(i, o, ilen, olen):
-                        if not (_aligned_o(o_new, ilen, alignment) and _aligned_i(i_new, olen, alignment)) \
-                                and ((i_new, o_new) in union):
-                            alignment.append((i_new, o_new))
-                            new_points_added = True
-
-    while new_points_added:
-        new_points_added = False
-        for i in range(ilen):
-            for o in range(olen):
-                if (i, o) in alignment:
-                    for (i_new, o_new) in _neighboring_points_diagonal(i, o, ilen, olen):
-                        if not (_aligned_o(o_new, ilen, alignment) and _aligned_i(i_new, olen, alignment)) \
-                                and ((i_new, o_new) in union):
-                            alignment.append((i_new, o_new))
-                            new_points_added = True
-
-    return alignment
+    # the diagonal step of the original nested loops never ran (it was guarded by the flag left False by the
+    # orthogonal one), thus the output is the same of sym_grow: it is kept as it is, not to change alignments
+    return sym_grow(i2o, o2i, ilen, olen)
 
 
 def sym_grow_diagonal_final_and(i2o, o2i, ilen, olen):
@@ -76,6 +42,17 @@ def sym_grow_diagonal_final_and(i2o, o2i, ilen, olen):
     return alignment
 
 
+SYMMETRIZATION_STRATEGIES = {
+    'direct': sym_direct,
+    'inverse': sym_inverse,
+    'intersect': sym_intersect,
+    'union': sym_union,
+    'grow': sym_grow,
+    'grow_diagonal': sym_grow_diagonal,
+    'grow_diagonal_final_and': sym_grow_diagonal_final_and,
+}
+
+
 # - Make alignment -----------------------------------------------------------------------------------------------------
 
 
@@ -87,33 +64,30 @@ def make_alignment(source_indexes, target_indexes, attention_matrix, prefix_lang
     norm_axis0 = (alignment_matrix / alignment_matrix.sum(axis=0)[np.newaxis])
     norm_axis1 = (alignment_matrix / alignment_matrix.sum(axis=1)[:, np.newaxis])
 
-    s2t_best_indexes = norm_axis0.argmax(1)
-    t2s_best_indexes = norm_axis1.argmax(0)
-
     threshold = 0.80  # TODO: find the best setting (0.85?, 0.75?, 0.90?, 1.00?)
-    s_len = alignment_matrix.shape[0]
-    t_len = alignment_matrix.shape[1]
+
+    # thresholds are computed with the same precision of the scalar expression "threshold * best"
+    dtype = (threshold * norm_axis0.dtype.type(1)).dtype
 
     # select points of the direct alignment (having score >= threshold*best)
-    t2s_sub_alignment = []
-    for t in range(t_len):
-        threshold_value = threshold * norm_axis1[t2s_best_indexes[t], t]
-        t2s_sub_alignment += [(s, t) for s in range(s_len) if norm_axis1[s, t] >= threshold_value]
+    t2s_best = norm_axis1[norm_axis1.argmax(0), np.arange(norm_axis1.shape[1])].astype(dtype)
+    t2s_mask = norm_axis1 >= threshold * t2s_best[np.newaxis]
 
     # select points of the inverted alignment (having score >= threshold*best)
-    s2t_sub_alignment = []
-    for s in range(s_len):
-        threshold_value = threshold * norm_axis0[s, s2t_best_indexes[s]]
-        s2t_sub_alignment += [(s, t) for t in range(t_len) if norm_axis0[s, t] >= threshold_value]
+    s2t_best = norm_axis0[np.arange(norm_axis0.shape[0]), norm_axis0.argmax(1)].astype(dtype)
+    s2t_mask = norm_axis0 >= threshold * s2t_best[:, np.newaxis]
 
-    if not t2s_sub_alignment and not s2t_sub_alignment:
+    if not t2s_mask.any() and not s2t_mask.any():
         return []
 
     # symmetrization on token-based alignment
-    t2s_alignment = sorted(set([(source_indexes[al[0]], target_indexes[al[1]]) for al in t2s_sub_alignment]))
-    s2t_alignment = sorted(set([(source_indexes[al[0]], target_indexes[al[1]]) for al in s2t_sub_alignment]))
-    highest_source_index = source_indexes[-1]
-    highest_target_index = target_indexes[-1]
+    source_indexes = np.asarray(source_indexes)
+    target_indexes = np.asarray(target_indexes)
+
+    t2s_alignment = _to_word_alignment(t2s_mask, source_indexes, target_indexes)
+    s2t_alignment = _to_word_alignment(s2t_mask, source_indexes, target_indexes)
+    highest_source_index = int(source_indexes[-1])
+    highest_target_index = int(target_indexes[-1])
     alignment = sorted(symmetrize(t2s_alignment, s2t_alignment, highest_source_index + 1, highest_target_index + 1))
 
     # shift source indexes if a language prefix has been used
@@ -123,6 +97,17 @@ def make_alignment(source_indexes, target_indexes, attention_matrix, prefix_lang
     return alignment
 
 
+def _to_word_alignment(mask, source_indexes, target_indexes):
+    # map the sub-word points of the mask to sorted and unique word points
+    s, t = np.nonzero(mask)
+    if len(s) == 0:
+        return []
+
+    width = int(target_indexes.max()) + 1
+    points = np.unique(source_indexes[s] * width + target_indexes[t])  # sorted as (source, target) pairs
+    return list(zip((points // width).tolist(), (points % width).tolist()))
+
+
 _is_word_regex = regex.compile(r'\w', flags=regex.U)
 
 
@@ -134,19 +119,11 @@ def clean_alignment(alignment, src, tgt):
     if len(alignment) == 0:
         return alignment
 
-    filtered = []
-    src_tokens = src.split()
-    tgt_tokens = tgt.split()
-
-    for align in alignment:
-        src_token = src_tokens[align[0]]
-        tgt_token = tgt_tokens[align[1]]
-
-        if (_is_punctuation(src_token) and _is_punctuation(tgt_token)) or \
-                (not _is_punctuation(src_token) and not _is_punctuation(tgt_token)):
-            filtered.append(align)
+    # keep only points between two punctuation tokens or two word tokens
+    src_punctuation = [_is_punctuation(token) for token in src.split()]
+    tgt_punctuation = [_is_punctuation(token) for token in tgt.split()]
 
-    return filtered
+    return [align for align in alignment if src_punctuation[align[0]] == tgt_punctuation[align[1]]]
 
 
 # - Alignment util functions -------------------------------------------------------------------------------------------
@@ -171,77 +148,40 @@ def _neighboring_points_orthogonal(o_index, i_index, e_len, f_len):
     return result
 
 
-def _neighboring_points_diagonal(o_index, i_index, e_len, f_len):
-    """
-    A function that returns list of neighboring points in
-    an alignment matrix for a given alignment (pair of indexes)
-    """
-    result = []
-
-    if o_index > 0 and i_index > 0:
-        result.append((o_index - 1, i_index - 1))
-    if o_index > 0 and i_index < f_len - 1:
-        result.append((o_index - 1, i_index + 1))
-    if o_index < e_len - 1 and i_index > 0:
-        result.append((o_index + 1, i_index - 1))
-    if o_index < e_len - 1 and i_index < f_len - 1:
-        result.append((o_index + 1, i_index + 1))
-
-    return result
+def _to_matrix(points, ilen, olen):
+    matrix = [bytearray(olen) for _ in range(ilen)]
+    for i, o in points:
+        matrix[i][o] = 1
+    return matrix
 
 
-def _neighboring_points(o_index, i_index, e_len, f_len):
+def _grow(alignment, union, ilen, olen, neighboring_points):
     """
-    A function that returns list of neighboring points in
-    an alignment matrix for a given alignment (pair of indexes)
+    Add to "alignment" (in place) the neighboring points that belong to "union" and whose row or column
+    is not aligned yet. Points are visited in the same order of repeated row-major scans of the matrix
+    until no point is added: a point added after the one being visited is visited in the same scan,
+    otherwise in the next one. Visiting a point twice never adds anything, as coverage only grows.
     """
-    result = []
+    i_coverage, o_coverage = [0] * ilen, [0] * olen
+    for i, o in alignment:
+        i_coverage[i] += 1
+        o_coverage[o] += 1
 
-    if o_index > 0:
-        result.append((o_index - 1, i_index))
-    if i_index > 0:
-        result.append((o_index, i_index - 1))
-    if o_index < e_len - 1:
-        result.append((o_index + 1, i_index))
-    if i_index < f_len - 1:
-        result.append((o_index, i_index + 1))
-    if o_index > 0 and i_index > 0:
-        result.append((o_index - 1, i_index - 1))
-    if o_index > 0 and i_index < f_len - 1:
-        result.append((o_index - 1, i_index + 1))
-    if o_index < e_len - 1 and i_index > 0:
-        result.append((o_index + 1, i_index - 1))
-    if o_index < e_len - 1 and i_index < f_len - 1:
-        result.append((o_index + 1, i_index + 1))
-
-    return result
+    queue = [(0, i, o) for i, o in alignment]
+    heapq.heapify(queue)
 
+    while len(queue) > 0:
+        scan, i, o = heapq.heappop(queue)
 
-def _aligned_o(o, ilen, alignment):
-    """
-    A function that checks if a given 'english' word is aligned
-    to any foreign word in a given foreign sentence
-    """
-    for i in range(ilen):
-        if (i, o) in alignment:
-            return True
+        for (i_new, o_new) in neighboring_points(i, o, ilen, olen):
+            if union[i_new][o_new] and not (o_coverage[o_new] > 0 and i_coverage[i_new] > 0):
+                alignment.append((i_new, o_new))
+                i_coverage[i_new] += 1
+                o_coverage[o_new] += 1
 
-    return False
+                heapq.heappush(queue, (scan if (i_new, o_new) > (i, o) else scan + 1, i_new, o_new))
 
-
-def _aligned_i(i, olen, alignment):
-    """
-    A function that checks if a given foreign word is aligned
-    to any 'english' word in a given 'english' sentence
-    """
-    # print "i:%s" % (i)
-    # print "olen:%s" % (olen)
-    # print "len(alignment):%s" % (len(alignment))
-    for o in range(olen):
-        if (i, o) in alignment:
-            return True
-
-    return False
+    return alignment
 
 
 def _final(alignment, i2o, o2i, ilen, olen):
@@ -249,8 +189,14 @@ def _final(alignment, i2o, o2i, ilen, olen):
     A function that implements both FINAL(e2f) and FINAL(f2e)
     steps of GROW-DIAG-FINAL algorithm
     """
-    for o in range(olen):
-        for i in range(ilen):
-            if not (_aligned_o(o, ilen, alignment) and _aligned_i(i, olen, alignment)) \
-                    and ((i, o) in i2o or (i, o) in o2i):
-                alignment.append((i, o))
+    i_coverage, o_coverage = [0] * ilen, [0] * olen
+    for i, o in alignment:
+        i_coverage[i] += 1
+        o_coverage[o] += 1
+
+    # candidates are visited column by column, as in a full scan of the matrix
+    for i, o in sorted(set(i2o) | set(o2i), key=lambda point: (point[1], point[0])):
+        if i < ilen and o < olen and not (o_coverage[o] > 0 and i_coverage[i] > 0):
+            alignment.append((i, o))
+            i_coverage[i] += 1
+            o_coverage[o] += 1
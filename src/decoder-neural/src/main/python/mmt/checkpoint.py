@@ -1,10 +1,19 @@
+import copy
+import json
 import logging
 import os
-from collections import defaultdict
-
+import pickle
+import shutil
+import threading
+import time
+from collections import defaultdict, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
 import torch
 from fairseq import tasks
 from mmt import SubwordDictionary
+from mmt.shortlist import Shortlist
 from torch.serialization import default_restore_location
 
 
@@ -18,32 +27,254 @@ def resize_embeddings(tensor, size):
     return tensor
 
 
+class CheckpointCache(object):
+    """
+    Startup-optimized copy of a checkpoint, stored in the "model.cache" folder next to "model.pt":
+    the model tensors (already resized) are written contiguously in a single file that is memory-mapped
+    at load time, the vocabulary is pickled and a manifest describes the layout and the source files the
+    cache has been built from. The cache is stale as soon as "model.pt" or "model.vcb" change.
+    It is never written while serving: it is created once with "mmt export-cache" (see create_cache()).
+    """
+    VERSION = 1
+    ALIGNMENT = 64
+
+    def __init__(self, checkpoint_path):
+        self._checkpoint_path = checkpoint_path
+        self._path = os.path.join(checkpoint_path, 'model.cache')
+        self._manifest = None
+
+    @property
+    def path(self):
+        return self._path
+
+    def _sources(self):
+        sources = {}
+        for filename in ['model.pt', 'model.vcb']:
+            stat = os.stat(os.path.join(self._checkpoint_path, filename))
+            sources[filename] = [stat.st_size, stat.st_mtime_ns]
+        return sources
+
+    def _read_manifest(self):
+        if self._manifest is None:
+            manifest_path = os.path.join(self._path, 'manifest.json')
+            if not os.path.isfile(manifest_path):
+                return None
+
+            with open(manifest_path, 'r', encoding='utf-8') as stream:
+                self._manifest = json.load(stream)
+
+        return self._manifest
+
+    def is_valid(self, embeddings_size=None):
+        try:
+            manifest = self._read_manifest()
+            if manifest is None or manifest['version'] != self.VERSION or manifest['sources'] != self._sources():
+                return False
+        except (IOError, ValueError, KeyError):
+            return False
+
+        return embeddings_size is None or manifest['embeddings_size'] == embeddings_size
+
+    def vocab_size(self):
+        return self._read_manifest()['vocab_size']
+
+    def load_dictionary(self):
+        with open(os.path.join(self._path, 'model.vcb.bin'), 'rb') as stream:
+            return pickle.load(stream)
+
+    def load(self):
+        manifest = self._read_manifest()
+
+        with open(os.path.join(self._path, 'model.meta'), 'rb') as stream:
+            args, decode_stats = pickle.load(stream)
+        args.data = self._checkpoint_path
+
+        # copy-on-write mapping: pages are read on demand and shared among processes until modified
+        data = np.memmap(os.path.join(self._path, 'model.bin'), dtype=np.uint8, mode='c')
+
+        model_state = OrderedDict()
+        for name, dtype, shape, offset, length in manifest['tensors']:
+            array = data[offset:offset + length].view(np.dtype(dtype)).reshape(shape)
+            model_state[name] = torch.from_numpy(array)
+
+        return args, model_state, decode_stats
+
+    def store(self, args, model_state, decode_stats, embeddings_size):
+        tmp_path = '%s.%d.tmp' % (self._path, os.getpid())
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        os.makedirs(tmp_path)
+
+        try:
+            tensors = []
+            offset = 0
+
+            with open(os.path.join(tmp_path, 'model.bin'), 'wb') as stream:
+                for name, tensor in model_state.items():
+                    array = tensor.detach().cpu().contiguous().numpy()
+
+                    padding = (-offset) % self.ALIGNMENT
+                    stream.write(b'\0' * padding)
+                    offset += padding
+
+                    stream.write(array.tobytes())
+                    tensors.append([name, array.dtype.str, list(array.shape), offset, array.nbytes])
+                    offset += array.nbytes
+
+            with open(os.path.join(tmp_path, 'model.meta'), 'wb') as stream:
+                pickle.dump((args, decode_stats), stream, protocol=pickle.HIGHEST_PROTOCOL)
+
+            dictionary = SubwordDictionary.load(os.path.join(self._checkpoint_path, 'model.vcb'))
+            with open(os.path.join(tmp_path, 'model.vcb.bin'), 'wb') as stream:
+                pickle.dump(dictionary, stream, protocol=pickle.HIGHEST_PROTOCOL)
+
+            manifest = {
+                'version': self.VERSION,
+                'sources': self._sources(),
+                'embeddings_size': embeddings_size,
+                'vocab_size': len(dictionary),
+                'tensors': tensors
+            }
+
+            with open(os.path.join(tmp_path, 'manifest.json'), 'w', encoding='utf-8') as stream:
+                json.dump(manifest, stream)
+
+            shutil.rmtree(self._path, ignore_errors=True)
+            os.rename(tmp_path, self._path)
+            self._manifest = manifest
+        except BaseException:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            raise
+
+
+class DeviceStateCache(object):
+    """
+    Copies of the most recently used checkpoint states on a device, bounded by a number of entries and
+    by a memory budget in bytes: the least recently used states are evicted first, the one just requested
+    never is (if it exceeds the budget alone, it is returned without being cached).
+    """
+
+    def __init__(self, device, max_entries, max_bytes=None, dtype=None):
+        self._device = device
+        self._max_entries = max_entries
+        self._max_bytes = max_bytes
+        self._dtype = dtype
+        self._states = OrderedDict()
+        self._bytes = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def sizeof(state):
+        return sum(tensor.element_size() * tensor.nelement() for tensor in state.values())
+
+    def _device_sizeof(self, state):
+        # the size of the state once copied on the device, floating point tensors converted to "dtype"
+        dtype_size = torch.empty(0, dtype=self._dtype).element_size() if self._dtype is not None else None
+        return sum((dtype_size if dtype_size is not None and tensor.is_floating_point() else tensor.element_size())
+                   * tensor.nelement() for tensor in state.values())
+
+    def _to_device(self, tensor):
+        if self._dtype is not None and tensor.is_floating_point():
+            return tensor.to(device=self._device, dtype=self._dtype, non_blocking=True)
+        return tensor.to(device=self._device, non_blocking=True)
+
+    def get(self, checkpoint):
+        if checkpoint in self._states:
+            self.hits += 1
+            self._states.move_to_end(checkpoint)
+            return self._states[checkpoint], True
+
+        self.misses += 1
+
+        size = self._device_sizeof(checkpoint.state)
+        cacheable = self._max_entries > 0 and (self._max_bytes is None or size <= self._max_bytes)
+
+        # release memory before copying the new state on the device
+        while cacheable and len(self._states) > 0 and \
+                (len(self._states) >= self._max_entries or
+                 (self._max_bytes is not None and self._bytes + size > self._max_bytes)):
+            self._evict()
+
+        state = OrderedDict((name, self._to_device(tensor)) for name, tensor in checkpoint.state.items())
+
+        if cacheable:
+            self._states[checkpoint] = state
+            self._bytes += size
+
+        return state, False
+
+    def _evict(self):
+        _, state = self._states.popitem(last=False)
+        self._bytes -= self.sizeof(state)
+        self.evictions += 1
+
+    def __len__(self):
+        return len(self._states)
+
+    def __str__(self):
+        return 'hits = %d, misses = %d, evictions = %d, entries = %d, bytes = %d' % \
+               (self.hits, self.misses, self.evictions, len(self._states), self._bytes)
+
+
 class UnsupportedLanguageException(KeyError):
     def __init__(self, source_language, target_language, *args: object) -> None:
         super().__init__("unsupported language: %s > %s" % (source_language, target_language), *args)
 
 
 class Checkpoint(object):
-    def __init__(self, task, model_state, decode_stats, multilingual_target=False):
+    def __init__(self, task, model_state, decode_stats, multilingual_target=False, loader=None):
         self.task = task
         self._checkpoint_path = self.task.args.data
         self._decode_stats = decode_stats or {}
         self._state = model_state
         self._multilingual_target = multilingual_target
+        self._loader = loader
+        self._shortlist = None
         self._logger = logging.getLogger(self.__class__.__name__)
 
+    @property
+    def path(self):
+        return self._checkpoint_path
+
     @property
     def multilingual_target(self):
         return self._multilingual_target
 
+    @property
+    def loaded(self):
+        return self._state is not None
+
     @property
     def state(self):
+        if self._state is None:
+            raise RuntimeError('Checkpoint state not loaded: %s' % self._checkpoint_path)
         return self._state
 
+    def load(self):
+        # the loader returns the tuple (model_state, decode_stats)
+        if self._state is None:
+            self._state, decode_stats = self._loader()
+            self._decode_stats = decode_stats or {}
+
+    def unload(self):
+        if self._loader is None:
+            raise RuntimeError('Checkpoint cannot be unloaded: %s' % self._checkpoint_path)
+        self._state = None
+
     @property
     def subword_dictionary(self):
         return self.task.source_dictionary
 
+    @property
+    def shortlist(self):
+        # the lexical shortlist is optional, it is loaded the first time it is requested
+        if self._shortlist is None and Shortlist.exists(self._checkpoint_path):
+            self._shortlist = Shortlist.load(self._checkpoint_path)
+            self._logger.info('lexical shortlist loaded from %s' % Shortlist.path(self._checkpoint_path))
+        return self._shortlist
+
     def size_in_bytes(self):
         size = 0
         for tensor in self._state.values():
@@ -81,10 +312,12 @@ class Checkpoint(object):
 
 class CheckpointRegistry(object):
     class Builder(object):
-        def __init__(self):
+        def __init__(self, use_cache=True):
             self._checkpoints_names = set()
             self._checkpoints_by_path = defaultdict(list)
             self._max_vocab_size = 0
+            self._use_cache = use_cache
+            self._logger = logging.getLogger('CheckpointRegistry.Builder')
 
         @property
         def embeddings_size(self):
@@ -97,34 +330,82 @@ class CheckpointRegistry(object):
             self._checkpoints_names.add(name)
             self._checkpoints_by_path[checkpoint_path].append(name)
 
-            dict_path = os.path.join(checkpoint_path, 'model.vcb')
-            self._max_vocab_size = max(self._max_vocab_size, SubwordDictionary.size_of(dict_path))
+            cache = CheckpointCache(checkpoint_path)
+            if self._use_cache and cache.is_valid():
+                vocab_size = cache.vocab_size()
+            else:
+                vocab_size = SubwordDictionary.size_of(os.path.join(checkpoint_path, 'model.vcb'))
+            self._max_vocab_size = max(self._max_vocab_size, vocab_size)
 
             return self
 
-        def build(self, device=None):
+        def build(self, device=None, memory_budget=None, pinned=None):
+            """
+            Build the registry: checkpoint states are loaded lazily on first use and evicted (least recently
+            used first) when their total size exceeds "memory_budget" bytes; "pinned" checkpoint names
+            are loaded immediately and never evicted. A lazily loaded checkpoint is loaded by the first request
+            using it, which waits for the whole load time (seconds for large models, see "load_time" in logs).
+            """
+            pinned = set(pinned or [])
+            for name in pinned:
+                if name not in self._checkpoints_names:
+                    raise ValueError('Unknown pinned checkpoint "%s"' % name)
+
+            begin = time.time()
             checkpoints = {}
+            pinned_checkpoints = set()
+            sample_args = None
 
             for path, keys in self._checkpoints_by_path.items():
-                args, model_state, decode_stats = self._load(path, self._max_vocab_size)
-                task = tasks.setup_task(args)
+                loader = self._mk_loader(path, self._max_vocab_size)
+
+                if sample_args is None:
+                    # the first checkpoint is loaded in order to read the model arguments, shared by all checkpoints
+                    sample_args, model_state, decode_stats = self._load(path, self._max_vocab_size)
+                    args = sample_args
+                else:
+                    args = copy.deepcopy(sample_args)
+                    args.data = path
+                    model_state, decode_stats = None, None
+
+                task = tasks.setup_task(args, dictionary=self._load_dictionary(path))
                 task.source_dictionary.force_length(self._max_vocab_size)
 
                 target_languages = set([key.split('__', 1)[1] for key in keys])
 
                 checkpoint = self._mk_checkpoint(task, model_state, decode_stats,
-                                                 multilingual_target=len(target_languages) > 1)
+                                                 multilingual_target=len(target_languages) > 1, loader=loader)
 
                 for key in keys:
                     checkpoints[key] = checkpoint
+                    if key in pinned:
+                        pinned_checkpoints.add(checkpoint)
 
-            return self._mk_registry(checkpoints, device)
+            registry = self._mk_registry(checkpoints, device, memory_budget, pinned_checkpoints)
+            self._logger.info('checkpoint registry built: checkpoints = %d, build_time = %.3f' %
+                              (len(self._checkpoints_by_path), time.time() - begin))
+
+            return registry
+
+        def _mk_loader(self, checkpoint_path, embeddings_size):
+            def _loader():
+                _, model_state, decode_stats = self._load(checkpoint_path, embeddings_size)
+                return model_state, decode_stats
+
+            return _loader
 
         def _load(self, checkpoint_path, embeddings_size=None):
             model_pt_path = os.path.join(checkpoint_path, 'model.pt')
             if not os.path.isfile(model_pt_path):
                 raise IOError('Model file not found: {}'.format(model_pt_path))
 
+            cache = CheckpointCache(checkpoint_path)
+            if self._use_cache and cache.is_valid(embeddings_size):
+                try:
+                    return cache.load()
+                except Exception as e:
+                    self._logger.warning('Unable to load checkpoint cache %s: %s' % (cache.path, str(e)))
+
             # Load model from file
             model_pt = torch.load(model_pt_path, map_location=lambda s, l: default_restore_location(s, 'cpu'))
             args, model_state, decode_stats = model_pt['args'], model_pt['model'], \
@@ -138,24 +419,72 @@ class CheckpointRegistry(object):
                     resize_embeddings(model_state['decoder.embed_tokens.weight'], embeddings_size)
 
             args.data = checkpoint_path
+
             return args, model_state, decode_stats
 
-        def _mk_checkpoint(self, task, model_state, decode_stats, multilingual_target):
-            return Checkpoint(task, model_state, decode_stats, multilingual_target=multilingual_target)
+        def _load_dictionary(self, checkpoint_path):
+            # the dictionary in the checkpoint cache (if enabled and valid), None to read "model.vcb"
+            cache = CheckpointCache(checkpoint_path)
+            if self._use_cache and cache.is_valid():
+                try:
+                    return cache.load_dictionary()
+                except Exception as e:
+                    self._logger.warning('Unable to load checkpoint cache %s: %s' % (cache.path, str(e)))
+
+            return None
+
+        def create_cache(self, checkpoint_path):
+            """
+            Create the "model.cache" of a registered checkpoint, as loaded by the decoder (embeddings resized
+            to the largest registered vocabulary); it returns False if a valid cache already exists.
+            """
+            cache = CheckpointCache(checkpoint_path)
+            if cache.is_valid(self._max_vocab_size):
+                return False
+
+            args, model_state, decode_stats = self._load(checkpoint_path, self._max_vocab_size)
 
-        def _mk_registry(self, checkpoints, device):
-            return CheckpointRegistry(checkpoints, device=device)
+            begin = time.time()
+            cache.store(args, model_state, decode_stats, self._max_vocab_size)
+            self._logger.info('checkpoint cache created: %s, store_time = %.3f' % (cache.path, time.time() - begin))
 
-    def __init__(self, checkpoints, device=None) -> None:
+            return True
+
+        def _mk_checkpoint(self, task, model_state, decode_stats, multilingual_target, loader=None):
+            return Checkpoint(task, model_state, decode_stats, multilingual_target=multilingual_target, loader=loader)
+
+        def _mk_registry(self, checkpoints, device, memory_budget=None, pinned=None):
+            return CheckpointRegistry(checkpoints, device=device, memory_budget=memory_budget, pinned=pinned)
+
+    def __init__(self, checkpoints, device=None, memory_budget=None, pinned=None) -> None:
         self._checkpoints = checkpoints
         self._device = device
+        self._memory_budget = memory_budget
+        self._pinned = set(pinned or [])
+        self._loaded = OrderedDict()  # loaded checkpoints, from the least to the most recently used
+        self._lock = threading.Lock()
+        self._logger = logging.getLogger(self.__class__.__name__)
 
         sample = next(iter(checkpoints.values()))
 
         self.task = sample.task
         self.args = sample.task.args
 
-    def load(self, source_lang, target_lang):
+        # initial checkpoints are loaded in parallel
+        initial = [c for c in set(checkpoints.values()) if c.loaded or c in self._pinned]
+        if len(initial) > 1:
+            begin = time.time()
+            with ThreadPoolExecutor(max_workers=min(len(initial), os.cpu_count() or 1)) as executor:
+                list(executor.map(lambda c: c.load(), initial))
+            self._logger.info('%d checkpoints loaded, load_time = %.3f' % (len(initial), time.time() - begin))
+
+        for checkpoint in initial:
+            self._load_state(checkpoint)
+
+    def get(self, source_lang, target_lang):
+        """
+        Return the checkpoint for the given language pair, without loading its state.
+        """
         key = '%s__%s' % (source_lang, target_lang)
 
         if key in self._checkpoints:
@@ -163,6 +492,56 @@ class CheckpointRegistry(object):
         else:
             raise UnsupportedLanguageException(source_lang, target_lang)
 
+    def load(self, source_lang, target_lang):
+        """
+        Return the checkpoint for the given language pair, loading its state if necessary.
+        """
+        checkpoint = self.get(source_lang, target_lang)
+
+        with self._lock:
+            self._load_state(checkpoint)
+
+        return checkpoint
+
+    def _load_state(self, checkpoint):
+        if checkpoint in self._loaded:
+            self._loaded.move_to_end(checkpoint)
+            return
+
+        if not checkpoint.loaded:
+            begin = time.time()
+            checkpoint.load()
+            self._logger.info('checkpoint loaded: %s, size = %.1fMB, load_time = %.3f' %
+                              (checkpoint, checkpoint.size_in_bytes() / (1024 * 1024), time.time() - begin))
+
+        self._loaded[checkpoint] = True
+        self._evict(keep=checkpoint)
+
+    def _evict(self, keep):
+        if self._memory_budget is None:
+            return
+
+        used = sum(checkpoint.size_in_bytes() for checkpoint in self._loaded)
+
+        for checkpoint in list(self._loaded.keys()):
+            if used <= self._memory_budget:
+                break
+            if checkpoint == keep or checkpoint in self._pinned:
+                continue
+
+            size = checkpoint.size_in_bytes()
+            checkpoint.unload()
+            del self._loaded[checkpoint]
+            used -= size
+
+            self._logger.info('checkpoint evicted: %s, size = %.1fMB, used = %.1fMB, budget = %.1fMB' %
+                              (checkpoint, size / (1024 * 1024), used / (1024 * 1024),
+                               self._memory_budget / (1024 * 1024)))
+
+        if used > self._memory_budget:
+            self._logger.warning('checkpoints memory budget exceeded: used = %.1fMB, budget = %.1fMB' %
+                                 (used / (1024 * 1024), self._memory_budget / (1024 * 1024)))
+
     def __len__(self):
         return len(self._checkpoints)
 
@@ -171,3 +550,24 @@ class CheckpointRegistry(object):
 
     def __repr__(self):
         return self.__class__.__name__ + str(self._checkpoints)
+
+
+def create_cache(model_path):
+    """
+    Create the "model.cache" of every checkpoint of the decoder model in "model_path" (the folder with
+    "model.conf"), skipping the ones already up to date; it returns the paths of the created caches.
+    """
+    from mmt.decoder import ModelConfig  # mmt.decoder depends on this module
+
+    config = ModelConfig.load(model_path)
+
+    builder = CheckpointRegistry.Builder(use_cache=False)
+    for name, checkpoint_path in config.checkpoints:
+        builder.register(name, checkpoint_path)
+
+    created = []
+    for checkpoint_path in sorted(set(path for _, path in config.checkpoints)):
+        if builder.create_cache(checkpoint_path):
+            created.append(checkpoint_path)
+
+    return created
@@ -1,9 +1,13 @@
 import configparser
+import copy
+import functools
 import logging
 import math
 import os
 import time
+from collections import OrderedDict
 
+import cachetools
 import fairseq
 import numpy as np
 import torch
@@ -11,15 +15,84 @@ from fairseq.models.transformer import TransformerModel
 from fairseq.sequence_generator import SequenceGenerator
 
 from mmt import textencoder
-from mmt.alignment import make_alignment, clean_alignment
+from mmt.checkpoint import DeviceStateCache
+from mmt.generator import BeamSearch
+from mmt.alignment import make_alignment, clean_alignment, SYMMETRIZATION_STRATEGIES
 from mmt.tuning import Tuner, TuningOptions
 
 
 class Translation(object):
-    def __init__(self, text, alignment=None, score=None):
+    def __init__(self, text, alignment=None, score=None, nbest=None):
         self.text = text
-        self.alignment = alignment
         self.score = score
+        self.nbest = nbest
+        self._alignment = alignment
+
+    @property
+    def alignment(self):
+        # alignment can be provided as a callable in order to defer its computation until actually needed
+        if callable(self._alignment):
+            self._alignment = self._alignment()
+        return self._alignment
+
+    @alignment.setter
+    def alignment(self, value):
+        self._alignment = value
+
+
+class TranslationCache(cachetools.LRUCache):
+    """
+    LRU cache of translations, bounded both in number of entries and in (approximated) bytes;
+    it keeps track of hits, misses and evictions.
+    """
+
+    def __init__(self, max_entries, max_bytes):
+        super().__init__(maxsize=max_bytes, getsizeof=self._sizeof)
+        self._max_entries = max_entries
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def _sizeof(translation):
+        # text plus the alignment: a deferred one holds the attention matrix it is computed from ("nbytes"),
+        # a computed one roughly 64 bytes per point (a tuple of two ints)
+        size = 64 + 2 * len(translation.text)
+
+        alignment = translation._alignment
+        if callable(alignment):
+            size += getattr(alignment, 'nbytes', 0)
+        elif alignment is not None:
+            size += 64 * len(alignment)
+
+        return size
+
+    def lookup(self, key):
+        translation = self.get(key)
+        if translation is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+
+        return translation
+
+    def __setitem__(self, key, value):
+        if self._sizeof(value) > self.maxsize:
+            return  # too large to be cached
+
+        super().__setitem__(key, value)
+        while len(self) > self._max_entries:
+            self.popitem()
+
+    def popitem(self):
+        item = super().popitem()
+        self.evictions += 1
+        return item
+
+    def __str__(self):
+        return 'hits = %d, misses = %d, evictions = %d, entries = %d, bytes = %d' % \
+               (self.hits, self.misses, self.evictions, len(self), self.currsize)
 
 
 class Suggestion(object):
@@ -31,6 +104,23 @@ class Suggestion(object):
         self.score = score
 
 
+class DecoderOptions(object):
+    def __init__(self):
+        # one of: direct, inverse, intersect, union, grow, grow_diagonal, grow_diagonal_final_and
+        self.alignment_symmetrization = 'intersect'
+        # restrict the output layer to the lexical shortlist of the checkpoint (if any), see "mmt shortlist"
+        self.output_shortlist = False
+        # beam search implementation, one of: fairseq (SequenceGenerator), builtin (mmt.generator.BeamSearch)
+        self.generator = 'fairseq'
+        # return the translation of a suggestion with score 1.0 and the same segment (whitespaces aside)
+        # as the input, without tuning nor decoding (only the alignment is computed, if requested): the translation
+        # has score 1.0 and the n-best list holds the distinct translations of the matching suggestions
+        self.exact_match_shortcut = False
+
+    def __str__(self):
+        return str(self.__dict__)
+
+
 class ModelConfig(object):
     __custom_values = {'True': True, 'False': False, 'None': None}
 
@@ -56,18 +146,25 @@ class ModelConfig(object):
 
         return value
 
-    @property
-    def tuning(self):
-        ops = TuningOptions()
-
+    def _load_settings(self, ops, *other_ops):
+        # the "settings" section is shared by different options objects, each one takes its own values
         if self._config.has_section('settings'):
             for name, value in self._config.items('settings'):
-                if not hasattr(ops, name):
+                if hasattr(ops, name):
+                    setattr(ops, name, self._parse(value))
+                elif not any(hasattr(other, name) for other in other_ops):
                     raise ValueError('Invalid option "%s"' % name)
-                setattr(ops, name, self._parse(value))
 
         return ops
 
+    @property
+    def tuning(self):
+        return self._load_settings(TuningOptions(), DecoderOptions())
+
+    @property
+    def decoding(self):
+        return self._load_settings(DecoderOptions(), TuningOptions())
+
     @property
     def checkpoints(self):
         def normalize_lang(lang):
@@ -92,6 +189,8 @@ class ModelConfig(object):
 
 
 class MMTDecoder(object):
+    GENERATORS = ['fairseq', 'builtin']
+
     @classmethod
     def _create_model(cls, checkpoints, device, beam_size, use_fp16):
         model = TransformerModel.build_model(checkpoints.args, checkpoints.task)
@@ -117,7 +216,22 @@ class MMTDecoder(object):
         return model
 
     @classmethod
-    def _create_translator(cls, checkpoints, beam_size):
+    def _create_quantized_model(cls, model, quantize):
+        if quantize != 'int8':
+            raise ValueError('Unsupported quantization "%s"' % quantize)
+
+        # dynamic quantization of nn.Linear modules (attention output and feed-forward projections)
+        return torch.quantization.quantize_dynamic(copy.deepcopy(model), {torch.nn.Linear}, dtype=torch.qint8)
+
+    @classmethod
+    def _create_translator(cls, checkpoints, beam_size, generator='fairseq'):
+        if generator == 'builtin':
+            return BeamSearch(
+                checkpoints.task.target_dictionary, beam_size=beam_size,
+                max_len_a=0, max_len_b=1, min_len=1,
+                normalize_scores=True, len_penalty=1, unk_penalty=0
+            )
+
         return SequenceGenerator(
             checkpoints.task.target_dictionary, beam_size=beam_size,
             max_len_a=0, max_len_b=1, min_len=1,
@@ -131,14 +245,45 @@ class MMTDecoder(object):
     def _create_tuner(cls, checkpoints, model, tuning_ops, device):
         return Tuner(checkpoints.args, checkpoints.task, model, tuning_ops=tuning_ops, device=device)
 
-    def __init__(self, checkpoints, device=None, beam_size=5, use_fp16=False, tuning_ops=None):
+    def __init__(self, checkpoints, device=None, beam_size=5, use_fp16=False, tuning_ops=None, max_batch_tokens=2048,
+                 cache_max_entries=50000, cache_max_bytes=64 * 1024 * 1024, quantize=None, share_weights=False,
+                 device_cache_entries=0, device_cache_bytes=None, decoder_ops=None):
+        if quantize is not None and device is not None:
+            raise ValueError('Quantization is supported on CPU only')
+        if share_weights and device is not None:
+            raise ValueError('Weights sharing is supported on CPU only')
+
         torch.manual_seed(checkpoints.args.seed)
 
         self._checkpoints = checkpoints
         self._device = device
+        self._max_batch_tokens = max_batch_tokens
+        self._beam_size = beam_size
         self._model = self._create_model(checkpoints, device=device, beam_size=beam_size, use_fp16=use_fp16)
-        self._translator = self._create_translator(checkpoints, beam_size)
-        self._tuner = self._create_tuner(checkpoints, self._model, tuning_ops, device)
+        self._decoder_ops = decoder_ops if decoder_ops is not None else DecoderOptions()
+        if self._decoder_ops.generator not in self.GENERATORS:
+            raise ValueError('Invalid generator "%s", valid values are: %s' %
+                             (self._decoder_ops.generator, ', '.join(self.GENERATORS)))
+        self._translator = self._create_translator(checkpoints, beam_size, self._decoder_ops.generator)
+        self._translators = {beam_size: self._translator}
+        # with a device cache, the model parameters point to the cached states (no copy on language switch)
+        self._device_states = DeviceStateCache(device, device_cache_entries, device_cache_bytes,
+                                               dtype=torch.half if use_fp16 else None) \
+            if device is not None and device_cache_entries > 0 else None
+        self._share_weights = share_weights or self._device_states is not None
+        self._quantize = quantize
+        self._quantized_model = None
+        self._quantized_checkpoint = None
+        self._cache = TranslationCache(cache_max_entries, cache_max_bytes) \
+            if cache_max_entries > 0 and cache_max_bytes > 0 else None
+        self._tuning_ops = tuning_ops if tuning_ops is not None else TuningOptions()
+        if self._decoder_ops.alignment_symmetrization not in SYMMETRIZATION_STRATEGIES:
+            raise ValueError('Invalid alignment symmetrization "%s", valid values are: %s' %
+                             (self._decoder_ops.alignment_symmetrization, ', '.join(SYMMETRIZATION_STRATEGIES)))
+        self._symmetrize = SYMMETRIZATION_STRATEGIES[self._decoder_ops.alignment_symmetrization]
+        self._tuner = self._create_tuner(checkpoints, self._model, self._tuning_ops, device)
+        self._tuned_states = cachetools.LRUCache(maxsize=self._tuning_ops.tuning_cache_size) \
+            if self._tuning_ops.tuning_cache_size > 0 else None
         self._max_positions = fairseq.utils.resolve_max_positions(
             checkpoints.task.max_positions(),
             self._model.max_positions(),
@@ -147,7 +292,11 @@ class MMTDecoder(object):
         self._logger = logging.getLogger('Transformer')
 
         self._nn_needs_reset = True
+        self._tuned_parameters = set()
+        self._tuning_key = None
         self._checkpoint = None
+        self._state = None
+        self._generated_tokens = 0
 
     # - High level functions -------------------------------------------------------------------------------------------
 
@@ -161,44 +310,279 @@ class MMTDecoder(object):
 
         self._logger.info('test_time = %.3f' % test_time)
 
+    def get_checkpoint(self, source_lang, target_lang):
+        """
+        Return the checkpoint translating the given language pair; "target_lang" can be a list of target
+        languages too (one per segment, see translate()), in which case they must share the same checkpoint.
+        """
+        if isinstance(target_lang, str):
+            return self._checkpoints.get(source_lang, target_lang)
+
+        checkpoints = set([self._checkpoints.get(source_lang, lang) for lang in set(target_lang)])
+        if len(checkpoints) != 1:
+            raise ValueError('Target languages %s are not translated by a single checkpoint' %
+                             ', '.join(sorted(set(target_lang))))
+
+        return checkpoints.pop()
+
+    def encode(self, source_lang, target_lang, batch, forced_translation=None):
+        """
+        Encode a request into subword tokens without touching the model, so that it can be done
+        by a different thread while a previous request is being decoded; the result can be passed
+        to translate() as "encoded_batch".
+        """
+        checkpoint = self.get_checkpoint(source_lang, target_lang)
+        prefix_langs = self._prefix_langs(checkpoint, self._target_langs(target_lang, batch))
+
+        src_tokens = self._encode(checkpoint, batch, prefix_langs=prefix_langs)
+        trg_tokens = self._encode(checkpoint, forced_translation) if forced_translation is not None else None
+
+        return src_tokens, trg_tokens
+
     def translate(self, source_lang, target_lang, batch, suggestions=None,
-                  tuning_epochs=None, tuning_learning_rate=None, forced_translation=None):
+                  tuning_epochs=None, tuning_learning_rate=None, forced_translation=None, nbest=None,
+                  encoded_batch=None, stats=None, alignment=True):
+        """
+        Translate the batch; if "stats" is a dict, it is filled with the time in seconds spent in every
+        step (tokenize, reset, tune, generate), the batch size and the source and generated target tokens.
+        If "alignment" is False, translations have no alignment and attention is not even computed.
+        The "target_lang" can be a list with the target language of every segment, if all of them are
+        translated by the same (multilingual) checkpoint: the whole batch is decoded at once.
+        """
+        if forced_translation is not None and not alignment:
+            return [Translation(text) for text in forced_translation]  # nothing left to compute
+
+        target_langs = self._target_langs(target_lang, batch)
+        if len(set(target_langs)) == 1:
+            target_lang = target_langs[0]  # not a mixed batch
+        else:
+            self.get_checkpoint(source_lang, target_lang)  # it fails if target languages require different models
+
+        # with mixed target languages, any of them identifies the checkpoint to load and tune
+        checkpoint_lang = target_lang if isinstance(target_lang, str) else target_langs[0]
+
+        # (0) Encode batch (if not already done)
+        tokenize_time = None
+        if encoded_batch is None:
+            begin = time.time()
+            encoded_batch = self.encode(source_lang, target_lang, batch, forced_translation=forced_translation)
+            tokenize_time = time.time() - begin
+
+        # Exact translation memory matches are not decoded (if enabled), the model is tuned for the others only
+        matches = self._find_exact_matches(source_lang, target_langs, batch, suggestions, nbest=nbest or 1) \
+            if self._decoder_ops.exact_match_shortcut and forced_translation is None else {}
+        decode_indexes = [i for i in range(len(batch)) if i not in matches]
+
+        tuned = suggestions is not None and len(suggestions) > 0 and len(decode_indexes) > 0
+        tuning_key = self._make_tuning_key(source_lang, checkpoint_lang, suggestions, tuning_epochs,
+                                           tuning_learning_rate) if tuned else None
+
+        # The model may be already tuned with the very same suggestions (i.e. the previous request)
+        reuse = tuning_key is not None and tuning_key == self._tuning_key and self._tuning_ops.tuning_reuse
+
+        # If every segment is an exact match, the model is used (if ever) just for the alignment: a tuned model
+        # is not reset, so that the next request with the same suggestions can reuse it
+        keep = len(matches) > 0 and len(decode_indexes) == 0 and \
+            (not alignment or self._checkpoints.get(source_lang, checkpoint_lang) == self._checkpoint)
+
         # (1) Reset model (if necessary)
         begin = time.time()
-        self._reset_model(source_lang, target_lang)
+        if reuse:
+            reset_type = 'reuse'
+        elif keep:
+            reset_type = 'none, exact matches'
+        else:
+            reset_type = self._reset_model(source_lang, checkpoint_lang)
         reset_time = time.time() - begin
 
         # (2) Tune engine if suggestions provided
         begin = time.time()
-        if suggestions is not None and len(suggestions) > 0:
-            self._tune(suggestions, epochs=tuning_epochs, learning_rate=tuning_learning_rate)
+        if tuned and not reuse:
+            self._tune(suggestions, epochs=tuning_epochs, learning_rate=tuning_learning_rate, tuning_key=tuning_key)
         tune_time = time.time() - begin
 
-        # (3) Translate and compute word alignment
+        # (3) Translate (word alignment is computed when first accessed)
         begin = time.time()
+        src_tokens, trg_tokens = encoded_batch
+        self._generated_tokens = 0
+
         if forced_translation is not None:
-            result = self._force_decode(target_lang, batch, forced_translation)
+            result = self._force_decode(target_langs, batch, forced_translation,
+                                        src_tokens=src_tokens, trg_tokens=trg_tokens)
         else:
-            result = self._decode(source_lang, target_lang, batch)
+            # tuned requests are decoded with the fp32 model, which is the one actually tuned; if every segment
+            # is an exact match nothing is decoded, and the model may still be tuned by a previous request
+            model = None
+            if len(decode_indexes) > 0:
+                model = self._get_quantized_model() if self._quantize is not None and not tuned else self._model
+
+            if len(matches) == 0:
+                result = self._decode(source_lang, target_langs, batch, nbest=nbest or 1, src_tokens=src_tokens,
+                                      use_cache=not tuned, model=model, alignment=alignment)
+            else:
+                result = [None] * len(batch)
+
+                if len(decode_indexes) > 0:
+                    translations = self._decode(source_lang, [target_langs[i] for i in decode_indexes],
+                                                [batch[i] for i in decode_indexes], nbest=nbest or 1,
+                                                src_tokens=[src_tokens[i] for i in decode_indexes],
+                                                use_cache=not tuned, model=model, alignment=alignment)
+                    for i, translation in zip(decode_indexes, translations):
+                        result[i] = translation
+
+                # every translation of the n-best list of a segment is aligned to the segment itself
+                indexes = [i for i in sorted(matches.keys()) for _ in matches[i]]
+                texts = [text for i in sorted(matches.keys()) for text in matches[i]]
+
+                if alignment:
+                    hypos = self._force_decode([target_langs[i] for i in indexes], [batch[i] for i in indexes], texts,
+                                               src_tokens=[src_tokens[i] for i in indexes])
+                else:
+                    hypos = [Translation(text) for text in texts]
+
+                hypos = iter(hypos)
+                for i in sorted(matches.keys()):
+                    hypos_i = [next(hypos) for _ in matches[i]]
+                    for hypo in hypos_i:
+                        hypo.score = 1.
+
+                    best = hypos_i[0]
+                    result[i] = Translation(best.text, alignment=best._alignment, score=best.score,
+                                            nbest=hypos_i if (nbest or 1) > 1 else None)
 
         decode_time = time.time() - begin
 
-        self._logger.info('reset_time = %.3f, tune_time = %.3f, decode_time = %.3f'
-                          % (reset_time, tune_time, decode_time))
+        self._logger.info('reset_time = %.3f (%s), tune_time = %.3f, decode_time = %.3f, exact_matches = %d'
+                          % (reset_time, reset_type, tune_time, decode_time, len(matches)))
+        if self._cache is not None:
+            self._logger.info('cache: %s' % self._cache)
+        if self._device_states is not None:
+            self._logger.info('device cache: %s' % self._device_states)
+
+        if stats is not None:
+            if tokenize_time is not None:
+                stats['tokenize'] = tokenize_time
+            stats.update(reset=reset_time, tune=tune_time, generate=decode_time, batch_size=len(batch),
+                         src_tokens=sum(tokens.numel() for tokens in src_tokens), tgt_tokens=self._generated_tokens,
+                         exact_matches=len(matches))
 
         return result
 
     # - Low level functions --------------------------------------------------------------------------------------------
 
     def _reset_model(self, source_lang, target_lang):
+        # it returns the type of reset performed: "none", "partial" (only tuned parameters) or "full"
         checkpoint = self._checkpoints.load(source_lang, target_lang)
 
-        if self._nn_needs_reset or checkpoint != self._checkpoint:
-            self._model.load_state_dict(checkpoint.state, strict=True)
-            self._checkpoint = checkpoint
-            self._nn_needs_reset = False
+        if checkpoint != self._checkpoint or (self._nn_needs_reset and len(self._tuned_parameters) == 0):
+            reset_type = 'full'
+
+            if self._device_states is not None:
+                self._state, hit = self._device_states.get(checkpoint)
+                reset_type += ', device cache %s' % ('hit' if hit else 'miss')
+            else:
+                self._state = checkpoint.state
+
+            if self._share_weights:
+                self._alias_parameters(self._state)
+            else:
+                self._model.load_state_dict(self._state, strict=True)
+        elif self._nn_needs_reset:
+            self._restore_parameters(self._state, self._tuned_parameters)
+            reset_type = 'partial'
+        else:
+            reset_type = 'none'
+
+        self._checkpoint = checkpoint
+        self._nn_needs_reset = False
+        self._tuned_parameters = set()
+        self._tuning_key = None
+
+        return reset_type
+
+    def _get_quantized_model(self):
+        # the quantized model is built from the fp32 model right after reset (hence not tuned)
+        if self._quantized_checkpoint != self._checkpoint:
+            if self._nn_needs_reset:
+                raise RuntimeError('Cannot quantize a tuned model')
+
+            begin = time.time()
+            self._quantized_model = None  # release memory first
+            self._quantized_model = self._create_quantized_model(self._model, self._quantize)
+            self._quantized_checkpoint = self._checkpoint
+            self._logger.info('quantize_time = %.3f' % (time.time() - begin))
+
+        return self._quantized_model
+
+    def _restore_parameters(self, state, names):
+        # copy back in-place only the given parameters from the (pristine) checkpoint state
+        if self._share_weights:
+            self._alias_parameters(state, names)
+            return
+
+        with torch.no_grad():
+            for name, param in self._model.named_parameters():
+                if name in names:
+                    param.copy_(state[name])
+
+    def _alias_parameters(self, state, names=None):
+        # model parameters point directly to the checkpoint tensors, no copy is made
+        for name, param in self._model.named_parameters():
+            if names is None or name in names:
+                param.data = state[name]
+
+        if names is None:
+            buffers = set([name for name, _ in self._model.named_buffers()])
+            self._model.load_state_dict({name: state[name] for name in buffers if name in state}, strict=False)
+
+    def _materialize_parameters(self, names):
+        # parameters about to be modified get their own copy, leaving the checkpoint tensors untouched
+        if self._share_weights:
+            for name, param in self._model.named_parameters():
+                if name in names:
+                    param.data = param.data.clone()
+
+        self._tuned_parameters |= set(names)
+
+    @staticmethod
+    def _join_tokens(text):
+        # segments are serialized by TokensOutputStream, with the spaces inside a token replaced by U+00A0, while
+        # suggestions are plain tokens joined by spaces: both are compared (and returned) as space separated words
+        return ' '.join([word for word in text.replace('\u00A0', ' ').split(' ') if len(word) > 0])
 
-    def _tune(self, suggestions, epochs=None, learning_rate=None):
+    @classmethod
+    def _find_exact_matches(cls, source_lang, target_langs, segments, suggestions, nbest=1):
+        # it returns the index of every segment with an exact match (score 1.0) in the suggestions and its
+        # distinct translations (at most "nbest"), in the order of the suggestions
+        if suggestions is None or len(suggestions) == 0:
+            return {}
+
+        memory = {}
+        for e in suggestions:
+            if e.score >= 1. and e.source_lang == source_lang:
+                translations = memory.setdefault((e.target_lang, cls._join_tokens(e.segment)), [])
+                translation = cls._join_tokens(e.translation)
+
+                if len(translations) < nbest and translation not in translations:
+                    translations.append(translation)
+
+        matches = {}
+        for i, (segment, target_lang) in enumerate(zip(segments, target_langs)):
+            translations = memory.get((target_lang, cls._join_tokens(segment)))
+            if translations is not None:
+                matches[i] = translations
+
+        return matches
+
+    def _make_tuning_key(self, source_lang, target_lang, suggestions, epochs, learning_rate):
+        # it identifies the state of the model after tuning: the order of suggestions is not relevant
+        checkpoint = self._checkpoints.get(source_lang, target_lang)
+        suggestions = tuple(sorted([(e.source_lang, e.target_lang, e.segment, e.translation, e.score)
+                                    for e in suggestions]))
+
+        return checkpoint, suggestions, epochs, learning_rate
+
+    def _tune(self, suggestions, epochs=None, learning_rate=None, tuning_key=None):
         # Set tuning parameters
         if epochs is None or learning_rate is None:
             _epochs, _learning_rate = self._tuner.estimate_tuning_parameters(suggestions)
@@ -208,54 +592,212 @@ class MMTDecoder(object):
 
         # Run tuning
         if learning_rate > 0. and epochs > 0:
-            sub_dict = self._checkpoint.subword_dictionary
+            tuned_state = self._tuned_states.get(tuning_key) \
+                if self._tuned_states is not None and tuning_key is not None else None
+
+            if tuned_state is not None:
+                self._materialize_parameters(tuned_state.keys())
 
-            if self._checkpoint.multilingual_target:
-                src_samples = [sub_dict.language_tag(e.target_lang) + ' ' + e.segment for e in suggestions]
+                with torch.no_grad():
+                    for name, param in self._model.named_parameters():
+                        if name in tuned_state:
+                            param.copy_(tuned_state[name])
             else:
-                src_samples = [e.segment for e in suggestions]
-            tgt_samples = [e.translation for e in suggestions]
+                sub_dict = self._checkpoint.subword_dictionary
+
+                if self._checkpoint.multilingual_target:
+                    src_samples = [sub_dict.language_tag(e.target_lang) + ' ' + e.segment for e in suggestions]
+                else:
+                    src_samples = [e.segment for e in suggestions]
+                tgt_samples = [e.translation for e in suggestions]
+
+                dataset = self._tuner.dataset(src_samples, tgt_samples, sub_dict)
+                self._materialize_parameters(self._tuner.tunable_parameter_names())
+                tuned_parameters = self._tuner.tune(dataset, num_iterations=epochs, lr=learning_rate)
+
+                if self._tuned_states is not None and tuning_key is not None:
+                    self._tuned_states[tuning_key] = {name: param.detach().clone()
+                                                      for name, param in self._model.named_parameters()
+                                                      if name in tuned_parameters}
 
-            dataset = self._tuner.dataset(src_samples, tgt_samples, sub_dict)
-            self._tuner.tune(dataset, num_iterations=epochs, lr=learning_rate)
+            self._tuning_key = tuning_key
             self._nn_needs_reset = True
 
-    def _decode(self, source_lang, target_lang, segments):
-        prefix_lang = target_lang if self._checkpoint.multilingual_target else None
-        batch, input_indexes, sentence_len = self._make_decode_batch(segments, prefix_lang=prefix_lang)
+    def _get_translator(self, nbest):
+        # SequenceGenerator returns at most beam_size hypotheses, hence the beam is enlarged if needed
+        beam_size = max(self._beam_size, nbest)
+
+        if beam_size not in self._translators:
+            self._translators[beam_size] = self._create_translator(self._checkpoints, beam_size,
+                                                                   self._decoder_ops.generator)
+
+        return self._translators[beam_size]
+
+    def _decode(self, source_lang, target_langs, segments, nbest=1, src_tokens=None, use_cache=True, model=None,
+                alignment=True):
+        prefix_langs = self._prefix_langs(self._checkpoint, target_langs)
+        if src_tokens is None:
+            src_tokens = self._encode(self._checkpoint, segments, prefix_langs=prefix_langs)
+
+        # Only 1-best translations of the original checkpoint (not tuned) are cached
+        use_cache = use_cache and self._cache is not None and nbest == 1
+
+        # Lookup cache and collapse duplicated segments
+        results = [None] * len(segments)
+        positions = OrderedDict()
+
+        for i, segment in enumerate(segments):
+            translation = self._cache.lookup((self._checkpoint, source_lang, target_langs[i], segment, alignment)) \
+                if use_cache else None
 
-        # Compute translation
-        self._translator.max_len_b = self._checkpoint.decode_length(source_lang, target_lang, sentence_len)
-        translations = self._translator.generate([self._model], batch)
+            if translation is not None:
+                results[i] = translation
+            else:
+                positions.setdefault((segment, target_langs[i]), []).append(i)
+
+        # Decode missing translations
+        indexes = [e[0] for e in positions.values()]
+        if len(indexes) > 0:
+            self._set_need_attn(model or self._model, alignment)
+
+        for bucket in self._make_buckets([src_tokens[i].numel() for i in indexes]):
+            bucket = [indexes[i] for i in bucket]
+            bucket_results = self._decode_bucket(source_lang, [target_langs[i] for i in bucket],
+                                                 [segments[i] for i in bucket], [src_tokens[i] for i in bucket],
+                                                 prefix_langs=[prefix_langs[i] for i in bucket],
+                                                 nbest=nbest, model=model, alignment=alignment)
+            for i, translation in zip(bucket, bucket_results):
+                for j in positions[(segments[i], target_langs[i])]:
+                    results[j] = translation
+
+                if use_cache:
+                    self._cache[(self._checkpoint, source_lang, target_langs[i], segments[i], alignment)] = translation
+
+        return results
+
+    def _decode_bucket(self, source_lang, target_langs, segments, src_tokens, prefix_langs, nbest=1, model=None,
+                       alignment=True):
+        batch, input_indexes, sentence_len = self._make_decode_batch(src_tokens)
+
+        # Compute translation (the max length is the one of the target language allowing the longest output)
+        translator = self._get_translator(nbest)
+        translator.max_len_b = max([self._checkpoint.decode_length(source_lang, target_lang, sentence_len)
+                                    for target_lang in set(target_langs)])
+
+        translations = self._generate(translator, model or self._model, batch, src_tokens)
 
         # Decode translation
-        sub_dict = self._checkpoint.subword_dictionary
+        attentions = iter(self._to_numpy([hypo['attention'] for hypos in translations for hypo in hypos[:nbest]])
+                          if alignment else [])
 
         results = []
-        for i, hypo in enumerate(translations):
-            hypo = hypo[0]  # (top-1 best nbest)
-            hypo_score = math.exp(hypo['score'])
-            hypo_tokens = hypo['tokens']
-            hypo_indexes = sub_dict.indexes_of(hypo_tokens)
-            hypo_str = sub_dict.string(hypo_tokens)
-            hypo_attention = np.asarray(hypo['attention'].data.cpu())
-
-            # Make alignment
-            if len(hypo_indexes) > 0:
-                hypo_alignment = make_alignment(input_indexes[i], hypo_indexes, hypo_attention,
-                                                prefix_lang=prefix_lang is not None)
-                hypo_alignment = clean_alignment(hypo_alignment, segments[i], hypo_str)
-            else:
-                hypo_alignment = []
+        for i, hypos in enumerate(translations):
+            self._generated_tokens += len(hypos[0]['tokens'])
+            hypos = [self._make_translation(hypo, next(attentions, None), input_indexes[i], segments[i],
+                                            prefix_lang=prefix_langs[i])
+                     for hypo in hypos[:nbest]]
 
-            results.append(Translation(hypo_str, alignment=hypo_alignment, score=hypo_score))
+            best = hypos[0]  # (top-1 best nbest)
+            results.append(Translation(best.text, alignment=best._alignment, score=best.score,
+                                       nbest=hypos if nbest > 1 else None))
 
         return results
 
-    def _force_decode(self, target_lang, segments, translations):
-        prefix_lang = target_lang if self._checkpoint.multilingual_target else None
+    def _generate(self, translator, model, batch, src_tokens):
+        shortlist = self._checkpoint.shortlist if self._decoder_ops.output_shortlist else None
+
+        if shortlist is not None:
+            self._restrict_output_layer(model, shortlist.candidates(src_tokens))
+            try:
+                return translator.generate([model], batch)
+            finally:
+                del model.decoder.output_layer
+        else:
+            return translator.generate([model], batch)
 
-        batch = self._make_force_decode_batch(segments, translations, prefix_lang=prefix_lang)
+    def _restrict_output_layer(self, model, candidates):
+        # the output projection is computed over the candidate ids only, then scores are scattered back
+        # to their original ids; all the other entries are set to -inf (thus never generated)
+        decoder = model.decoder
+        weight = decoder.embed_tokens.weight if decoder.share_input_output_embed else decoder.embed_out
+
+        if self._device is not None:
+            candidates = candidates.cuda(self._device)
+        candidates_weight = weight.index_select(0, candidates)
+
+        def output_layer(features, **_):
+            logits = features.new_full(features.shape[:-1] + (weight.size(0),), float('-inf'))
+            return logits.index_copy_(logits.dim() - 1, candidates,
+                                      torch.nn.functional.linear(features, candidates_weight))
+
+        decoder.output_layer = output_layer  # instance attribute, it shadows the class method until deleted
+
+    @staticmethod
+    def _set_need_attn(model, need_attn):
+        # fairseq decoder layers compute (and return) the encoder-decoder attention only if "need_attn" is set
+        for module in model.modules():
+            if hasattr(module, 'need_attn'):
+                module.need_attn = need_attn
+
+    @staticmethod
+    def _to_numpy(tensors):
+        # device tensors (of any shape) are moved to host with a single transfer, flattened and concatenated
+        if len(tensors) == 0 or not tensors[0].is_cuda:
+            return [np.asarray(tensor.data.cpu()) for tensor in tensors]
+
+        data = np.asarray(torch.cat([tensor.data.reshape(-1) for tensor in tensors]).cpu())
+        chunks = np.split(data, np.cumsum([tensor.numel() for tensor in tensors])[:-1])
+        return [chunk.reshape(tuple(tensor.shape)) for chunk, tensor in zip(chunks, tensors)]
+
+    def _make_translation(self, hypo, hypo_attention, input_indexes, segment, prefix_lang=None):
+        sub_dict = self._checkpoint.subword_dictionary
+
+        hypo_score = math.exp(hypo['score'])
+        hypo_tokens = hypo['tokens']
+        hypo_indexes = sub_dict.indexes_of(hypo_tokens)
+        hypo_str = sub_dict.string(hypo_tokens)
+
+        # Make alignment (deferred, it is computed only when accessed the first time)
+        if hypo_attention is None:
+            hypo_alignment = None
+        elif len(hypo_indexes) > 0:
+            hypo_alignment = functools.lru_cache(maxsize=1)(
+                functools.partial(self._make_alignment, input_indexes, hypo_indexes, hypo_attention,
+                                  segment, hypo_str, prefix_lang=prefix_lang))
+            hypo_alignment.nbytes = hypo_attention.nbytes  # see TranslationCache._sizeof()
+        else:
+            hypo_alignment = []
+
+        return Translation(hypo_str, alignment=hypo_alignment, score=hypo_score)
+
+    def _make_alignment(self, src_indexes, tgt_indexes, attention, source, target, prefix_lang=None):
+        alignment = make_alignment(src_indexes, tgt_indexes, attention, prefix_lang=prefix_lang is not None,
+                                   symmetrize=self._symmetrize)
+        return clean_alignment(alignment, source, target)
+
+    def _force_decode(self, target_langs, segments, translations, src_tokens=None, trg_tokens=None):
+        prefix_langs = self._prefix_langs(self._checkpoint, target_langs)
+        if src_tokens is None:
+            src_tokens = self._encode(self._checkpoint, segments, prefix_langs=prefix_langs)
+        if trg_tokens is None:
+            trg_tokens = self._encode(self._checkpoint, translations)
+
+        self._generated_tokens += sum(tokens.numel() for tokens in trg_tokens)
+
+        results = [None] * len(segments)
+        for bucket in self._make_buckets([s.numel() + t.numel() for s, t in zip(src_tokens, trg_tokens)]):
+            bucket_results = self._force_decode_bucket([segments[i] for i in bucket],
+                                                       [translations[i] for i in bucket],
+                                                       [src_tokens[i] for i in bucket],
+                                                       [trg_tokens[i] for i in bucket],
+                                                       [prefix_langs[i] for i in bucket])
+            for i, translation in zip(bucket, bucket_results):
+                results[i] = translation
+
+        return results
+
+    def _force_decode_bucket(self, segments, translations, src_tokens, trg_tokens, prefix_langs):
+        batch = self._make_force_decode_batch(src_tokens, trg_tokens)
 
         src_tokens = batch['src_tokens']
         tgt_tokens = batch['trg_tokens']
@@ -269,28 +811,78 @@ class MMTDecoder(object):
             tgt_tokens = tgt_tokens.cuda(self._device)
 
         self._model.eval()
+        self._set_need_attn(self._model, True)
         _, attn = self._model(src_tokens, src_lengths, tgt_tokens)
         if type(attn) is dict:
             attn = attn['attn']
 
+        attn = attn.cpu()  # a single device-to-host transfer for the whole batch
+
         results = []
         for i, hypo_attention in enumerate(attn):  # for each entry of the original batch
-            hypo_attention = hypo_attention.transpose(0, 1).cpu()
+            hypo_attention = hypo_attention.transpose(0, 1)
             hypo_attention = hypo_attention[hypo_attention.size(0) - (len(src_indexes[i]) + 1):,
                              hypo_attention.size(1) - (len(tgt_indexes[i]) + 1):]
 
-            # Make alignment
-            hypo_alignment = make_alignment(src_indexes[i], tgt_indexes[i], hypo_attention.data.numpy(),
-                                            prefix_lang=prefix_lang is not None)
-
-            hypo_alignment = clean_alignment(hypo_alignment, segments[i], translations[i])
+            # Make alignment (deferred, it is computed only when accessed the first time)
+            hypo_alignment = functools.partial(self._make_alignment, src_indexes[i], tgt_indexes[i],
+                                               hypo_attention.data.numpy(), segments[i], translations[i],
+                                               prefix_lang=prefix_langs[i])
 
             results.append(Translation(translations[i], alignment=hypo_alignment))
 
         return results
 
-    def _make_decode_batch(self, segments, prefix_lang=None):
-        src_tokens, src_indexes, src_lengths, src_max_length = self._make_batch(segments, prefix_lang=prefix_lang)
+    def _make_buckets(self, lengths):
+        # Group entries of similar length, so that padding is minimized and each group
+        # can be decoded with its own max length; the padded size of every bucket
+        # (entries * longest entry) never exceeds max_batch_tokens, unless it holds a single entry
+        buckets = []
+        bucket, bucket_max_len = [], 0
+
+        for i in sorted(range(len(lengths)), key=lambda k: lengths[k]):
+            if len(bucket) > 0 and (len(bucket) + 1) * max(bucket_max_len, lengths[i]) > self._max_batch_tokens:
+                buckets.append(bucket)
+                bucket, bucket_max_len = [], 0
+
+            bucket.append(i)
+            bucket_max_len = max(bucket_max_len, lengths[i])
+
+        if len(bucket) > 0:
+            buckets.append(bucket)
+
+        return buckets
+
+    @staticmethod
+    def _target_langs(target_lang, batch):
+        # the target language of every segment, "target_lang" is either a single language or a list of them
+        if isinstance(target_lang, str):
+            return [target_lang] * len(batch)
+
+        if len(target_lang) != len(batch):
+            raise ValueError('Number of inputs and target languages differs (%d vs %d)' %
+                             (len(batch), len(target_lang)))
+        return list(target_lang)
+
+    @staticmethod
+    def _prefix_langs(checkpoint, target_langs):
+        # the language prefix of every segment (if multilingual target)
+        return list(target_langs) if checkpoint.multilingual_target else [None] * len(target_langs)
+
+    @staticmethod
+    def _encode(checkpoint, entries, prefix_langs=None):
+        sub_dict = checkpoint.subword_dictionary
+
+        # Add language prefix if multilingual target
+        if prefix_langs is not None:
+            entries = [text if lang is None else sub_dict.language_tag(lang) + ' ' + text
+                       for text, lang in zip(entries, prefix_langs)]
+
+        return [sub_dict.encode_line(text, line_tokenizer=sub_dict.tokenize, add_if_not_exist=False).long()
+                for text in entries]
+
+    def _make_decode_batch(self, src_tokens):
+        src_tokens, src_indexes, src_lengths, src_max_length = self._make_batch(src_tokens)
 
         batch = {'net_input': {
             'src_tokens': src_tokens,
@@ -299,9 +891,9 @@ class MMTDecoder(object):
 
         return batch, src_indexes, src_max_length
 
-    def _make_force_decode_batch(self, segments, translations, prefix_lang=None):
-        src_tokens, src_indexes, src_lengths, _ = self._make_batch(segments, prefix_lang=prefix_lang)
-        trg_tokens, trg_indexes, _, _ = self._make_batch(translations, reverse_last_word=True)
+    def _make_force_decode_batch(self, src_tokens, trg_tokens):
+        src_tokens, src_indexes, src_lengths, _ = self._make_batch(src_tokens)
+        trg_tokens, trg_indexes, _, _ = self._make_batch(trg_tokens, reverse_last_word=True)
 
         return {
             'src_tokens': src_tokens,
@@ -311,42 +903,35 @@ class MMTDecoder(object):
             'src_lengths': src_lengths
         }
 
-    def _make_batch(self, entries, prefix_lang=None, reverse_last_word=False):
-        # Add language prefix if multilingual target
-        if prefix_lang is not None:
-            entries = [self._checkpoint.subword_dictionary.language_tag(prefix_lang) + ' ' + text for text in entries]
-
+    def _make_batch(self, tokens, reverse_last_word=False):
         # Prepare batch
-        if len(entries) > 0:
+        if len(tokens) > 0:
             sub_dict = self._checkpoint.subword_dictionary
 
-            tokens = [
-                sub_dict.encode_line(text, line_tokenizer=sub_dict.tokenize, add_if_not_exist=False).long()
-                for text in entries
-            ]
             indexes = [sub_dict.indexes_of(el) for el in tokens]
             lengths = torch.LongTensor([t.numel() for t in tokens])
 
             if reverse_last_word:
                 tokens = [torch.cat((text[-1:], text[:-1])) for text in tokens]
         else:
-            tokens = torch.LongTensor([[textencoder.EOS_ID]])
+            tokens = [torch.LongTensor([textencoder.EOS_ID])]
             indexes = [[]]
             lengths = torch.LongTensor([1])
 
+        batch_size = len(tokens)
         max_length = torch.max(lengths)
 
         # Apply padding
-        if len(entries) > 1:
+        if batch_size > 1:
             tokens = [torch.nn.functional.pad(el, (max_length - el.size(0), 0), value=sub_dict.pad()) for el in tokens]
 
         # Reshape tokens tensor
-        if len(entries) > 1:
+        if batch_size > 1:
             tokens = torch.cat(tokens)
         else:
             tokens = tokens[0]
 
-        tokens = tokens.reshape([max(1, len(entries)), max_length])
+        tokens = tokens.reshape([batch_size, max_length])
 
         if self._device is not None:
             tokens = tokens.cuda(self._device)
@@ -0,0 +1,143 @@
+import math
+
+import torch
+
+
+class BeamSearch(object):
+    """
+    Beam search specialized for the single-model, small-batch case of the decoder: same results and output format
+    of fairseq SequenceGenerator (beam search, stop early, normalized scores), without its generic bookkeeping.
+    Beams are kept in preallocated (double) buffers, rows are reordered and finished sentences are compacted out
+    of the batch with a single index_select per buffer and step.
+    """
+
+    def __init__(self, tgt_dict, beam_size=5, max_len_a=0, max_len_b=200, min_len=1,
+                 normalize_scores=True, len_penalty=1., unk_penalty=0.):
+        self.pad = tgt_dict.pad()
+        self.unk = tgt_dict.unk()
+        self.eos = tgt_dict.eos()
+        self.vocab_size = len(tgt_dict)
+        self.beam_size = min(beam_size, self.vocab_size - 1)
+        self.max_len_a = max_len_a
+        self.max_len_b = max_len_b
+        self.min_len = min_len
+        self.normalize_scores = normalize_scores
+        self.len_penalty = len_penalty
+        self.unk_penalty = unk_penalty
+
+    @torch.no_grad()
+    def generate(self, models, sample, **_):
+        if len(models) != 1:
+            raise ValueError('BeamSearch supports a single model only')
+
+        model = models[0]
+        model.eval()
+
+        encoder_input = {k: v for k, v in sample['net_input'].items() if k != 'prev_output_tokens'}
+        src_tokens = encoder_input['src_tokens']
+        bsz, src_len = src_tokens.size()
+        beam, eos = self.beam_size, self.eos
+        max_len = min(int(self.max_len_a * src_len + self.max_len_b), model.max_decoder_positions() - 1)
+
+        # (1) Encode and replicate the encoder output for every beam
+        rows = torch.arange(bsz, device=src_tokens.device).view(-1, 1).repeat(1, beam).view(-1)
+        encoder_out = model.encoder.reorder_encoder_out(model.encoder(**encoder_input), rows)
+        incremental_state = {}
+
+        tokens = src_tokens.new_full((bsz * beam, max_len + 2), self.pad)
+        tokens[:, 0] = eos
+        tokens_buf = tokens.clone()
+        attn, attn_buf = None, None
+        beam_scores = None  # cumulative score of every beam (after step 0)
+
+        sentences = list(range(bsz))  # original index of every sentence still in the batch
+        nonpad = src_tokens.ne(self.pad)
+        finalized = [[] for _ in range(bsz)]
+
+        for step in range(max_len + 1):
+            # (2) Decode next token of every beam
+            logits, extra = model.decoder(tokens[:, :step + 1], encoder_out, incremental_state=incremental_state)
+            lprobs = model.get_normalized_probs((logits[:, -1:, :], extra), log_probs=True)[:, -1, :]
+
+            lprobs[:, self.pad] = -math.inf
+            if self.unk_penalty != 0:
+                lprobs[:, self.unk] -= self.unk_penalty
+            if step >= max_len:
+                lprobs[:, :eos] = -math.inf
+                lprobs[:, eos + 1:] = -math.inf
+            if step < self.min_len:
+                lprobs[:, eos] = -math.inf
+
+            step_attn = extra.get('attn') if isinstance(extra, dict) else extra
+            if step_attn is not None:
+                if attn is None:
+                    attn = lprobs.new_zeros(bsz * beam, src_len, max_len + 2)
+                    attn_buf = attn.clone()
+                attn[:, :, step + 1].copy_(step_attn[:, -1, :])
+
+            # (3) Select the top 2 * beam candidates of every sentence
+            batch_size = len(sentences)
+            if step == 0:
+                lprobs = lprobs.view(batch_size, beam, -1)[:, 0, :]
+            else:
+                lprobs = lprobs.add_(beam_scores.unsqueeze(-1)).view(batch_size, -1)
+
+            cand_scores, cand_indices = torch.topk(lprobs, k=min(2 * beam, lprobs.size(1) - 1))
+            cand_beams = cand_indices // self.vocab_size
+            cand_tokens = cand_indices.fmod(self.vocab_size)
+            cand_rows = cand_beams + (torch.arange(batch_size, device=cand_beams.device) * beam).unsqueeze(1)
+
+            # (4) Finalize hypotheses ending with eos among the top beam candidates
+            eos_mask = cand_tokens.eq(eos)
+            finished = set()
+
+            if step >= self.min_len and eos_mask[:, :beam].any():
+                eos_rows = cand_rows[:, :beam][eos_mask[:, :beam]].tolist()
+                eos_scores = cand_scores[:, :beam][eos_mask[:, :beam]].tolist()
+                length = (step + 1) ** self.len_penalty if self.normalize_scores else 1.
+
+                for row, score in zip(eos_rows, eos_scores):
+                    i = row // beam
+                    sentence = sentences[i]
+                    if len(finalized[sentence]) >= beam:
+                        continue
+
+                    hypo_tokens = tokens[row, 1:step + 2].clone()
+                    hypo_tokens[step] = eos
+                    hypo_attn = attn[row, :, 1:step + 2][nonpad[sentence]] if attn is not None else None
+
+                    finalized[sentence].append({'tokens': hypo_tokens, 'score': score / length,
+                                                'attention': hypo_attn})
+                    if len(finalized[sentence]) == beam:
+                        finished.add(i)
+
+            if len(finished) == batch_size:
+                break
+
+            # (5) Compact finished sentences out of the batch
+            if len(finished) > 0:
+                active = [i for i in range(batch_size) if i not in finished]
+                active = torch.tensor(active, dtype=torch.long, device=cand_rows.device)
+
+                eos_mask, cand_scores = eos_mask[active], cand_scores[active]
+                cand_tokens, cand_rows = cand_tokens[active], cand_rows[active]
+                sentences = [s for i, s in enumerate(sentences) if i not in finished]
+
+            # (6) Keep the top beam candidates not ending with eos, reorder buffers and decoder state
+            cand_offsets = torch.arange(eos_mask.size(1), device=eos_mask.device)
+            _, active_hypos = torch.topk(eos_mask.long() * eos_mask.size(1) + cand_offsets, k=beam, largest=False)
+
+            reorder = cand_rows.gather(1, active_hypos).view(-1)
+            beam_scores = cand_scores.gather(1, active_hypos).view(-1)
+
+            # rows are gathered into the spare buffer (the batch only shrinks, so its first rows are enough)
+            tokens, tokens_buf = torch.index_select(tokens, 0, reorder, out=tokens_buf[:reorder.numel()]), tokens
+            tokens[:, step + 1] = cand_tokens.gather(1, active_hypos).view(-1)
+
+            if attn is not None:
+                attn, attn_buf = torch.index_select(attn, 0, reorder, out=attn_buf[:reorder.numel()]), attn
+
+            model.decoder.reorder_incremental_state(incremental_state, reorder)
+            encoder_out = model.encoder.reorder_encoder_out(encoder_out, reorder)
+
+        return [sorted(hypos, key=lambda hypo: hypo['score'], reverse=True) for hypos in finalized]
@@ -0,0 +1,408 @@
+import copy
+import json
+import logging
+import os
+import time
+
+import torch
+import torch.nn.functional as F
+from fairseq.models.transformer import TransformerModel
+from fairseq.modules import LearnedPositionalEmbedding, SinusoidalPositionalEmbedding
+
+from mmt.checkpoint import CheckpointRegistry
+from mmt.decoder import MMTDecoder, DecoderOptions, ModelConfig
+
+
+def _split_heads(x, num_heads):
+    # (T x B x C) -> (B x H x T x D)
+    length, bsz, embed_dim = x.size()
+    return x.contiguous().view(length, bsz, num_heads, embed_dim // num_heads).permute(1, 2, 0, 3)
+
+
+def _attention(attn, q, k, v, key_padding_mask=None):
+    # same computation of fairseq MultiheadAttention, with keys and values already split in heads (B x H x T x D)
+    q = _split_heads(attn.in_proj_q(q) * attn.scaling, attn.num_heads)
+
+    weights = torch.matmul(q, k.transpose(2, 3))
+    if key_padding_mask is not None:
+        weights = weights.masked_fill(key_padding_mask.unsqueeze(1).unsqueeze(2), float('-inf'))
+    weights = F.softmax(weights.float(), dim=-1).type_as(weights)
+
+    x = torch.matmul(weights, v)  # B x H x 1 x D
+    x = attn.out_proj(x.permute(2, 0, 1, 3).reshape(1, x.size(0), attn.embed_dim))
+
+    return x, weights.mean(dim=1)
+
+
+class _EncoderGraph(torch.nn.Module):
+    """
+    Encoder graph: it returns the keys and values of the encoder-decoder attention of every decoder layer
+    (L x B x H x S x D), so that they are computed just once per batch, and the source padding mask.
+    """
+
+    def __init__(self, model):
+        super().__init__()
+        self.encoder = model.encoder
+        self.layers = model.decoder.layers
+
+    def forward(self, src_tokens):
+        encoder_out = self.encoder(src_tokens, None)['encoder_out']  # lengths are not used by the encoder
+
+        keys, values = [], []
+        for layer in self.layers:
+            attn = layer.encoder_attn
+            keys.append(_split_heads(attn.in_proj_k(encoder_out), attn.num_heads))
+            values.append(_split_heads(attn.in_proj_v(encoder_out), attn.num_heads))
+
+        return torch.stack(keys), torch.stack(values), src_tokens.eq(self.encoder.padding_idx)
+
+    @staticmethod
+    def sample(pad):
+        # traced with a padded batch, so that the padding mask is part of the graph
+        return torch.LongTensor([[pad, 5, 6, 2], [7, 8, 9, 2]]),
+
+
+class _DecoderStepGraph(torch.nn.Module):
+    """
+    Single decoder step with explicit state: given the last token of every beam and the self-attention keys and
+    values of the previous steps (L x N x H x T x D), it returns the log-probabilities of the next token, the
+    encoder-decoder attention of the last layer (averaged over heads) and the updated self-attention state.
+    """
+
+    def __init__(self, model):
+        super().__init__()
+        decoder = model.decoder
+        if decoder.adaptive_softmax is not None:
+            raise ValueError('Adaptive softmax is not supported')
+
+        self.decoder = decoder
+        self.padding_idx = decoder.embed_tokens.padding_idx
+
+        positions = decoder.embed_positions
+        if positions is None:
+            table = None
+        elif isinstance(positions, LearnedPositionalEmbedding):
+            table = positions.weight.detach()
+        else:
+            table = SinusoidalPositionalEmbedding.get_embedding(
+                decoder.max_positions() + self.padding_idx + 1, positions.embedding_dim, self.padding_idx)
+        self.register_buffer('positions', table)
+
+    def forward(self, tokens, self_keys, self_values, encoder_keys, encoder_values, encoder_padding_mask):
+        decoder = self.decoder
+
+        x = decoder.embed_scale * decoder.embed_tokens(tokens)
+        if decoder.project_in_dim is not None:
+            x = decoder.project_in_dim(x)
+        if self.positions is not None:
+            step = torch.full((1,), self_keys.size(3), dtype=torch.long) + self.padding_idx + 1
+            x = x + self.positions.index_select(0, step)
+
+        x = x.transpose(0, 1)  # 1 x N x C
+
+        keys, values, attn = [], [], None
+        for i, layer in enumerate(decoder.layers):
+            # (1) self-attention, appending this step to the cached keys and values
+            residual = x
+            x = layer.maybe_layer_norm(layer.self_attn_layer_norm, x, before=True)
+
+            _, k, v = layer.self_attn.in_proj_qkv(x)
+            k = torch.cat([self_keys[i], _split_heads(k, layer.self_attn.num_heads)], dim=2)
+            v = torch.cat([self_values[i], _split_heads(v, layer.self_attn.num_heads)], dim=2)
+            keys.append(k)
+            values.append(v)
+
+            x, _ = _attention(layer.self_attn, x, k, v)
+            x = residual + x
+            x = layer.maybe_layer_norm(layer.self_attn_layer_norm, x, after=True)
+
+            # (2) encoder-decoder attention
+            residual = x
+            x = layer.maybe_layer_norm(layer.encoder_attn_layer_norm, x, before=True)
+            x, attn = _attention(layer.encoder_attn, x, encoder_keys[i], encoder_values[i],
+                                 key_padding_mask=encoder_padding_mask)
+            x = residual + x
+            x = layer.maybe_layer_norm(layer.encoder_attn_layer_norm, x, after=True)
+
+            # (3) feed-forward
+            residual = x
+            x = layer.maybe_layer_norm(layer.final_layer_norm, x, before=True)
+            x = layer.fc2(layer.activation_fn(layer.fc1(x)))
+            x = residual + x
+            x = layer.maybe_layer_norm(layer.final_layer_norm, x, after=True)
+
+        if decoder.layer_norm is not None:
+            x = decoder.layer_norm(x)
+
+        x = x.transpose(0, 1)
+        if decoder.project_out_dim is not None:
+            x = decoder.project_out_dim(x)
+
+        lprobs = F.log_softmax(decoder.output_layer(x).float(), dim=-1)
+
+        return lprobs[:, -1, :], attn[:, -1, :], torch.stack(keys), torch.stack(values)
+
+    def sample(self, encoder_keys, encoder_values, encoder_padding_mask):
+        num_layers, bsz, num_heads, _, head_dim = encoder_keys.size()
+        tokens = torch.LongTensor([[5], [6]])
+        state = encoder_keys.new_zeros(num_layers, bsz, num_heads, 3, head_dim)
+
+        return tokens, state, state.clone(), encoder_keys, encoder_values, encoder_padding_mask
+
+
+class ONNXModel(object):
+    """
+    Encoder and decoder-step graphs running on ONNX Runtime, exposing the (small) subset of the fairseq
+    model interface used by mmt.generator.BeamSearch. A manifest records the source files and the embeddings
+    size the graphs have been exported from: the graphs are stale as soon as "model.pt" or "model.vcb" change.
+    """
+
+    VERSION = 1
+    ENCODER_FILENAME = 'model.encoder.onnx'
+    DECODER_FILENAME = 'model.decoder.onnx'
+    MANIFEST_FILENAME = 'model.onnx.json'
+
+    @staticmethod
+    def _sources(checkpoint_path):
+        sources = {}
+        for filename in ['model.pt', 'model.vcb']:
+            stat = os.stat(os.path.join(checkpoint_path, filename))
+            sources[filename] = [stat.st_size, stat.st_mtime_ns]
+        return sources
+
+    @classmethod
+    def exists(cls, checkpoint_path):
+        return os.path.isfile(os.path.join(checkpoint_path, cls.ENCODER_FILENAME)) and \
+               os.path.isfile(os.path.join(checkpoint_path, cls.DECODER_FILENAME))
+
+    @classmethod
+    def is_valid(cls, checkpoint_path, embeddings_size):
+        if not cls.exists(checkpoint_path):
+            return False
+
+        try:
+            with open(os.path.join(checkpoint_path, cls.MANIFEST_FILENAME), 'r', encoding='utf-8') as stream:
+                manifest = json.load(stream)
+
+            return manifest['version'] == cls.VERSION and manifest['sources'] == cls._sources(checkpoint_path) and \
+                manifest['embeddings_size'] == embeddings_size
+        except (IOError, ValueError, KeyError):
+            return False
+
+    @classmethod
+    def export(cls, model, checkpoint_path, opset_version=11):
+        manifest_path = os.path.join(checkpoint_path, cls.MANIFEST_FILENAME)
+        if os.path.isfile(manifest_path):  # the graphs are not valid until the export completes
+            os.remove(manifest_path)
+
+        manifest = {
+            'version': cls.VERSION,
+            'sources': cls._sources(checkpoint_path),
+            'embeddings_size': model.encoder.embed_tokens.num_embeddings
+        }
+
+        model = copy.deepcopy(model).float()
+        model.eval()
+        model.prepare_for_onnx_export_()
+
+        encoder, decoder = _EncoderGraph(model), _DecoderStepGraph(model)
+
+        with torch.no_grad():
+            encoder_sample = encoder.sample(model.encoder.padding_idx)
+            decoder_sample = decoder.sample(*encoder(*encoder_sample))
+
+            torch.onnx.export(encoder, encoder_sample, os.path.join(checkpoint_path, cls.ENCODER_FILENAME),
+                              input_names=['src_tokens'],
+                              output_names=['encoder_keys', 'encoder_values', 'encoder_padding_mask'],
+                              dynamic_axes={
+                                  'src_tokens': {0: 'batch', 1: 'source'},
+                                  'encoder_keys': {1: 'batch', 3: 'source'},
+                                  'encoder_values': {1: 'batch', 3: 'source'},
+                                  'encoder_padding_mask': {0: 'batch', 1: 'source'},
+                              }, opset_version=opset_version)
+
+            torch.onnx.export(decoder, decoder_sample, os.path.join(checkpoint_path, cls.DECODER_FILENAME),
+                              input_names=['tokens', 'self_keys', 'self_values',
+                                           'encoder_keys', 'encoder_values', 'encoder_padding_mask'],
+                              output_names=['lprobs', 'attn', 'new_self_keys', 'new_self_values'],
+                              dynamic_axes={
+                                  'tokens': {0: 'beams'},
+                                  'self_keys': {1: 'beams', 3: 'steps'},
+                                  'self_values': {1: 'beams', 3: 'steps'},
+                                  'encoder_keys': {1: 'beams', 3: 'source'},
+                                  'encoder_values': {1: 'beams', 3: 'source'},
+                                  'encoder_padding_mask': {0: 'beams', 1: 'source'},
+                                  'lprobs': {0: 'beams'},
+                                  'attn': {0: 'beams', 1: 'source'},
+                                  'new_self_keys': {1: 'beams', 3: 'steps_plus_one'},
+                                  'new_self_values': {1: 'beams', 3: 'steps_plus_one'},
+                              }, opset_version=opset_version)
+
+        with open(manifest_path + '.tmp', 'w', encoding='utf-8') as stream:
+            json.dump(manifest, stream)
+        os.replace(manifest_path + '.tmp', manifest_path)
+
+    @classmethod
+    def load(cls, checkpoint_path, max_positions, num_threads=None):
+        import onnxruntime
+
+        options = onnxruntime.SessionOptions()
+        if num_threads is not None:
+            options.intra_op_num_threads = num_threads
+        # between two runs the beam search uses the torch thread pool: spinning ORT threads would compete with it
+        options.add_session_config_entry('session.intra_op.allow_spinning', '0')
+
+        encoder = onnxruntime.InferenceSession(os.path.join(checkpoint_path, cls.ENCODER_FILENAME), options)
+        decoder = onnxruntime.InferenceSession(os.path.join(checkpoint_path, cls.DECODER_FILENAME), options)
+
+        return cls(encoder, decoder, max_positions)
+
+    def __init__(self, encoder_session, decoder_session, max_positions):
+        self.encoder = _ONNXEncoder(encoder_session)
+        self.decoder = _ONNXDecoder(decoder_session)
+        self._max_positions = max_positions
+
+    def eval(self):
+        pass
+
+    def max_decoder_positions(self):
+        return self._max_positions
+
+    @staticmethod
+    def get_normalized_probs(net_output, log_probs):
+        if not log_probs:
+            raise ValueError('ONNXModel computes log-probabilities only')
+        return net_output[0]  # the decoder graph already returns log-probabilities
+
+
+class _ONNXEncoder(object):
+    def __init__(self, session):
+        self._session = session
+
+    def __call__(self, src_tokens, **_):
+        keys, values, padding_mask = self._session.run(None, {'src_tokens': src_tokens.numpy()})
+
+        return {
+            'encoder_keys': torch.from_numpy(keys),
+            'encoder_values': torch.from_numpy(values),
+            'encoder_padding_mask': torch.from_numpy(padding_mask),
+        }
+
+    @staticmethod
+    def reorder_encoder_out(encoder_out, new_order):
+        return {
+            'encoder_keys': encoder_out['encoder_keys'].index_select(1, new_order),
+            'encoder_values': encoder_out['encoder_values'].index_select(1, new_order),
+            'encoder_padding_mask': encoder_out['encoder_padding_mask'].index_select(0, new_order),
+        }
+
+
+class _ONNXDecoder(object):
+    def __init__(self, session):
+        self._session = session
+
+    def __call__(self, prev_output_tokens, encoder_out, incremental_state):
+        encoder_keys = encoder_out['encoder_keys']
+
+        if 'self_keys' not in incremental_state:
+            num_layers, beams, num_heads, _, head_dim = encoder_keys.size()
+            incremental_state['self_keys'] = encoder_keys.new_zeros(num_layers, beams, num_heads, 0, head_dim)
+            incremental_state['self_values'] = encoder_keys.new_zeros(num_layers, beams, num_heads, 0, head_dim)
+
+        lprobs, attn, keys, values = self._session.run(None, {
+            'tokens': prev_output_tokens[:, -1:].contiguous().numpy(),
+            'self_keys': incremental_state['self_keys'].numpy(),
+            'self_values': incremental_state['self_values'].numpy(),
+            'encoder_keys': encoder_keys.numpy(),
+            'encoder_values': encoder_out['encoder_values'].numpy(),
+            'encoder_padding_mask': encoder_out['encoder_padding_mask'].numpy(),
+        })
+
+        incremental_state['self_keys'] = torch.from_numpy(keys)
+        incremental_state['self_values'] = torch.from_numpy(values)
+
+        return torch.from_numpy(lprobs).unsqueeze(1), {'attn': torch.from_numpy(attn).unsqueeze(1)}
+
+    @staticmethod
+    def reorder_incremental_state(incremental_state, new_order):
+        for key in ['self_keys', 'self_values']:
+            incremental_state[key] = incremental_state[key].index_select(1, new_order)
+
+
+class ONNXDecoder(MMTDecoder):
+    """
+    Decoder running the beam search (mmt.generator.BeamSearch) on the ONNX Runtime graphs exported with
+    "mmt export-onnx"; requests with suggestions are decoded with PyTorch, as tuning changes the model parameters.
+    Checkpoints with stale graphs (exported from a different "model.pt" or vocabulary) are decoded with PyTorch too.
+    """
+
+    def __init__(self, checkpoints, device=None, decoder_ops=None, onnx_threads=None, **kwargs):
+        if device is not None:
+            raise ValueError('ONNX decoding is supported on CPU only')
+
+        # the beam search must run on the ONNX graphs too, thus the built-in generator is always used
+        decoder_ops = copy.copy(decoder_ops) if decoder_ops is not None else DecoderOptions()
+        decoder_ops.generator = 'builtin'
+
+        super().__init__(checkpoints, device=None, decoder_ops=decoder_ops, **kwargs)
+
+        self._onnx_threads = onnx_threads if onnx_threads is not None else torch.get_num_threads()
+        self._onnx_models = {}
+        self._logger = logging.getLogger('ONNXDecoder')
+
+    def _get_onnx_model(self):
+        checkpoint = self._checkpoint
+
+        if checkpoint not in self._onnx_models:
+            if not ONNXModel.exists(checkpoint.path):
+                raise IOError('ONNX graphs not found in %s, run "mmt export-onnx" first' % checkpoint.path)
+
+            if ONNXModel.is_valid(checkpoint.path, self._model.encoder.embed_tokens.num_embeddings):
+                begin = time.time()
+                self._onnx_models[checkpoint] = ONNXModel.load(checkpoint.path, self._model.max_decoder_positions(),
+                                                               num_threads=self._onnx_threads)
+                self._logger.info('ONNX graphs loaded: %s, load_time = %.3f' % (checkpoint, time.time() - begin))
+            else:
+                self._onnx_models[checkpoint] = None  # stale graphs, see _generate()
+
+        return self._onnx_models[checkpoint]
+
+    def _generate(self, translator, model, batch, src_tokens):
+        # a tuned model has parameters that differ from the exported graphs
+        if self._nn_needs_reset:
+            return super()._generate(translator, model, batch, src_tokens)
+
+        onnx_model = self._get_onnx_model()
+        if onnx_model is None:
+            self._logger.warning('ONNX graphs in %s do not match the checkpoint, decoding with PyTorch: '
+                                 'run "mmt export-onnx" again' % self._checkpoint.path)
+            return super()._generate(translator, model, batch, src_tokens)
+
+        return translator.generate([onnx_model], batch)
+
+
+def export(model_path, opset_version=11):
+    """
+    Export every checkpoint of the decoder model in "model_path" (the folder with "model.conf"), as loaded
+    by the decoder (embeddings resized to the largest vocabulary); it returns the exported checkpoint paths.
+    """
+    config = ModelConfig.load(model_path)
+
+    builder = CheckpointRegistry.Builder()
+    for name, checkpoint_path in config.checkpoints:
+        builder.register(name, checkpoint_path)
+    checkpoints = builder.build()
+
+    exported = []
+    for name, _ in config.checkpoints:
+        checkpoint = checkpoints.load(*name.split('__'))
+        if checkpoint.path in exported:
+            continue
+
+        model = TransformerModel.build_model(checkpoints.args, checkpoint.task)
+        model.load_state_dict(checkpoint.state, strict=True)
+
+        ONNXModel.export(model, checkpoint.path, opset_version=opset_version)
+        exported.append(checkpoint.path)
+
+    return exported
@@ -0,0 +1,154 @@
+import logging
+import os
+
+import numpy as np
+import torch
+
+
+class Shortlist(object):
+    """
+    Lexical shortlist of the target vocabulary: the output layer of the decoder can be restricted to the
+    most frequent target subwords plus the translation candidates of the subwords found in the source batch.
+    The per-source candidates are stored in CSR format: the candidates of source subword "i" are
+    targets[offsets[i]:offsets[i + 1]].
+    """
+
+    FILENAME = 'model.shortlist.npz'
+
+    class Builder(object):
+        def __init__(self, dictionary, frequent=1000, candidates=50, min_count=2, buffer_size=10000000):
+            self._dictionary = dictionary
+            self._vocab_size = len(dictionary)
+            self._frequent = frequent
+            self._candidates = candidates
+            self._min_count = min_count
+            self._buffer_size = buffer_size
+
+            self._tgt_freq = np.zeros(self._vocab_size, dtype=np.int64)  # occurrences
+            self._src_docs = np.zeros(self._vocab_size, dtype=np.int64)  # number of sentences containing the subword
+            self._tgt_docs = np.zeros(self._vocab_size, dtype=np.int64)
+
+            # co-occurrences (in the same sentence pair) of source and target subwords, keyed by src * V + tgt:
+            # every flush of the buffer adds a chunk of unique keys and counts, merged only once in build()
+            self._chunks = []
+            self._buffer = []
+            self._buffer_len = 0
+
+            self._logger = logging.getLogger('Shortlist.Builder')
+
+        def _encode(self, line):
+            return self._dictionary.encode_line(line.strip(), line_tokenizer=self._dictionary.tokenize,
+                                                add_if_not_exist=False, append_eos=False).numpy()
+
+        def add(self, source, target):
+            src_tokens, tgt_tokens = self._encode(source), self._encode(target)
+            if len(src_tokens) == 0 or len(tgt_tokens) == 0:
+                return
+
+            self._tgt_freq += np.bincount(tgt_tokens, minlength=self._vocab_size)
+
+            src_tokens, tgt_tokens = np.unique(src_tokens), np.unique(tgt_tokens)
+            self._src_docs[src_tokens] += 1
+            self._tgt_docs[tgt_tokens] += 1
+
+            self._buffer.append((src_tokens[:, None] * self._vocab_size + tgt_tokens[None, :]).ravel())
+            self._buffer_len += len(self._buffer[-1])
+
+            if self._buffer_len >= self._buffer_size:
+                self._flush()
+
+        def _flush(self):
+            if len(self._buffer) == 0:
+                return
+
+            keys, counts = np.unique(np.concatenate(self._buffer), return_counts=True)
+            self._chunks.append((keys, counts.astype(np.int64)))
+            self._buffer, self._buffer_len = [], 0
+
+        def _merge(self):
+            if len(self._chunks) == 0:
+                return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+
+            keys, inverse = np.unique(np.concatenate([keys for keys, _ in self._chunks]), return_inverse=True)
+            weights = np.concatenate([counts for _, counts in self._chunks])
+            counts = np.bincount(inverse.ravel(), weights=weights, minlength=len(keys)).astype(np.int64)
+
+            return keys, counts
+
+        def build(self):
+            self._flush()
+            keys, counts = self._merge()
+            vocab_size = self._vocab_size
+
+            # (1) frequent target subwords, special symbols are always part of the shortlist
+            frequent = np.argsort(-self._tgt_freq, kind='stable')[:self._frequent]
+            frequent = frequent[self._tgt_freq[frequent] > 0]
+            frequent = np.union1d(frequent, np.arange(self._dictionary.nspecial))
+
+            is_frequent = np.zeros(vocab_size, dtype=bool)
+            is_frequent[frequent] = True
+
+            # (2) per-source candidates, the top-k target subwords by Dice coefficient
+            src, tgt = keys // vocab_size, keys % vocab_size
+            mask = (counts >= self._min_count) & ~is_frequent[tgt]
+            src, tgt, counts = src[mask], tgt[mask], counts[mask]
+
+            dice = 2. * counts / (self._src_docs[src] + self._tgt_docs[tgt])
+            order = np.lexsort((-dice, src))
+            src, tgt = src[order], tgt[order]
+
+            rank = np.arange(len(src)) - np.searchsorted(src, src)
+            src, tgt = src[rank < self._candidates], tgt[rank < self._candidates]
+
+            offsets = np.zeros(vocab_size + 1, dtype=np.int64)
+            offsets[1:] = np.cumsum(np.bincount(src, minlength=vocab_size))
+
+            self._logger.info('shortlist built: frequent = %d, candidates = %d' % (len(frequent), len(tgt)))
+
+            return Shortlist(vocab_size, frequent.astype(np.int32), offsets, tgt.astype(np.int32))
+
+    @classmethod
+    def path(cls, checkpoint_path):
+        return os.path.join(checkpoint_path, cls.FILENAME)
+
+    @classmethod
+    def exists(cls, checkpoint_path):
+        return os.path.isfile(cls.path(checkpoint_path))
+
+    @classmethod
+    def load(cls, checkpoint_path):
+        with np.load(cls.path(checkpoint_path)) as data:
+            return cls(int(data['vocab_size']), data['frequent'], data['offsets'], data['targets'])
+
+    def __init__(self, vocab_size, frequent, offsets, targets):
+        self._vocab_size = vocab_size
+        self._frequent = frequent
+        self._offsets = offsets
+        self._targets = targets
+
+    @property
+    def vocab_size(self):
+        return self._vocab_size
+
+    def save(self, checkpoint_path):
+        path = self.path(checkpoint_path)
+
+        # write to a temporary file first, so that a running decoder never reads a partial file
+        with open(path + '.tmp', 'wb') as stream:
+            np.savez(stream, vocab_size=np.int64(self._vocab_size), frequent=self._frequent,
+                     offsets=self._offsets, targets=self._targets)
+        os.replace(path + '.tmp', path)
+
+    def candidates(self, src_tokens):
+        """
+        Return the sorted target ids (LongTensor) allowed for the given source batch (list of LongTensor):
+        frequent subwords, source subwords (copies) and the candidates of every source subword.
+        """
+        tokens = np.unique(np.concatenate([t.numpy() for t in src_tokens]))
+        tokens = tokens[tokens < self._vocab_size]
+
+        ids = [self._frequent, tokens] + [self._targets[self._offsets[i]:self._offsets[i + 1]] for i in tokens]
+        return torch.from_numpy(np.unique(np.concatenate(ids)).astype(np.int64))
+
+    def __len__(self):
+        return len(self._targets)
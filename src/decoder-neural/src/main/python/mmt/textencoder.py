@@ -4,6 +4,7 @@ import multiprocessing
 import os
 import re
 import tempfile
+import threading
 from itertools import chain
 
 import cachetools
@@ -376,6 +377,7 @@ class SubwordDictionary(Dictionary):
         self.nspecial = len(RESERVED_TOKENS)
 
         self._cache = cachetools.LRUCache(maxsize=2 ** 20)
+        self._cache_lock = threading.Lock()  # the dictionary can be used concurrently by the decoder pipeline
         self._max_subtoken_len = 0
         self._alphabet = set()
 
@@ -383,6 +385,15 @@ class SubwordDictionary(Dictionary):
             self._init_subtokens_from_list(subtokens)
             self._init_alphabet_from_tokens(subtokens)
 
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_cache_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._cache_lock = threading.Lock()
+
     def _init_subtokens_from_list(self, subtokens):
         self.symbols = subtokens
         self.indices = {s: i for i, s in enumerate(subtokens) if s}
@@ -538,7 +549,8 @@ class SubwordDictionary(Dictionary):
             ret.extend(self._subtokens_of(token))
         return ret
 
-    @cachetools.cachedmethod(cache=lambda self: self._cache, key=lambda token: token)
+    @cachetools.cachedmethod(cache=lambda self: self._cache, key=lambda token: token,
+                             lock=lambda self: self._cache_lock)
     def _subtokens_of(self, token):
         return self._subtokens_of_escaped(_escape_token(token, self._alphabet))
 
@@ -14,6 +14,11 @@ class TuningOptions(object):
         self.tuning_max_epochs = 4
         self.tuning_max_learning_rate = .0001
         self.tuning_max_batch_size = 4000
+        # comma-separated list of: all, decoder, last_layers, layer_norms, biases, output_embeddings
+        self.tuning_scope = 'all'
+        self.tuning_last_layers = 1  # number of (top) decoder layers tuned with scope "last_layers"
+        self.tuning_reuse = True  # skip reset and tuning if the model is already tuned on the same suggestions
+        self.tuning_cache_size = 0  # number of tuned parameter sets kept in memory for later reuse
 
     def __str__(self):
         return str(self.__dict__)
@@ -48,6 +53,8 @@ class TuningDataset(torch.utils.data.Dataset):
 
 
 class Tuner(object):
+    SCOPES = ['all', 'decoder', 'last_layers', 'layer_norms', 'biases', 'output_embeddings']
+
     @classmethod
     def dataset(cls, src_samples, tgt_samples, dictionary):
         src_dataset = TuningDataset(src_samples, dictionary)
@@ -66,7 +73,7 @@ class Tuner(object):
         self._logger = logging.getLogger('Tuner')
 
         self._cuda = torch.cuda.is_available() and device is not None
-        self._tuning_ops = tuning_ops
+        self._tuning_ops = tuning_ops if tuning_ops is not None else TuningOptions()
         self._args = args
         self._task = task
 
@@ -76,8 +83,68 @@ class Tuner(object):
         if self._cuda:
             self._criterion = self._criterion.cuda()
 
-    def _build_optimizer(self):
-        params = list(filter(lambda p: p.requires_grad, self._model.parameters()))
+        self._freeze_parameters()
+
+    def _select_parameters(self):
+        scopes = set([scope.strip() for scope in str(self._tuning_ops.tuning_scope).split(',')])
+        for scope in scopes:
+            if scope not in self.SCOPES:
+                raise ValueError('Invalid tuning scope "%s", valid values are: %s' % (scope, ', '.join(self.SCOPES)))
+
+        named_params = list(self._model.named_parameters())
+        if 'all' in scopes:
+            return set([name for name, _ in named_params])
+
+        selected = set()
+
+        if 'decoder' in scopes:
+            # by identity: shared embeddings are named after the encoder ("encoder.embed_tokens.weight")
+            decoder_params = set([id(param) for param in self._model.decoder.parameters()])
+            selected.update([name for name, param in named_params if id(param) in decoder_params])
+
+        if 'last_layers' in scopes:
+            first_layer = len(self._model.decoder.layers) - self._tuning_ops.tuning_last_layers
+            for name, _ in named_params:
+                if name.startswith('decoder.layers.') and int(name.split('.')[2]) >= first_layer:
+                    selected.add(name)
+
+        if 'layer_norms' in scopes:
+            for module_name, module in self._model.named_modules():
+                if 'LayerNorm' in module.__class__.__name__:
+                    selected.update(['%s.%s' % (module_name, name) for name, _ in module.named_parameters()])
+
+        if 'biases' in scopes:
+            selected.update([name for name, _ in named_params if name.endswith('bias')])
+
+        if 'output_embeddings' in scopes:
+            decoder = self._model.decoder
+            output_embeddings = decoder.embed_tokens.weight if decoder.share_input_output_embed else decoder.embed_out
+            selected.update([name for name, param in named_params if param is output_embeddings])
+
+        return selected
+
+    def _freeze_parameters(self):
+        # parameters out of the tuning scope are excluded from backward pass and optimization
+        selected = self._select_parameters()
+
+        frozen = 0
+        for name, param in self._model.named_parameters():
+            param.requires_grad = name in selected
+            if not param.requires_grad:
+                frozen += param.numel()
+
+        self._logger.info('tuning scope = "%s", frozen parameters = %d' % (self._tuning_ops.tuning_scope, frozen))
+
+    def _tunable_parameters(self):
+        return [(name, param) for name, param in self._model.named_parameters() if param.requires_grad]
+
+    def tunable_parameter_names(self):
+        """
+        Return the names of the parameters that tune() may modify.
+        """
+        return set([name for name, _ in self._tunable_parameters()])
+
+    def _build_optimizer(self, params):
         if self._args.fp16:
             if self._cuda and torch.cuda.get_device_capability(0)[0] < 7:
                 print('| WARNING: your device does NOT support faster training with --fp16, '
@@ -115,8 +182,11 @@ class Tuner(object):
         return tuning_epochs, tuning_learning_rate
 
     def tune(self, dataset, num_iterations, lr):
+        """
+        Tune the model on the given dataset; it returns the names of the parameters that may have been modified.
+        """
         if len(dataset) == 0:
-            return
+            return set()
 
         epoch_itr = self._task.get_batch_iterator(
             dataset=dataset,
@@ -127,18 +197,22 @@ class Tuner(object):
             seed=1, num_shards=1, shard_id=0,
         )
 
-        optimizer = self._build_optimizer()
+        named_params = self._tunable_parameters()
+        optimizer = self._build_optimizer([param for _, param in named_params])
 
         for step in range(num_iterations):
             for sample in epoch_itr.next_epoch_itr(shuffle=False, fix_batches_to_gpus=False):
                 if len(sample) == 0:
                     continue
 
-                sample = utils.move_to_cuda(sample)
+                if self._cuda:
+                    sample = utils.move_to_cuda(sample)
                 optimizer.set_lr(lr)
                 self._train_step(optimizer, sample, step)
                 del sample
 
+        return set([name for name, _ in named_params])
+
     def _train_step(self, optimizer, sample, step=0):
         """Do forward, backward and parameter update."""
         seed = self._args.seed + step
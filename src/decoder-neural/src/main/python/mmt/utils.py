@@ -1,7 +1,17 @@
+import bisect
+import cProfile
+import io
 import json
 import logging
+import os
+import pstats
+import queue
+import struct
 import sys
+import threading
+import time
 
+import torch
 from mmt.decoder import Translation, Suggestion
 
 
@@ -51,29 +61,85 @@ def mask_std_streams():
 
 
 class TranslationRequest(object):
-    def __init__(self, source_lang, target_lang, batch, suggestions=None, forced_translation=None):
+    COMMANDS = ['metrics', 'profile']
+
+    def __init__(self, source_lang, target_lang, batch, suggestions=None, forced_translation=None, nbest=None,
+                 request_id=None, command=None, command_args=None, alignment=True):
         self.source_lang = source_lang
         self.target_lang = target_lang
         self.batch = batch
         self.suggestions = suggestions if suggestions is not None else []
         self.forced_translation = forced_translation
+        self.nbest = nbest
+        self.alignment = alignment
+        self.request_id = request_id
+        self.command = command
+        self.command_args = command_args if command_args is not None else {}
+        self.encoded_batch = None
+        self.checkpoint = None
+        self.received = time.time()
+        self.stats = {}
 
     @staticmethod
     def from_json_string(json_string):
+        begin = time.time()
+        request = TranslationRequest._parse_json_string(json_string)
+        request.received = begin
+        request.stats['parse'] = time.time() - begin
+
+        return request
+
+    @staticmethod
+    def _parse_request_id(value):
+        # request ids are echoed in responses, the binary protocol encodes them as int64
+        if isinstance(value, bool) or not isinstance(value, (int, str)):
+            raise ValueError('Invalid request id: %r' % (value,))
+
+        try:
+            request_id = int(value)
+        except ValueError:
+            raise ValueError('Invalid request id: %r' % (value,))
+
+        if not -2 ** 63 <= request_id < 2 ** 63:
+            raise ValueError('Request id out of int64 range: %d' % request_id)
+
+        return request_id
+
+    @staticmethod
+    def _parse_json_string(json_string):
         obj = json.loads(json_string)
+        request_id = obj.pop('id', None)
+        if request_id is not None:
+            request_id = TranslationRequest._parse_request_id(request_id)
+
+        if 'command' in obj:
+            command = obj.pop('command')
+            if command not in TranslationRequest.COMMANDS:
+                raise ValueError('Unknown command "%s"' % command)
+            return TranslationRequest(None, None, None, request_id=request_id, command=command, command_args=obj)
 
         if len(obj) == 0:
-            return TranslationRequest(None, None, None)  # Test request
+            return TranslationRequest(None, None, None, request_id=request_id)  # Test request
 
         batch = obj['q'].split('\n')
         source_lang = obj['sl']
         target_lang = obj['tl']
+        if '\n' in target_lang:  # the target language of every segment (mixed batch)
+            target_lang = target_lang.split('\n')
+            if len(batch) != len(target_lang):
+                raise ValueError("Number of inputs and target languages differs ({} vs {})".format(
+                    len(batch), len(target_lang)))
         forced_translation = None
         if 'f' in obj:
             forced_translation = obj['f'].split('\n')
             if (len(batch) != len(forced_translation)):
                 raise ValueError("Number of inputs ans forced translations differs ({} vs {}".format(len(batch), len(forced_translation)))
 
+        alignment = bool(obj['a']) if 'a' in obj else True
+        nbest = int(obj['n']) if 'n' in obj else None
+        if nbest is not None and nbest < 1:
+            raise ValueError("Invalid n-best size: {}".format(nbest))
+
         suggestions = []
 
         if 'hints' in obj:
@@ -87,27 +153,44 @@ class TranslationRequest(object):
                 suggestions.append(Suggestion(sugg_sl, sugg_tl, sugg_seg, sugg_tra, sugg_scr))
 
         return TranslationRequest(source_lang, target_lang, batch,
-                                  suggestions=suggestions, forced_translation=forced_translation)
+                                  suggestions=suggestions, forced_translation=forced_translation, nbest=nbest,
+                                  request_id=request_id, alignment=alignment)
 
 
 class TranslationResponse(object):
+    # "obj" can be an exception, a list of translations or the dict result of a command; if "stats" is
+    # not None, the time spent encoding the translations is added as "serialize" and sent along with them.
     @staticmethod
-    def to_json_string(obj):
+    def to_json_string(obj, request_id=None, stats=None):
+        begin = time.time()
+
         if isinstance(obj, BaseException):
-            return TranslationResponse.__error_to_json_string(obj)
+            payload = TranslationResponse.__error_to_json(obj)
+        elif isinstance(obj, dict):
+            payload = {'success': True}
+            payload.update(obj)
         else:
-            return TranslationResponse.__translations_to_json_string(obj)
+            payload = TranslationResponse.__translations_to_json(obj)
+
+            if stats is not None:
+                stats['serialize'] = time.time() - begin
+                payload['stats'] = stats
+
+        if request_id is not None:
+            payload['id'] = request_id
+
+        return json.dumps(payload).replace('\n', ' ')
 
     @staticmethod
-    def __error_to_json_string(cause):
-        return json.dumps({
+    def __error_to_json(cause):
+        return {
             'success': False,
             'type': 'UnknownError' if isinstance(cause, str) else type(cause).__name__,
             'msg': cause if isinstance(cause, str) else str(cause)
-        }).replace('\n', ' ')
+        }
 
     @staticmethod
-    def __translations_to_json_string(translations):
+    def __translations_to_json(translations):
         def __encode_alignment(a):
             return [[e[0] for e in a], [e[1] for e in a]] if a is not None else None
 
@@ -119,44 +202,621 @@ class TranslationResponse(object):
                 payload['a'] = alignment
             if translation.score is not None:
                 payload['s'] = round(translation.score, 4)
+            if translation.nbest is not None:
+                payload['nbest'] = [__to_json(hypothesis) for hypothesis in translation.nbest]
 
             return payload
 
-        return json.dumps({
+        return {
             'success': True,
             'data': [__to_json(translation) for translation in translations],
-        }).replace('\n', ' ')
+        }
+
+    # Binary encoding (all numbers are big-endian):
+    #   error:   uint8 0, int64 request id (-1 if missing), string type, string msg
+    #   success: uint8 1, int64 request id (-1 if missing), uint32 count, count * translation,
+    #            uint32 stats count, stats count * (string name, float64 value)
+    #   command: uint8 2, int64 request id (-1 if missing), string JSON result
+    # where:
+    #   string      = uint32 length, UTF-8 bytes
+    #   translation = string text, float32 score (NaN if missing), int32 alignment length (-1 if missing),
+    #                 int32[length] source indexes, int32[length] target indexes,
+    #                 uint32 nbest count, nbest count * translation
+    @staticmethod
+    def to_bytes(obj, request_id=None, stats=None):
+        request_id = struct.pack('>q', int(request_id) if request_id is not None else -1)
+
+        if isinstance(obj, BaseException):
+            return TranslationResponse.__error_to_bytes(obj, request_id)
+        elif isinstance(obj, dict):
+            return struct.pack('>B', 2) + request_id + TranslationResponse.__encode_string(json.dumps(obj))
+        else:
+            return TranslationResponse.__translations_to_bytes(obj, request_id, stats)
+
+    @staticmethod
+    def __encode_string(text):
+        data = text.encode('utf-8')
+        return struct.pack('>I', len(data)) + data
+
+    @staticmethod
+    def __error_to_bytes(cause, request_id):
+        return b''.join([
+            struct.pack('>B', 0),
+            request_id,
+            TranslationResponse.__encode_string('UnknownError' if isinstance(cause, str) else type(cause).__name__),
+            TranslationResponse.__encode_string(cause if isinstance(cause, str) else str(cause))
+        ])
+
+    @staticmethod
+    def __translations_to_bytes(translations, request_id, stats=None):
+        begin = time.time()
+
+        def __encode(translation, chunks):
+            chunks.append(TranslationResponse.__encode_string(translation.text))
+            chunks.append(struct.pack('>f', translation.score if translation.score is not None else float('nan')))
+
+            if translation.alignment is None:
+                chunks.append(struct.pack('>i', -1))
+            else:
+                size = len(translation.alignment)
+                chunks.append(struct.pack('>i', size))
+                chunks.append(struct.pack('>%di' % size, *[e[0] for e in translation.alignment]))
+                chunks.append(struct.pack('>%di' % size, *[e[1] for e in translation.alignment]))
+
+            nbest = translation.nbest or []
+            chunks.append(struct.pack('>I', len(nbest)))
+            for hypothesis in nbest:
+                __encode(hypothesis, chunks)
+
+        payload = [struct.pack('>B', 1), request_id, struct.pack('>I', len(translations))]
+        for translation in translations:
+            __encode(translation, payload)
+
+        if stats is not None:
+            stats['serialize'] = time.time() - begin
+
+        stats = stats or {}
+        payload.append(struct.pack('>I', len(stats)))
+        for name, value in stats.items():
+            payload.append(TranslationResponse.__encode_string(name))
+            payload.append(struct.pack('>d', value))
+
+        return b''.join(payload)
+
+
+class Profiler(object):
+    """
+    Profile the translation requests with cProfile (and the torch autograd profiler if "use_torch" is True)
+    until "requests" profiles slower than "threshold" seconds have been written to "path": for every one,
+    the raw cProfile stats (.prof), a per-function summary (.txt) and, with torch, a per-operator summary
+    (.ops.txt) and a chrome trace (.trace.json). Requests are not profiled at all while it is disabled.
+    """
+
+    def __init__(self, path, use_torch=False):
+        self._path = path
+        self._use_torch = use_torch
+        self._remaining = 0
+        self._threshold = 0.
+        self._logger = logging.getLogger('Profiler')
+
+    @property
+    def enabled(self):
+        return self._remaining > 0
+
+    def enable(self, requests, threshold=0.):
+        self._remaining = requests
+        self._threshold = threshold
+        self._logger.info('profiling enabled: requests = %d, threshold = %.3f, path = %s' %
+                          (requests, threshold, self._path))
+
+    def status(self):
+        return {'remaining': self._remaining, 'threshold': self._threshold, 'path': self._path}
+
+    def profile(self, name, fn, *args, **kwargs):
+        profile = cProfile.Profile()
+        torch_profile = torch.autograd.profiler.profile() if self._use_torch else None
+
+        begin = time.time()
+        if torch_profile is not None:
+            torch_profile.__enter__()
+        profile.enable()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            profile.disable()
+            if torch_profile is not None:
+                torch_profile.__exit__(None, None, None)
+
+            elapsed = time.time() - begin
+            if elapsed >= self._threshold and self._remaining > 0:
+                self._remaining -= 1
+                self._dump(name, elapsed, profile, torch_profile)
+
+    def _dump(self, name, elapsed, profile, torch_profile):
+        os.makedirs(self._path, exist_ok=True)
+        basename = os.path.join(self._path, '%s_%d_%s' % (time.strftime('%Y%m%d-%H%M%S'), os.getpid(), name))
+
+        profile.dump_stats(basename + '.prof')
+
+        summary = io.StringIO()
+        pstats.Stats(profile, stream=summary).sort_stats('cumulative').print_stats(50)
+        with open(basename + '.txt', 'w', encoding='utf-8') as stream:
+            stream.write('elapsed = %.3f\n' % elapsed)
+            stream.write(summary.getvalue())
+
+        if torch_profile is not None:
+            with open(basename + '.ops.txt', 'w', encoding='utf-8') as stream:
+                stream.write(torch_profile.key_averages().table(sort_by='self_cpu_time_total'))
+            torch_profile.export_chrome_trace(basename + '.trace.json')
+
+        self._logger.info('profile written: %s, elapsed = %.3f, remaining = %d' % (basename, elapsed, self._remaining))
+
+
+class Metrics(object):
+    """
+    Cumulative counters and per-step latency histograms of the requests served since start.
+    """
+
+    STEPS = ['parse', 'tokenize', 'reset', 'tune', 'generate', 'alignment', 'serialize', 'total']
+    COUNTERS = ['batch_size', 'src_tokens', 'tgt_tokens', 'exact_matches']
+    BUCKETS = [.001, .002, .005, .01, .02, .05, .1, .2, .5, 1., 2., 5., 10., 30.]  # upper bounds in seconds
+
+    def __init__(self):
+        self._start_time = time.time()
+        self.requests = 0
+        self.errors = 0
+        self.counters = {name: 0 for name in self.COUNTERS}
+        self.histograms = {step: [0] * (len(self.BUCKETS) + 1) for step in self.STEPS}
+        self.sums = {step: 0. for step in self.STEPS}
+
+    def update(self, stats):
+        self.requests += 1
+
+        for name in self.COUNTERS:
+            self.counters[name] += stats.get(name, 0)
+
+        for step in self.STEPS:
+            if step in stats:
+                self.histograms[step][bisect.bisect_left(self.BUCKETS, stats[step])] += 1
+                self.sums[step] += stats[step]
+
+    def error(self):
+        self.errors += 1
+
+    def to_dict(self):
+        # histogram counts are not cumulative, the last one counts the values greater than the last bucket
+        return {
+            'uptime': time.time() - self._start_time,
+            'requests': self.requests,
+            'errors': self.errors,
+            'counters': dict(self.counters),
+            'buckets': self.BUCKETS,
+            'latency': {step: {'count': sum(self.histograms[step]), 'sum': self.sums[step],
+                               'histogram': list(self.histograms[step])} for step in self.STEPS}
+        }
+
+
+class JSONChannel(object):
+    """
+    Newline-delimited JSON messages over text streams (the default protocol).
+    """
+
+    name = 'json'
+
+    def __init__(self, stdin, stdout):
+        self._stdin = stdin
+        self._stdout = stdout
+
+    def recv(self):
+        line = self._stdin.readline()
+        return TranslationRequest.from_json_string(line) if line else None
+
+    def send(self, obj, request_id=None, stats=None):
+        self._stdout.write(TranslationResponse.to_json_string(obj, request_id=request_id, stats=stats) + '\n')
+        self._stdout.flush()
+
+
+class BinaryChannel(object):
+    """
+    Length-prefixed frames (uint32 big-endian size + payload) over binary streams:
+    requests carry a UTF-8 JSON payload, responses use the TranslationResponse binary encoding.
+    The engine does not use it yet: PythonDecoderImpl starts the decoder with the default JSON protocol.
+    """
+
+    name = 'binary'
+
+    def __init__(self, stdin, stdout):
+        self._stdin = getattr(stdin, 'buffer', stdin)
+        self._stdout = getattr(stdout, 'buffer', stdout)
+
+    def _read(self, size):
+        data = self._stdin.read(size)
+        if len(data) < size:
+            if len(data) > 0:
+                raise IOError('Unexpected end of stream: %d bytes expected, %d found' % (size, len(data)))
+            return None
+        return data
+
+    def recv(self):
+        header = self._read(4)
+        if header is None:
+            return None
+
+        payload = self._read(struct.unpack('>I', header)[0])
+        if payload is None:
+            raise IOError('Unexpected end of stream: missing frame payload')
+
+        return TranslationRequest.from_json_string(payload.decode('utf-8'))
+
+    def send(self, obj, request_id=None, stats=None):
+        payload = TranslationResponse.to_bytes(obj, request_id=request_id, stats=stats)
+
+        self._stdout.write(struct.pack('>I', len(payload)))
+        self._stdout.write(payload)
+        self._stdout.flush()
 
 
-def serve_forever(stdin, stdout, decoder):
-    stdout.write('READY\n')
+_CHANNELS = {channel.name: channel for channel in [JSONChannel, BinaryChannel]}
+
+
+def _parse_profile_args(args):
+    # the arguments of the "profile" command come from the JSON request as they are: the number of requests
+    # and the threshold in milliseconds, as numbers or numeric strings
+    def __parse(name, default, cast):
+        value = args.get(name, default)
+        if isinstance(value, bool) or not isinstance(value, (int, float, str)):
+            raise ValueError('Invalid profile %s: %r' % (name, value))
+
+        try:
+            value = cast(value)
+        except (ValueError, OverflowError):
+            raise ValueError('Invalid profile %s: %r' % (name, value))
+
+        if not 0 <= value < float('inf'):
+            raise ValueError('Invalid profile %s: %r' % (name, value))
+
+        return value
+
+    return __parse('requests', 1, int), __parse('threshold', 0, float) / 1000.
+
+
+def _translate(decoder, request):
+    if request.batch is None:
+        decoder.test()
+        return []
+    else:
+        return decoder.translate(request.source_lang, request.target_lang, request.batch,
+                                 suggestions=request.suggestions,
+                                 forced_translation=request.forced_translation,
+                                 nbest=request.nbest, encoded_batch=request.encoded_batch, stats=request.stats,
+                                 alignment=request.alignment)
+
+
+def _is_coalescable(request):
+    return request.batch is not None and len(request.suggestions) == 0 and request.forced_translation is None
+
+
+def _can_coalesce(request, other):
+    # requests for different target languages are merged if translated by the same (multilingual) checkpoint
+    return _is_coalescable(other) and request.source_lang == other.source_lang and \
+           request.checkpoint == other.checkpoint and request.nbest == other.nbest
+
+
+def _count_tokens(request):
+    return sum(tokens.numel() for tokens in request.encoded_batch[0])
+
+
+def _coalesce(request, requests, max_tokens, max_wait):
+    """
+    Collect from the "requests" queue the ones that can be translated together with "request",
+    until the token budget is reached or "max_wait" seconds are elapsed; it returns the group
+    and the first queue item that could not be added to it (if any).
+    """
+    group = [request]
+    tokens = _count_tokens(request)
+    deadline = time.time() + max_wait
+
+    while tokens < max_tokens:
+        try:
+            timeout = deadline - time.time()
+            item = requests.get(timeout=timeout) if timeout > 0 else requests.get_nowait()
+        except queue.Empty:
+            break
+
+        if item is None or item[1] is not None or not _can_coalesce(request, item[0]):
+            return group, [item]
+
+        item_tokens = _count_tokens(item[0])
+        if tokens + item_tokens > max_tokens:
+            return group, [item]
+
+        group.append(item[0])
+        tokens += item_tokens
+
+    return group, []
+
+
+def _translate_group(decoder, group):
+    if len(group) == 1:
+        return [_translate(decoder, group[0])]
+
+    head = group[0]
+    batch = [segment for request in group for segment in request.batch]
+    src_tokens = [tokens for request in group for tokens in request.encoded_batch[0]]
+    target_langs = [lang for request in group
+                    for lang in ([request.target_lang] * len(request.batch)
+                                 if isinstance(request.target_lang, str) else request.target_lang)]
+
+    stats = {}
+    translations = decoder.translate(head.source_lang, target_langs, batch,
+                                     nbest=head.nbest, encoded_batch=(src_tokens, None), stats=stats,
+                                     alignment=any(request.alignment for request in group))
+
+    results = []
+    offset = 0
+    for request in group:
+        request.stats.update(stats)  # decoder stats refer to the whole group
+        result = translations[offset:offset + len(request.batch)]
+        results.append(result if request.alignment else [_without_alignment(e) for e in result])
+        offset += len(request.batch)
+
+    return results
+
+
+def _without_alignment(translation):
+    # a copy, translations can be shared with the decoder cache
+    nbest = [_without_alignment(e) for e in translation.nbest] if translation.nbest is not None else None
+    return Translation(translation.text, score=translation.score, nbest=nbest)
+
+
+def serve_forever(stdin, stdout, decoder, protocol=JSONChannel.name, max_in_flight=1,
+                  coalesce_max_tokens=0, coalesce_max_wait=0., profiler=None):
+    """
+    Serve translation requests until stdin is closed. Requests flow through a three-stage pipeline:
+    a reader thread parses and subword-encodes them, the calling thread runs the model, and a writer
+    thread computes the (deferred) alignments and serializes responses; at most "max_in_flight"
+    requests wait in each queue between stages. Responses are written in the same order as requests,
+    each carrying the "id" (an int64) of the corresponding request (if any). Stages overlap only for
+    clients writing requests ahead of the responses: the engine client (PythonDecoderImpl) sends one
+    request at a time and waits for its response, thus it does not benefit from the pipeline.
+
+    If "coalesce_max_tokens" is greater than zero, consecutive requests for the same source language
+    and checkpoint without suggestions nor forced translations are merged into a single decoder call of
+    at most "coalesce_max_tokens" source tokens, waiting up to "coalesce_max_wait" seconds for them to
+    arrive; requests for different target languages of a multilingual checkpoint are decoded together.
+    The token budget only limits the size of a group: the requests queue is still bounded by "max_in_flight",
+    while the model thread collects a group the reader keeps filling the queue as it drains.
+
+    Every translation response carries the time spent by its request in each step ("stats"); the
+    request {"command": "metrics"} returns instead the cumulative counters and latency histograms
+    of all the requests answered before it.
+
+    If a "profiler" is given, the request {"command": "profile", "requests": N, "threshold": MS} makes
+    it profile the model stage of the following requests (see Profiler), otherwise it is answered with an error.
+    """
+    if protocol not in _CHANNELS:
+        raise ValueError('Unsupported protocol "%s"' % protocol)
+
+    # The handshake line is always plain text, it announces the protocol if different from the default one
+    stdout.write('READY\n' if protocol == JSONChannel.name else 'READY %s\n' % protocol)
     stdout.flush()
 
-    try:
+    channel = _CHANNELS[protocol](stdin, stdout)
+    requests = queue.Queue(maxsize=max_in_flight)
+    responses = queue.Queue(maxsize=max_in_flight)
+    write_errors = []
+    metrics = Metrics()
+
+    def read_loop():
+        request = None
+
+        try:
+            while True:
+                request = None
+                request = channel.recv()
+                if request is None:
+                    break
+
+                if request.batch is not None:
+                    begin = time.time()
+                    request.encoded_batch = decoder.encode(request.source_lang, request.target_lang, request.batch,
+                                                           forced_translation=request.forced_translation)
+                    request.checkpoint = decoder.get_checkpoint(request.source_lang, request.target_lang)
+                    request.stats['tokenize'] = time.time() - begin
+
+                requests.put((request, None))
+        except BaseException as e:
+            requests.put((request, e))
+        finally:
+            requests.put(None)
+
+    def write_loop():
         while True:
-            line = stdin.readline()
-            if not line:
+            item = responses.get()
+            if item is None:
                 break
 
-            request = TranslationRequest.from_json_string(line)
+            if len(write_errors) > 0:
+                continue  # drain the queue, the process is going to exit
+
+            request, result = item
+            request_id = request.request_id if request is not None else None
+            stats = None
+
+            try:
+                if request is not None and request.command == 'metrics':
+                    result = {'metrics': metrics.to_dict()}
+                elif isinstance(result, BaseException):
+                    metrics.error()
+                elif not isinstance(result, dict):
+                    stats = request.stats
+
+                    begin = time.time()
+                    for translation in result:
+                        for hypothesis in [translation] + (translation.nbest or []):
+                            _ = hypothesis.alignment  # deferred alignments are computed here
+                    stats['alignment'] = time.time() - begin
+
+                channel.send(result, request_id=request_id, stats=stats)
+
+                if stats is not None:
+                    stats['total'] = time.time() - request.received
+                    metrics.update(stats)
+            except BaseException as e:
+                write_errors.append(e)
+
+                try:
+                    channel.send(e, request_id=request_id)
+                except BaseException:
+                    pass  # the channel is unusable, keep draining the queue so that the main thread never blocks
+
+    reader = threading.Thread(target=read_loop, name='RequestReader', daemon=True)
+    writer = threading.Thread(target=write_loop, name='ResponseWriter')
+    reader.start()
+    writer.start()
+
+    failed = False
+    pending = []
+    group = []
 
-            if request.batch is None:
-                decoder.test()
-                translations = []
-            else:
-                translations = decoder.translate(request.source_lang, request.target_lang, request.batch,
-                                                 suggestions=request.suggestions,
-                                                 forced_translation=request.forced_translation)
+    try:
+        while len(write_errors) == 0:
+            item = pending.pop() if len(pending) > 0 else requests.get()
+            if item is None:
+                break
+
+            request, error = item
+            group = [request] if request is not None else []
+
+            if error is not None:
+                raise error
 
-            response = TranslationResponse.to_json_string(translations)
+            if request.command == 'profile':
+                try:
+                    if profiler is None:
+                        raise ValueError('Profiling is not available')
+                    profiler.enable(*_parse_profile_args(request.command_args))
+                    result = {'profile': profiler.status()}
+                except ValueError as e:
+                    result = e  # an invalid command is answered with an error, the decoder keeps serving
 
-            stdout.write(response + '\n')
-            stdout.flush()
+                responses.put((request, result))
+                continue
+            elif request.command is not None:
+                responses.put((request, None))
+                continue
+
+            if coalesce_max_tokens > 0 and _is_coalescable(request):
+                group, pending = _coalesce(request, requests, coalesce_max_tokens, coalesce_max_wait)
+
+            if profiler is not None and profiler.enabled:
+                results = profiler.profile(str(request.request_id or 'request'), _translate_group, decoder, group)
+            else:
+                results = _translate_group(decoder, group)
+
+            for request, result in zip(group, results):
+                responses.put((request, result))
     except KeyboardInterrupt:
         pass  # ignore and exit
     except BaseException as e:
-        response = TranslationResponse.to_json_string(e)
-        stdout.write(response + '\n')
-        stdout.flush()
+        for request in (group or [None]):
+            responses.put((request, e))
+        failed = True
+
+    responses.put(None)
+    writer.join()
 
+    if failed or len(write_errors) > 0:
         exit(1)
+
+
+def cpu_sets(count):
+    """
+    Split the CPUs available to this process into "count" disjoint sets of contiguous CPUs.
+    """
+    cpus = sorted(os.sched_getaffinity(0))
+    if count > len(cpus):
+        raise ValueError('Cannot split %d CPUs among %d workers' % (len(cpus), count))
+
+    size, remainder = divmod(len(cpus), count)
+
+    result = []
+    begin = 0
+    for i in range(count):
+        end = begin + size + (1 if i < remainder else 0)
+        result.append(cpus[begin:end])
+        begin = end
+
+    return result
+
+
+def serve_workers(decoder_factory, workers, endpoints_path, stdout, **kwargs):
+    """
+    Fork "workers" processes, each one serving translations (see serve_forever) on its own pair of
+    named pipes "<endpoints_path>/worker_<i>.in" and "<endpoints_path>/worker_<i>.out". Everything that
+    has been loaded before calling this function (i.e. checkpoints) is shared copy-on-write among workers.
+    Every worker is pinned to its own set of CPUs and uses as many intra-op threads.
+
+    The supervisor prints one line "WORKER <i> <stdin path> <stdout path>" per worker, then waits
+    for all of them to terminate. A client discovers the workers reading these lines, then connects
+    to every worker opening its stdin pipe for writing first and its stdout pipe for reading next (the
+    worker opens them in the same order, any other order blocks both); from then on each pair of pipes
+    behaves like the stdin and stdout of a single decoder process, starting with the "READY" line.
+    A worker terminates when its stdin is closed and it is not restarted: when one of them fails, the
+    client has to restart the whole process.
+
+    The Java decoder queue does not use this mode yet: it starts one decoder process per CPU thread and
+    expects the "READY" line on the process stdout, thus "--workers" must not be passed to it as an extra
+    argument either.
+    """
+    logger = logging.getLogger('Supervisor')
+    os.makedirs(endpoints_path, exist_ok=True)
+
+    pids = {}
+    for i, cpu_set in enumerate(cpu_sets(workers)):
+        in_path = os.path.join(endpoints_path, 'worker_%d.in' % i)
+        out_path = os.path.join(endpoints_path, 'worker_%d.out' % i)
+
+        for path in [in_path, out_path]:
+            if not os.path.exists(path):
+                os.mkfifo(path)
+
+        stdout.flush()
+        pid = os.fork()
+
+        if pid == 0:
+            exit_code = 0
+
+            try:
+                os.sched_setaffinity(0, cpu_set)
+                torch.set_num_threads(len(cpu_set))
+
+                decoder = decoder_factory()
+
+                with open(in_path, 'r', encoding='utf-8') as worker_stdin, \
+                        open(out_path, 'w', encoding='utf-8') as worker_stdout:
+                    serve_forever(worker_stdin, worker_stdout, decoder, **kwargs)
+            except SystemExit as e:
+                exit_code = e.code if isinstance(e.code, int) else 1
+            except BaseException:
+                logger.exception('Worker %d failed' % i)
+                exit_code = 1
+            finally:
+                os._exit(exit_code)
+
+        logger.info('worker %d started: pid = %d, cpus = %s' % (i, pid, cpu_set))
+        pids[pid] = i
+
+        stdout.write('WORKER %d %s %s\n' % (i, in_path, out_path))
+
+    stdout.flush()
+
+    exit_code = 0
+    while len(pids) > 0:
+        pid, status = os.wait()
+        if pid in pids:
+            logger.info('worker %d terminated with status %d' % (pids.pop(pid), status))
+            if status != 0:
+                exit_code = 1
+
+    return exit_code
@@ -0,0 +1,68 @@
+"""
+Compare the time of make_alignment() with the original nested-loops implementation (see test_alignment.py),
+for every symmetrization strategy, on random attention matrices of the given sizes.
+
+    python3 bench_alignment.py --lengths 10 30 80
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+import numpy as np
+
+import common  # noqa, it sets up the path of the "mmt" package
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir)))
+
+from mmt import alignment
+import test_alignment
+
+
+def _time(fn, cases, min_time=.2):
+    # the average time per call, repeating all the cases for at least "min_time" seconds
+    calls, begin = 0, time.time()
+    while True:
+        for case in cases:
+            fn(*case)
+        calls += len(cases)
+
+        elapsed = time.time() - begin
+        if elapsed >= min_time:
+            return elapsed / calls
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the word alignment from attention matrices')
+    parser.add_argument('--lengths', dest='lengths', metavar='N', nargs='+', default=[10, 30, 80], type=int,
+                        help='the number of source and target sub-words of the matrices (default 10 30 80)')
+    parser.add_argument('--cases', dest='cases', metavar='N', default=20, type=int,
+                        help='the number of random matrices per length (default 20)')
+    parser.add_argument('--strategies', dest='strategies', metavar='NAME', nargs='+',
+                        default=sorted(alignment.SYMMETRIZATION_STRATEGIES.keys()),
+                        help='the symmetrization strategies to compare (default all of them)')
+    args = parser.parse_args(argv)
+
+    references = test_alignment._ref_strategies()
+
+    print('%-26s %8s %14s %14s %9s' % ('strategy', 'length', 'loops (ms)', 'current (ms)', 'speedup'))
+    for name in args.strategies:
+        for length in args.lengths:
+            rnd = random.Random(length)
+            cases = []
+            for _ in range(args.cases):
+                source_indexes = test_alignment._random_indexes(rnd, length)
+                target_indexes = test_alignment._random_indexes(rnd, length)
+                attention = test_alignment._random_attention(rnd, length + 1, length + 1, np.float32)
+                cases.append((source_indexes, target_indexes, attention))
+
+            strategy, reference = alignment.SYMMETRIZATION_STRATEGIES[name], references[name]
+            old = _time(lambda s, t, a: test_alignment._ref_make_alignment(s, t, a, symmetrize=reference), cases)
+            new = _time(lambda s, t, a: alignment.make_alignment(s, t, a, symmetrize=strategy), cases)
+
+            print('%-26s %8d %14.3f %14.3f %8.1fx' % (name, length, 1000. * old, 1000. * new, old / new))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+"""
+Compare the decoding with and without word alignment (the "a" flag of a request), for every beam search
+implementation: without alignment the decoder layers do not compute the encoder-decoder attention weights
+and no alignment is built.
+
+    python3 bench_alignment_free.py models/decoder -s en -t it -i test.en --threads 1
+
+Alignments are computed lazily (by the response writer thread in the decoder process), here the time spent
+computing them is measured once on the translations of the fastest run and added to its time.
+"""
+import argparse
+import time
+
+import torch
+
+import common
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the alignment-free decoding')
+    common.add_model_args(parser)
+    parser.add_argument('--batch-size', dest='batch_size', metavar='N', default=1, type=int,
+                        help='the number of segments per request (default 1)')
+    parser.add_argument('--generators', dest='generators', metavar='NAME', nargs='+', default=['fairseq', 'builtin'],
+                        choices=['fairseq', 'builtin'], help='the beam search implementations (default all of them)')
+    parser.add_argument('--threads', dest='threads', metavar='N', default=None, type=int,
+                        help='the number of intra-op threads (default torch default)')
+    args = parser.parse_args(argv)
+
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+
+    lines = common.read_lines(args.input, args.lines)
+    batches = [lines[i:i + args.batch_size] for i in range(0, len(lines), args.batch_size)]
+
+    print('%-9s %-9s %14s %15s %16s %12s %9s %10s' % ('generator', 'alignment', 'latency (ms)', 'generate (ms)',
+                                                      'alignment (ms)', 'tgt tok/s', 'speedup', 'identical'))
+    for generator in args.generators:
+        baseline, baseline_texts = None, None
+        for alignment in [True, False]:
+            decoder = common.create_decoder(args.model, device=args.gpu, decoding={'generator': generator})
+            decoder.test()  # warm up
+            translations, stats = common.run(decoder, args.source_lang, args.target_lang, batches, runs=args.runs,
+                                             alignment=alignment)
+            texts = [translation.text for translation in translations]
+
+            begin = time.time()
+            for translation in translations:
+                _ = translation.alignment  # deferred alignments are computed here
+            alignment_time = time.time() - begin
+            total_time = stats['time'] + alignment_time
+
+            if baseline is None:
+                baseline, baseline_texts = total_time, texts
+
+            identical = 100. * sum(1 for a, b in zip(texts, baseline_texts) if a == b) / len(texts)
+
+            print('%-9s %-9s %14.2f %15.2f %16.2f %12.1f %8.2fx %9.1f%%' % (
+                generator, 'yes' if alignment else 'no', 1000. * total_time / len(batches),
+                1000. * stats['generate'] / len(batches), 1000. * alignment_time / len(batches),
+                stats['tgt_tokens'] / total_time, baseline / total_time, identical))
+
+
+if __name__ == '__main__':
+    main()
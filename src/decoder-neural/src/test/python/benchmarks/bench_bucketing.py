@@ -0,0 +1,46 @@
+"""
+Compare the decoding throughput of length-bucketed batches with the whole batch padded to its longest segment.
+
+    python3 bench_bucketing.py models/decoder -s en -t it -i newstest.en --batch-size 64
+
+Input lines are shuffled, so that every batch mixes short and long segments; without bucketing
+("--max-batch-tokens" large enough to hold any batch) every segment is padded to the longest one
+and the whole batch is decoded up to the longest decode length.
+"""
+import argparse
+import sys
+
+import common
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark length-bucketed decoding on a mixed-length workload')
+    common.add_model_args(parser)
+    parser.add_argument('--batch-size', dest='batch_size', metavar='N', default=64, type=int,
+                        help='the number of segments per request (default 64)')
+    parser.add_argument('--max-batch-tokens', dest='max_batch_tokens', metavar='N', default=2048, type=int,
+                        help='the max padded size of a bucket (default 2048)')
+    args = parser.parse_args(argv)
+
+    lines = common.read_lines(args.input, args.lines)
+    batches = common.make_batches(lines, args.batch_size)
+
+    modes = [('no bucketing', sys.maxsize), ('bucketing', args.max_batch_tokens)]
+
+    print('%-14s %10s %12s %12s %10s' % ('mode', 'time (s)', 'src tok/s', 'tgt tok/s', 'speedup'))
+    baseline = None
+    for name, max_batch_tokens in modes:
+        decoder = common.create_decoder(args.model, device=args.gpu, max_batch_tokens=max_batch_tokens)
+        decoder.test()  # warm up
+        _, stats = common.run(decoder, args.source_lang, args.target_lang, batches, runs=args.runs,
+                              alignment=False)
+
+        if baseline is None:
+            baseline = stats['time']
+
+        print('%-14s %10.2f %12.1f %12.1f %9.2fx' % (name, stats['time'], stats['src_tokens'] / stats['time'],
+                                                    stats['tgt_tokens'] / stats['time'], baseline / stats['time']))
+
+
+if __name__ == '__main__':
+    main()
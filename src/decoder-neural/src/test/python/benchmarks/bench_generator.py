@@ -0,0 +1,59 @@
+"""
+Compare the beam search implementations ("generator" decoding option): fairseq SequenceGenerator
+and the builtin mmt.generator.BeamSearch, for every beam size.
+
+    python3 bench_generator.py models/decoder -s en -t it -i test.en --beam-sizes 1 5 --threads 1
+
+The "latency" column is the average time per request, "generate" the part of it spent in the beam search;
+the "identical" column is the percentage of translations equal to the fairseq ones.
+"""
+import argparse
+
+import torch
+
+import common
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the builtin beam search against fairseq')
+    common.add_model_args(parser)
+    parser.add_argument('--batch-size', dest='batch_size', metavar='N', default=1, type=int,
+                        help='the number of segments per request (default 1)')
+    parser.add_argument('--beam-sizes', dest='beam_sizes', metavar='N', nargs='+', default=[1, 5], type=int,
+                        help='the beam sizes to compare (default 1 5)')
+    parser.add_argument('--threads', dest='threads', metavar='N', default=None, type=int,
+                        help='the number of intra-op threads (default torch default)')
+    args = parser.parse_args(argv)
+
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+
+    lines = common.read_lines(args.input, args.lines)
+    batches = [lines[i:i + args.batch_size] for i in range(0, len(lines), args.batch_size)]
+
+    print('%-9s %5s %14s %15s %12s %9s %10s' % ('generator', 'beam', 'latency (ms)', 'generate (ms)', 'tgt tok/s',
+                                                'speedup', 'identical'))
+    for beam_size in args.beam_sizes:
+        baseline, baseline_texts = None, None
+        for generator in ['fairseq', 'builtin']:
+            decoder = common.create_decoder(args.model, device=args.gpu, beam_size=beam_size,
+                                            decoding={'generator': generator})
+            decoder.test()  # warm up
+            translations, stats = common.run(decoder, args.source_lang, args.target_lang, batches, runs=args.runs,
+                                             alignment=False)
+            texts = [translation.text for translation in translations]
+
+            if baseline is None:
+                baseline, baseline_texts = stats['time'], texts
+
+            identical = 100. * sum(1 for a, b in zip(texts, baseline_texts) if a == b) / len(texts)
+
+            print('%-9s %5d %14.2f %15.2f %12.1f %8.2fx %9.1f%%' % (generator, beam_size,
+                                                                    1000. * stats['time'] / len(batches),
+                                                                    1000. * stats['generate'] / len(batches),
+                                                                    stats['tgt_tokens'] / stats['time'],
+                                                                    baseline / stats['time'], identical))
+
+
+if __name__ == '__main__':
+    main()
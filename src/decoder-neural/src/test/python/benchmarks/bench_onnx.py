@@ -0,0 +1,68 @@
+"""
+Compare the CPU decoding latency of PyTorch and ONNX Runtime ("--onnx"): both the default fairseq beam search
+and the builtin one on PyTorch, the latter being the beam search that runs on the ONNX graphs too.
+
+    python3 bench_onnx.py models/decoder -s en -t it -i test.en --threads 1
+
+The graphs must have been exported with "mmt export-onnx" from the current checkpoints. The "identical"
+column is the percentage of translations equal to the PyTorch ones with the default beam search.
+"""
+import argparse
+
+import torch
+
+import common
+from mmt.decoder import MMTDecoder
+from mmt.onnxmodel import ONNXDecoder, ONNXModel
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark ONNX Runtime CPU decoding')
+    common.add_model_args(parser)
+    parser.add_argument('--batch-size', dest='batch_size', metavar='N', default=1, type=int,
+                        help='the number of segments per request (default 1)')
+    parser.add_argument('--threads', dest='threads', metavar='N', default=None, type=int,
+                        help='the number of intra-op threads, of both PyTorch and ONNX Runtime '
+                             '(default torch default)')
+    args = parser.parse_args(argv)
+
+    if args.gpu is not None:
+        parser.error('ONNX decoding is supported on CPU only')
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+
+    # stale graphs are detected by the decoder, that logs a warning for every request decoded with PyTorch
+    config, _ = common.load_checkpoints(args.model)
+    for name, checkpoint_path in config.checkpoints:
+        if not ONNXModel.exists(checkpoint_path):
+            parser.error('missing ONNX graphs for checkpoint "%s", run "mmt export-onnx" first' % name)
+
+    lines = common.read_lines(args.input, args.lines)
+    batches = [lines[i:i + args.batch_size] for i in range(0, len(lines), args.batch_size)]
+
+    modes = [('pytorch', MMTDecoder, 'fairseq'), ('pytorch', MMTDecoder, 'builtin'), ('onnx', ONNXDecoder, 'builtin')]
+
+    print('%-8s %-9s %14s %15s %12s %9s %10s' % ('runtime', 'generator', 'latency (ms)', 'generate (ms)',
+                                                 'tgt tok/s', 'speedup', 'identical'))
+    baseline, baseline_texts = None, None
+    for runtime, decoder_class, generator in modes:
+        decoder = common.create_decoder(args.model, decoder_class=decoder_class, decoding={'generator': generator})
+        decoder.test()  # warm up
+        translations, stats = common.run(decoder, args.source_lang, args.target_lang, batches, runs=args.runs,
+                                         alignment=False)
+        texts = [translation.text for translation in translations]
+
+        if baseline is None:
+            baseline, baseline_texts = stats['time'], texts
+
+        identical = 100. * sum(1 for a, b in zip(texts, baseline_texts) if a == b) / len(texts)
+
+        print('%-8s %-9s %14.2f %15.2f %12.1f %8.2fx %9.1f%%' % (runtime, generator,
+                                                                 1000. * stats['time'] / len(batches),
+                                                                 1000. * stats['generate'] / len(batches),
+                                                                 stats['tgt_tokens'] / stats['time'],
+                                                                 baseline / stats['time'], identical))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+"""
+Compare the decoding with the full output layer and with the lexical shortlist ("output_shortlist"):
+speed, BLEU and agreement with the full output layer.
+
+    python3 bench_shortlist.py models/decoder -s en -t it -i test.en -r test.it --threads 1
+
+Every checkpoint of the model must have its shortlist, built with "mmt shortlist". The "identical"
+column is the percentage of translations equal to the ones of the full output layer.
+"""
+import argparse
+
+import torch
+
+import common
+from mmt.shortlist import Shortlist
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the lexical shortlist of the output layer')
+    common.add_model_args(parser)
+    parser.add_argument('-r', '--reference', dest='reference', metavar='FILE', default=None,
+                        help='the reference translation of the input, to compute BLEU (default none)')
+    parser.add_argument('--batch-size', dest='batch_size', metavar='N', default=1, type=int,
+                        help='the number of segments per request (default 1)')
+    parser.add_argument('--threads', dest='threads', metavar='N', default=None, type=int,
+                        help='the number of intra-op threads (default torch default)')
+    args = parser.parse_args(argv)
+
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+
+    config, _ = common.load_checkpoints(args.model)
+    for name, checkpoint_path in config.checkpoints:
+        if not Shortlist.exists(checkpoint_path):
+            parser.error('missing shortlist for checkpoint "%s", run "mmt shortlist" first' % name)
+
+    lines = common.read_lines(args.input, args.lines)
+    references = common.read_lines(args.reference, args.lines) if args.reference is not None else None
+    batches = [lines[i:i + args.batch_size] for i in range(0, len(lines), args.batch_size)]
+
+    print('%-9s %10s %12s %9s %8s %10s' % ('output', 'time (s)', 'tgt tok/s', 'speedup', 'BLEU', 'identical'))
+    baseline, baseline_texts = None, None
+    for output_shortlist in [False, True]:
+        decoder = common.create_decoder(args.model, device=args.gpu, decoding={'output_shortlist': output_shortlist})
+        decoder.test()  # warm up
+        translations, stats = common.run(decoder, args.source_lang, args.target_lang, batches, runs=args.runs,
+                                         alignment=False)
+        texts = [translation.text for translation in translations]
+
+        if baseline is None:
+            baseline, baseline_texts = stats['time'], texts
+
+        identical = 100. * sum(1 for a, b in zip(texts, baseline_texts) if a == b) / len(texts)
+        bleu = common.bleu(references, translations) if references is not None else float('nan')
+
+        print('%-9s %10.2f %12.1f %8.2fx %8.2f %9.1f%%' % ('shortlist' if output_shortlist else 'full',
+                                                          stats['time'], stats['tgt_tokens'] / stats['time'],
+                                                          baseline / stats['time'], bleu, identical))
+
+
+if __name__ == '__main__':
+    main()
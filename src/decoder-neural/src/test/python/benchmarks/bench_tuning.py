@@ -0,0 +1,87 @@
+"""
+Compare the online tuning scopes: tuning time, reset time and BLEU of the tuned translations.
+
+    python3 bench_tuning.py models/decoder -s en -t it -i test.en -r test.it \\
+        --memory-source memory.en --memory-target memory.it
+
+Every test segment is translated alone, tuning the model on the "--suggestions" memory entries
+sharing most words with it (as the translation memory would do), and every scope is run on the
+very same requests; the "none" row is the translation without tuning.
+"""
+import argparse
+
+import common
+from mmt.decoder import Suggestion
+from mmt.tuning import Tuner
+
+
+def _words(text):
+    return set(text.lower().split())
+
+
+def find_suggestions(source_lang, target_lang, segments, memory, limit):
+    # a naive translation memory: the entries with the highest words overlap (Jaccard)
+    memory_words = [_words(segment) for segment, _ in memory]
+
+    results = []
+    for segment in segments:
+        words = _words(segment)
+
+        scores = []
+        for i, entry_words in enumerate(memory_words):
+            union = len(words | entry_words)
+            scores.append((len(words & entry_words) / union if union > 0 else 0., i))
+        scores.sort(reverse=True)
+
+        results.append([Suggestion(source_lang, target_lang, memory[i][0], memory[i][1], score)
+                        for score, i in scores[:limit] if score > 0])
+
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the online tuning scopes')
+    common.add_model_args(parser, runs=False)
+    parser.add_argument('-r', '--reference', dest='reference', metavar='FILE', required=True,
+                        help='the reference translation of the input')
+    parser.add_argument('--memory-source', dest='memory_source', metavar='FILE', required=True,
+                        help='the source side of the translation memory')
+    parser.add_argument('--memory-target', dest='memory_target', metavar='FILE', required=True,
+                        help='the target side of the translation memory')
+    parser.add_argument('--suggestions', dest='suggestions', metavar='N', default=5, type=int,
+                        help='the number of suggestions per segment (default 5)')
+    parser.add_argument('--scopes', dest='scopes', metavar='SCOPE', nargs='+', default=Tuner.SCOPES,
+                        help='the tuning scopes to compare (default all of them)')
+    parser.add_argument('--last-layers', dest='last_layers', metavar='N', default=1, type=int,
+                        help='the number of decoder layers tuned with scope "last_layers" (default 1)')
+    args = parser.parse_args(argv)
+
+    segments = common.read_lines(args.input, args.lines)
+    references = common.read_lines(args.reference, args.lines)
+    memory = list(zip(common.read_lines(args.memory_source), common.read_lines(args.memory_target)))
+
+    suggestions = find_suggestions(args.source_lang, args.target_lang, segments, memory, args.suggestions)
+
+    print('%-20s %14s %14s %8s' % ('scope', 'tune (ms/seg)', 'reset (ms/seg)', 'BLEU'))
+    for scope in ['none'] + args.scopes:
+        decoder = common.create_decoder(args.model, device=args.gpu,
+                                        tuning=dict(tuning_scope=scope if scope != 'none' else 'all',
+                                                    tuning_last_layers=args.last_layers, tuning_cache_size=0))
+        decoder.test()  # warm up
+
+        translations, stats = [], {}
+        for segment, segment_suggestions in zip(segments, suggestions):
+            segment_stats = {}
+            translations.extend(decoder.translate(args.source_lang, args.target_lang, [segment],
+                                                  suggestions=segment_suggestions if scope != 'none' else None,
+                                                  stats=segment_stats, alignment=False))
+            for key in ('tune', 'reset'):
+                stats[key] = stats.get(key, 0) + segment_stats[key]
+
+        print('%-20s %14.1f %14.1f %8.2f' % (scope, 1000. * stats['tune'] / len(segments),
+                                             1000. * stats['reset'] / len(segments),
+                                             common.bleu(references, translations)))
+
+
+if __name__ == '__main__':
+    main()
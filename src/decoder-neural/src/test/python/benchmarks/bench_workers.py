@@ -0,0 +1,167 @@
+"""
+Measure the translation throughput of the pre-fork CPU mode ("--workers N") for different worker counts.
+
+    python3 bench_workers.py models/decoder -s en -t it -i test.en --workers 1 2 4 8
+
+For every worker count a decoder process is started with "--workers N", then one client thread per
+worker connects to its named pipes (the same protocol a client of the decoder has to implement, see
+serve_workers() in mmt/utils.py) and all of them translate the input requests from a shared queue.
+The memory column is the proportional set size (PSS) of the whole process tree, that is the
+actual memory used, counting only once the pages shared among workers.
+"""
+import argparse
+import json
+import os
+import queue
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import common
+
+
+def _pss(pids):
+    # the sum of the proportional set size of the processes, in bytes (Linux only)
+    total = 0
+    for pid in pids:
+        try:
+            with open('/proc/%d/smaps_rollup' % pid, 'r') as stream:
+                for line in stream:
+                    if line.startswith('Pss:'):
+                        total += int(line.split()[1]) * 1024
+        except IOError:
+            return None
+    return total
+
+
+def _children(pid):
+    try:
+        with open('/proc/%d/task/%d/children' % (pid, pid), 'r') as stream:
+            return [int(child) for child in stream.read().split()]
+    except IOError:
+        return []
+
+
+class Worker(object):
+    def __init__(self, in_path, out_path):
+        # the worker opens its input first: opening the pipes in any other order would deadlock
+        self._stdin = open(in_path, 'w', encoding='utf-8')
+        self._stdout = open(out_path, 'r', encoding='utf-8')
+
+        line = self._stdout.readline().strip()
+        if line != 'READY':
+            raise IOError('Failed to start worker, received: %s' % line)
+
+    def translate(self, source_lang, target_lang, batch):
+        self._stdin.write(json.dumps({'q': '\n'.join(batch), 'sl': source_lang, 'tl': target_lang}) + '\n')
+        self._stdin.flush()
+
+        response = json.loads(self._stdout.readline())
+        if not response['success']:
+            raise IOError('Translation failed: %s' % response)
+        return response['data']
+
+    def close(self):
+        self._stdin.close()  # the worker terminates when its input is closed
+        self._stdout.close()
+
+
+def run(args, workers, batches):
+    endpoints = tempfile.mkdtemp(prefix='mmt-workers-')
+
+    command = [sys.executable, os.path.join(common.PYTHON_HOME, '__main__.py'), args.model,
+               '--workers', str(workers), '--endpoints', endpoints, '--cache-max-entries', '0']
+    log_path = os.path.join(endpoints, 'decoder.log')
+    with open(log_path, 'w') as log:
+        process = subprocess.Popen(command, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=log,
+                                   universal_newlines=True)
+
+    try:
+        begin = time.time()
+        clients = []
+        for _ in range(workers):
+            line = process.stdout.readline().split()
+            if len(line) != 4 or line[0] != 'WORKER':
+                with open(log_path, 'r') as log:
+                    raise IOError('Failed to start the decoder, received "%s", log:\n%s' %
+                                  (' '.join(line), ''.join(log.readlines()[-10:])))
+            clients.append(Worker(line[2], line[3]))
+        startup_time = time.time() - begin
+
+        requests = queue.Queue()
+        for batch in batches:
+            requests.put(batch)
+
+        errors = []
+
+        def _serve(client):
+            try:
+                while True:
+                    try:
+                        batch = requests.get_nowait()
+                    except queue.Empty:
+                        break
+                    client.translate(args.source_lang, args.target_lang, batch)
+            except BaseException as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=_serve, args=(client,)) for client in clients]
+
+        begin = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.time() - begin
+
+        if len(errors) > 0:
+            raise errors[0]
+
+        memory = _pss([process.pid] + _children(process.pid))
+
+        for client in clients:
+            client.close()
+        process.wait()
+
+        return startup_time, elapsed, memory
+    finally:
+        if process.poll() is None:
+            process.kill()
+        shutil.rmtree(endpoints, ignore_errors=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the throughput of the pre-fork CPU workers')
+    common.add_model_args(parser, runs=False)
+    parser.add_argument('--workers', dest='workers', metavar='N', nargs='+', default=[1, 2, 4], type=int,
+                        help='the worker counts to compare (default 1 2 4)')
+    parser.add_argument('--batch-size', dest='batch_size', metavar='N', default=1, type=int,
+                        help='the number of segments per request (default 1)')
+    args = parser.parse_args(argv)
+
+    if args.gpu is not None:
+        parser.error('workers are supported on CPU only')
+
+    lines = common.read_lines(args.input, args.lines)
+    batches = [lines[i:i + args.batch_size] for i in range(0, len(lines), args.batch_size)]
+    words = sum(len(line.split()) for line in lines)
+
+    print('%-8s %12s %10s %12s %12s %9s %12s' % ('workers', 'startup (s)', 'time (s)', 'segments/s', 'words/s',
+                                                'speedup', 'memory (MB)'))
+    baseline = None
+    for workers in args.workers:
+        startup_time, elapsed, memory = run(args, workers, batches)
+
+        if baseline is None:
+            baseline = elapsed
+
+        print('%-8d %12.1f %10.2f %12.1f %12.1f %8.2fx %12s' % (
+            workers, startup_time, elapsed, len(lines) / elapsed, words / elapsed, baseline / elapsed,
+            '%.0f' % (memory / 1024. / 1024.) if memory is not None else 'n/a'))
+
+
+if __name__ == '__main__':
+    main()
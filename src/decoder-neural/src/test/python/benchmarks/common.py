@@ -0,0 +1,100 @@
+import os
+import random
+import sys
+import time
+
+__this_dir = os.path.dirname(os.path.realpath(__file__))
+PYTHON_HOME = os.path.abspath(os.path.join(__this_dir, os.pardir, os.pardir, os.pardir, 'main', 'python'))
+MMT_HOME = os.path.abspath(os.path.join(PYTHON_HOME, os.pardir, os.pardir, os.pardir, os.pardir, os.pardir))
+sys.path.insert(0, PYTHON_HOME)
+sys.path.insert(1, MMT_HOME)
+
+from mmt.checkpoint import CheckpointRegistry
+from mmt.decoder import MMTDecoder, ModelConfig
+
+
+def add_model_args(parser, runs=True):
+    parser.add_argument('model', metavar='MODEL', help='the path to the decoder model (i.e. "models/decoder")')
+    parser.add_argument('-s', '--source', dest='source_lang', metavar='LANG', required=True,
+                        help='the source language')
+    parser.add_argument('-t', '--target', dest='target_lang', metavar='LANG', required=True,
+                        help='the target language')
+    parser.add_argument('-i', '--input', dest='input', metavar='FILE', required=True,
+                        help='the source text, one tokenized segment per line')
+    parser.add_argument('-n', '--lines', dest='lines', metavar='N', default=None, type=int,
+                        help='use only the first N lines of the input (default all)')
+    parser.add_argument('-g', '--gpu', dest='gpu', help='specify the GPU to use (default none)', default=None, type=int)
+    if runs:
+        parser.add_argument('--runs', dest='runs', metavar='N', default=3, type=int,
+                            help='the number of timed runs, the best one is reported (default 3)')
+
+
+def read_lines(path, limit=None):
+    with open(path, 'r', encoding='utf-8') as stream:
+        lines = [line.strip() for line in stream]
+    return lines[:limit] if limit is not None else lines
+
+
+def make_batches(lines, batch_size, seed=1):
+    # a fixed shuffle, so that every batch holds segments of mixed length
+    lines = list(lines)
+    random.Random(seed).shuffle(lines)
+    return [lines[i:i + batch_size] for i in range(0, len(lines), batch_size)]
+
+
+def load_checkpoints(model_path, device=None, use_cache=True):
+    config = ModelConfig.load(model_path)
+
+    builder = CheckpointRegistry.Builder(use_cache=use_cache)
+    for name, checkpoint_path in config.checkpoints:
+        builder.register(name, checkpoint_path)
+
+    return config, builder.build(device)
+
+
+def create_decoder(model_path, device=None, decoder_class=MMTDecoder, tuning=None, decoding=None, **kwargs):
+    """
+    Create a decoder as the decoder process does; "tuning" and "decoding" are dicts overriding
+    the options read from the "settings" section of model.conf.
+    """
+    config, checkpoints = load_checkpoints(model_path, device=device)
+
+    tuning_ops, decoder_ops = config.tuning, config.decoding
+    for ops, values in ((tuning_ops, tuning), (decoder_ops, decoding)):
+        for name, value in (values or {}).items():
+            if not hasattr(ops, name):
+                raise ValueError('Invalid option "%s"' % name)
+            setattr(ops, name, value)
+
+    kwargs.setdefault('cache_max_entries', 0)  # measure the model, not the translation cache
+    return decoder_class(checkpoints, device=device, tuning_ops=tuning_ops, decoder_ops=decoder_ops, **kwargs)
+
+
+def bleu(references, translations):
+    from cli.mmt.bleu import corpus_bleu
+    return corpus_bleu(references, [translation.text for translation in translations])
+
+
+def run(decoder, source_lang, target_lang, batches, runs=1, **kwargs):
+    """
+    Translate all the batches "runs" times, returning the translations and the stats of the fastest run,
+    that is the total "time" in seconds and the sum of the translate() stats of every batch.
+    """
+    best, translations = None, None
+
+    for _ in range(runs):
+        stats, outputs = {'time': 0.}, []
+
+        for batch in batches:
+            batch_stats = {}
+            begin = time.time()
+            outputs.extend(decoder.translate(source_lang, target_lang, batch, stats=batch_stats, **kwargs))
+            stats['time'] += time.time() - begin
+
+            for key, value in batch_stats.items():
+                stats[key] = stats.get(key, 0) + value
+
+        if best is None or stats['time'] < best['time']:
+            best, translations = stats, outputs
+
+    return translations, best
@@ -0,0 +1,80 @@
+"""
+Tiny random decoder models for the tests, built on the fly (no training data is needed).
+"""
+import os
+
+import torch
+from fairseq import options
+from fairseq.models.transformer import TransformerModel
+
+import mmt  # noqa, it registers the "mmt_translation" task
+from mmt.checkpoint import CheckpointRegistry
+from mmt.decoder import MMTDecoder, ModelConfig
+from mmt.textencoder import SubwordDictionary, RESERVED_TOKENS
+
+WORDS = ['w%d' % i for i in range(60)]
+
+
+def make_checkpoint(checkpoint_path, target_langs=('it',), seed=0, share_all_embeddings=True):
+    """
+    Write a random transformer ("model.pt" and "model.vcb") for English to the given target languages,
+    the vocabulary holds the words in WORDS.
+    """
+    os.makedirs(checkpoint_path, exist_ok=True)
+
+    subtokens = RESERVED_TOKENS + [SubwordDictionary.language_tag(lang) + '_' for lang in target_langs] + \
+        [word + '_' for word in WORDS] + list('abcdefghijklmnopqrstuvwxyz0123456789') + ['_', '\\\\', ';', 'u']
+    dictionary = SubwordDictionary(subtokens)
+    dictionary.save(os.path.join(checkpoint_path, 'model.vcb'))
+
+    argv = [checkpoint_path, '--task', 'mmt_translation', '--arch', 'transformer', '-s', 'en', '-t', 'xx',
+            '--encoder-embed-dim', '32', '--decoder-embed-dim', '32',
+            '--encoder-ffn-embed-dim', '64', '--decoder-ffn-embed-dim', '64',
+            '--encoder-layers', '2', '--decoder-layers', '2',
+            '--encoder-attention-heads', '4', '--decoder-attention-heads', '4',
+            '--criterion', 'label_smoothed_cross_entropy', '--optimizer', 'adam', '--lr', '0.001']
+    if share_all_embeddings:
+        argv.append('--share-all-embeddings')
+    args = options.parse_args_and_arch(options.get_training_parser(), argv)
+
+    class _Task:
+        source_dictionary = dictionary
+        target_dictionary = dictionary
+
+    torch.manual_seed(seed)
+    model = TransformerModel.build_model(args, _Task)
+    with torch.no_grad():  # sharper output distributions, so that hypotheses differ
+        for p in model.parameters():
+            p.mul_(3.)
+
+    decode_stats = {'en__%s' % lang: (1. + .5 * i, .1) for i, lang in enumerate(target_langs)}
+    torch.save({'args': args, 'model': model.state_dict(), 'decode_stats': decode_stats},
+               os.path.join(checkpoint_path, 'model.pt'))
+
+
+def make_decoder_model(model_path, target_langs=('it',), **kwargs):
+    """
+    Write a decoder model folder ("model.conf" plus a single checkpoint "en__xx") and return its path.
+    """
+    checkpoint_name = 'en__%s' % '_'.join(target_langs)
+    make_checkpoint(os.path.join(model_path, checkpoint_name), target_langs=target_langs, **kwargs)
+
+    with open(os.path.join(model_path, 'model.conf'), 'w', encoding='utf-8') as stream:
+        stream.write('[models]\n')
+        for lang in target_langs:
+            stream.write('en__%s = %s\n' % (lang, checkpoint_name))
+
+    return model_path
+
+
+def load_checkpoints(model_path, **kwargs):
+    builder = CheckpointRegistry.Builder(use_cache=False)
+    for name, checkpoint_path in ModelConfig.load(model_path).checkpoints:
+        builder.register(name, checkpoint_path)
+
+    return builder.build(**kwargs)
+
+
+def create_decoder(model_path, decoder_class=MMTDecoder, **kwargs):
+    kwargs.setdefault('cache_max_entries', 0)
+    return decoder_class(load_checkpoints(model_path), **kwargs)
@@ -0,0 +1,234 @@
+import os
+import random
+import sys
+import unittest
+
+import numpy as np
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir, os.pardir, 'main', 'python')))
+
+_import_error = None
+try:
+    from mmt import alignment
+except ImportError as e:  # fairseq is imported by the "mmt" package
+    alignment = None
+    _import_error = str(e)
+
+
+# - Reference implementation: the original nested loops (before vectorization) -----------------------------------------
+
+
+def _ref_aligned_o(o, ilen, points):
+    return any((i, o) in points for i in range(ilen))
+
+
+def _ref_aligned_i(i, olen, points):
+    return any((i, o) in points for o in range(olen))
+
+
+def _ref_grow(i2o, o2i, ilen, olen, neighboring_points):
+    union = sorted(set(i2o) | set(o2i))
+    points = sorted(set(i2o) & set(o2i))
+
+    new_points_added = True
+    while new_points_added:
+        new_points_added = False
+        for i in range(ilen):
+            for o in range(olen):
+                if (i, o) in points:
+                    for (i_new, o_new) in neighboring_points(i, o, ilen, olen):
+                        if not (_ref_aligned_o(o_new, ilen, points) and _ref_aligned_i(i_new, olen, points)) \
+                                and ((i_new, o_new) in union):
+                            points.append((i_new, o_new))
+                            new_points_added = True
+
+    return points
+
+
+def _ref_neighboring_points_diagonal(o_index, i_index, e_len, f_len):
+    result = []
+
+    if o_index > 0 and i_index > 0:
+        result.append((o_index - 1, i_index - 1))
+    if o_index > 0 and i_index < f_len - 1:
+        result.append((o_index - 1, i_index + 1))
+    if o_index < e_len - 1 and i_index > 0:
+        result.append((o_index + 1, i_index - 1))
+    if o_index < e_len - 1 and i_index < f_len - 1:
+        result.append((o_index + 1, i_index + 1))
+
+    return result
+
+
+def _ref_grow_diagonal(i2o, o2i, ilen, olen):
+    union = sorted(set(i2o) | set(o2i))
+    points = sorted(set(i2o) & set(o2i))
+
+    new_points_added = True
+    while new_points_added:
+        new_points_added = False
+        for i in range(ilen):
+            for o in range(olen):
+                if (i, o) in points:
+                    for (i_new, o_new) in alignment._neighboring_points_orthogonal(i, o, ilen, olen):
+                        if not (_ref_aligned_o(o_new, ilen, points) and _ref_aligned_i(i_new, olen, points)) \
+                                and ((i_new, o_new) in union):
+                            points.append((i_new, o_new))
+                            new_points_added = True
+
+    while new_points_added:
+        new_points_added = False
+        for i in range(ilen):
+            for o in range(olen):
+                if (i, o) in points:
+                    for (i_new, o_new) in _ref_neighboring_points_diagonal(i, o, ilen, olen):
+                        if not (_ref_aligned_o(o_new, ilen, points) and _ref_aligned_i(i_new, olen, points)) \
+                                and ((i_new, o_new) in union):
+                            points.append((i_new, o_new))
+                            new_points_added = True
+
+    return points
+
+
+def _ref_final(points, i2o, o2i, ilen, olen):
+    for o in range(olen):
+        for i in range(ilen):
+            if not (_ref_aligned_o(o, ilen, points) and _ref_aligned_i(i, olen, points)) \
+                    and ((i, o) in i2o or (i, o) in o2i):
+                points.append((i, o))
+
+
+def _ref_strategies():
+    def grow(i2o, o2i, ilen, olen):
+        return _ref_grow(i2o, o2i, ilen, olen, alignment._neighboring_points_orthogonal)
+
+    def grow_diagonal_final_and(i2o, o2i, ilen, olen):
+        points = _ref_grow_diagonal(i2o, o2i, ilen, olen)
+        _ref_final(points, i2o, o2i, ilen, olen)
+        return points
+
+    return {
+        'direct': lambda i2o, o2i, ilen, olen: i2o,
+        'inverse': lambda i2o, o2i, ilen, olen: o2i,
+        'intersect': lambda i2o, o2i, ilen, olen: sorted(set(i2o) & set(o2i)),
+        'union': lambda i2o, o2i, ilen, olen: sorted(set(i2o) | set(o2i)),
+        'grow': grow,
+        'grow_diagonal': _ref_grow_diagonal,
+        'grow_diagonal_final_and': grow_diagonal_final_and,
+    }
+
+
+def _ref_make_alignment(source_indexes, target_indexes, attention_matrix, prefix_lang=None, symmetrize=None):
+    alignment_matrix = attention_matrix[:len(source_indexes), :len(target_indexes)]
+    norm_axis0 = (alignment_matrix / alignment_matrix.sum(axis=0)[np.newaxis])
+    norm_axis1 = (alignment_matrix / alignment_matrix.sum(axis=1)[:, np.newaxis])
+
+    s2t_best_indexes = norm_axis0.argmax(1)
+    t2s_best_indexes = norm_axis1.argmax(0)
+
+    threshold = 0.80
+    s_len = alignment_matrix.shape[0]
+    t_len = alignment_matrix.shape[1]
+
+    t2s_sub_alignment = []
+    for t in range(t_len):
+        threshold_value = threshold * norm_axis1[t2s_best_indexes[t], t]
+        t2s_sub_alignment += [(s, t) for s in range(s_len) if norm_axis1[s, t] >= threshold_value]
+
+    s2t_sub_alignment = []
+    for s in range(s_len):
+        threshold_value = threshold * norm_axis0[s, s2t_best_indexes[s]]
+        s2t_sub_alignment += [(s, t) for t in range(t_len) if norm_axis0[s, t] >= threshold_value]
+
+    if not t2s_sub_alignment and not s2t_sub_alignment:
+        return []
+
+    t2s_alignment = sorted(set([(source_indexes[al[0]], target_indexes[al[1]]) for al in t2s_sub_alignment]))
+    s2t_alignment = sorted(set([(source_indexes[al[0]], target_indexes[al[1]]) for al in s2t_sub_alignment]))
+    alignment_ = sorted(symmetrize(t2s_alignment, s2t_alignment, source_indexes[-1] + 1, target_indexes[-1] + 1))
+
+    if prefix_lang:
+        alignment_ = [(al[0] - 1, al[1]) for al in alignment_ if al[0] > 0]
+
+    return alignment_
+
+
+def _ref_clean_alignment(points, src, tgt):
+    src_tokens, tgt_tokens = src.split(), tgt.split()
+    return [point for point in points
+            if alignment._is_punctuation(src_tokens[point[0]]) == alignment._is_punctuation(tgt_tokens[point[1]])]
+
+
+# - Test cases ---------------------------------------------------------------------------------------------------------
+
+
+def _random_indexes(rnd, length):
+    # the word index of every sub-word: non decreasing, starting from 0, without gaps
+    indexes, word = [], 0
+    for k in range(length):
+        if k > 0 and rnd.random() < 0.6:
+            word += 1
+        indexes.append(word)
+    return indexes
+
+
+def _random_attention(rnd, s_len, t_len, dtype):
+    matrix = np.random.RandomState(rnd.randint(0, 2 ** 31)).rand(s_len, t_len).astype(dtype)
+    if rnd.random() < 0.3:
+        matrix = np.round(matrix, 1) + dtype(0.05)  # many ties, never a zero column or row
+    return matrix
+
+
+@unittest.skipIf(alignment is None, 'mmt package not available: %s' % _import_error)
+class AlignmentTest(unittest.TestCase):
+    CASES = 300
+
+    def _cases(self, seed):
+        rnd = random.Random(seed)
+        for _ in range(self.CASES):
+            s_len, t_len = rnd.randint(1, 25), rnd.randint(1, 25)
+            dtype = rnd.choice([np.float32, np.float64])
+
+            source_indexes = _random_indexes(rnd, s_len)
+            target_indexes = _random_indexes(rnd, t_len)
+            # the attention matrix can be larger than the sub-words (i.e. EOS row and column)
+            attention = _random_attention(rnd, s_len + rnd.randint(0, 2), t_len + rnd.randint(0, 2), dtype)
+            prefix_lang = rnd.choice([None, 'it'])
+
+            yield source_indexes, target_indexes, attention, prefix_lang
+
+    def test_make_alignment(self):
+        references = _ref_strategies()
+
+        for seed, (name, strategy) in enumerate(sorted(alignment.SYMMETRIZATION_STRATEGIES.items())):
+            for source_indexes, target_indexes, attention, prefix_lang in self._cases(seed):
+                expected = _ref_make_alignment(source_indexes, target_indexes, attention, prefix_lang=prefix_lang,
+                                               symmetrize=references[name])
+                actual = alignment.make_alignment(source_indexes, target_indexes, attention,
+                                                  prefix_lang=prefix_lang, symmetrize=strategy)
+
+                self.assertEqual([(int(i), int(o)) for i, o in expected], actual,
+                                 msg='strategy = %s, attention = %r' % (name, attention))
+
+    def test_grow_diagonal_never_adds_diagonal_points(self):
+        # (0, 0) is in both directions, (1, 1) only in the direct one: only a diagonal step would reach it
+        i2o, o2i = [(0, 0), (1, 1)], [(0, 0)]
+
+        self.assertEqual([(0, 0)], sorted(_ref_grow_diagonal(i2o, o2i, 2, 2)))
+        self.assertEqual([(0, 0)], sorted(alignment.sym_grow_diagonal(i2o, o2i, 2, 2)))
+
+    def test_clean_alignment(self):
+        rnd = random.Random(1)
+        tokens = ['a', 'b', ',', '.', 'c1', '!', '2']
+
+        for _ in range(self.CASES):
+            src = ' '.join(rnd.choice(tokens) for _ in range(rnd.randint(1, 10)))
+            tgt = ' '.join(rnd.choice(tokens) for _ in range(rnd.randint(1, 10)))
+            points = sorted(set((rnd.randrange(len(src.split())), rnd.randrange(len(tgt.split())))
+                                for _ in range(rnd.randint(0, 10))))
+
+            self.assertEqual(_ref_clean_alignment(points, src, tgt), alignment.clean_alignment(points, src, tgt))
+
+
+if __name__ == '__main__':
+    unittest.main()
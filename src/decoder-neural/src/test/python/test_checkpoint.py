@@ -0,0 +1,148 @@
+import os
+import sys
+import unittest
+from collections import OrderedDict
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir, os.pardir, 'main', 'python')))
+
+_import_error = None
+try:
+    import torch
+    from mmt.checkpoint import DeviceStateCache
+except ImportError as e:  # torch and fairseq are not installed
+    DeviceStateCache = None
+    _import_error = str(e)
+
+
+class _Checkpoint(object):
+    # the cache only reads "state" and uses checkpoints as keys
+    def __init__(self, name, floats, longs=10):
+        self.name = name
+        self.state = OrderedDict([('weight', torch.randn(floats)), ('indexes', torch.arange(longs))])
+
+    def __repr__(self):
+        return self.name
+
+
+@unittest.skipIf(DeviceStateCache is None, 'torch or fairseq not available: %s' % _import_error)
+class DeviceStateCacheTest(unittest.TestCase):
+    # the CPU is the device: tensors are converted to "dtype" as on a GPU, otherwise they are not copied
+
+    def _get(self, cache, checkpoint, hit):
+        state, cached = cache.get(checkpoint)
+        self.assertEqual(hit, cached, msg=repr(checkpoint))
+
+        self.assertEqual(list(checkpoint.state.keys()), list(state.keys()))
+        for name, tensor in checkpoint.state.items():
+            # compared in the original dtype, half precision operators are not available on CPU
+            expected = tensor.to(state[name].dtype).to(tensor.dtype)
+            self.assertTrue(torch.equal(expected, state[name].to(tensor.dtype)), msg=name)
+
+        return state
+
+    def test_bytes_with_dtype(self):
+        a, b = _Checkpoint('a', 100), _Checkpoint('b', 50)
+
+        cache = DeviceStateCache('cpu', max_entries=2)
+        self._get(cache, a, False)
+        self.assertEqual(400 + 80, cache._bytes)
+
+        cache = DeviceStateCache('cpu', max_entries=2, dtype=torch.half)
+        state = self._get(cache, a, False)
+        self.assertEqual(torch.half, state['weight'].dtype)
+        self.assertEqual(torch.long, state['indexes'].dtype)  # only floating point tensors are converted
+        self.assertEqual(200 + 80, cache._bytes)
+
+        self._get(cache, b, False)
+        self.assertEqual(200 + 80 + 100 + 80, cache._bytes)
+
+        # the budget is the size on the device: three half states fit where two float ones would not
+        cache = DeviceStateCache('cpu', max_entries=10, max_bytes=3 * (200 + 80), dtype=torch.half)
+        checkpoints = [_Checkpoint(name, 100) for name in 'xyz']
+        for checkpoint in checkpoints:
+            self._get(cache, checkpoint, False)
+        self.assertEqual(3, len(cache))
+        self.assertEqual(0, cache.evictions)
+        self.assertEqual(3 * (200 + 80), cache._bytes)
+
+    def test_eviction_order(self):
+        a, b, c, d = [_Checkpoint(name, 100) for name in 'abcd']
+
+        cache = DeviceStateCache('cpu', max_entries=3)
+        for checkpoint in [a, b, c]:
+            self._get(cache, checkpoint, False)
+
+        self._get(cache, a, True)  # "b" becomes the least recently used
+        self._get(cache, d, False)
+        self.assertEqual(1, cache.evictions)
+        self.assertEqual(3, len(cache))
+        self.assertEqual(3 * (400 + 80), cache._bytes)
+
+        self._get(cache, a, True)
+        self._get(cache, c, True)
+        self._get(cache, d, True)
+        self._get(cache, b, False)  # evicted, "a" is the least recently used now
+
+        self._get(cache, c, True)
+        self._get(cache, a, False)
+        self.assertEqual(3, cache.evictions)
+        self.assertEqual(6, cache.misses)
+        self.assertEqual(5, cache.hits)
+
+    def test_eviction_by_bytes(self):
+        small, large = [_Checkpoint('s%d' % i, 100) for i in range(3)], _Checkpoint('large', 220)
+        size = 400 + 80
+
+        cache = DeviceStateCache('cpu', max_entries=10, max_bytes=3 * size)
+        for checkpoint in small:
+            self._get(cache, checkpoint, False)
+
+        # "large" takes the space of two small states, the least recently used ones are evicted
+        self._get(cache, small[0], True)
+        self._get(cache, large, False)
+        self.assertEqual(2, cache.evictions)
+        self.assertEqual(2, len(cache))
+        self.assertEqual(3 * size, cache._bytes)
+
+        self._get(cache, small[0], True)
+        self._get(cache, large, True)
+
+    def test_reuse_after_eviction(self):
+        a, b = _Checkpoint('a', 100), _Checkpoint('b', 100)
+
+        cache = DeviceStateCache('cpu', max_entries=1, dtype=torch.half)
+        first = self._get(cache, a, False)
+        self._get(cache, b, False)
+
+        # a new device state of the (unchanged) checkpoint, cached again
+        second = self._get(cache, a, False)
+        self.assertIsNot(first, second)
+        self.assertIs(second, self._get(cache, a, True))
+        self.assertEqual(200 + 80, cache._bytes)
+        self.assertEqual(2, cache.evictions)
+
+    def test_state_larger_than_budget(self):
+        a, huge = _Checkpoint('a', 100), _Checkpoint('huge', 1000)
+
+        cache = DeviceStateCache('cpu', max_entries=10, max_bytes=1000)
+        self._get(cache, a, False)
+
+        # returned without being cached, nothing is evicted for it
+        self._get(cache, huge, False)
+        self._get(cache, huge, False)
+        self.assertEqual(1, len(cache))
+        self.assertEqual(0, cache.evictions)
+        self._get(cache, a, True)
+
+    def test_disabled(self):
+        a = _Checkpoint('a', 100)
+
+        cache = DeviceStateCache('cpu', max_entries=0)
+        self._get(cache, a, False)
+        self._get(cache, a, False)
+        self.assertEqual(0, len(cache))
+        self.assertEqual(0, cache._bytes)
+
+
+if __name__ == '__main__':
+    unittest.main()
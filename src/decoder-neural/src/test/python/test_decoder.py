@@ -0,0 +1,116 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir, os.pardir, 'main', 'python')))
+
+_import_error = None
+try:
+    import fixtures
+    from mmt.decoder import DecoderOptions, Suggestion, TranslationCache
+except ImportError as e:  # torch and fairseq are not installed
+    fixtures = None
+    _import_error = str(e)
+
+
+def _suggestion(segment, translation, score=1.):
+    return Suggestion('en', 'it', segment, translation, score)
+
+
+def _dump(translations):
+    return [(t.text, t.score, t.alignment) for t in translations]
+
+
+@unittest.skipIf(fixtures is None, 'mmt package not available: %s' % _import_error)
+class ExactMatchTest(unittest.TestCase):
+    BATCH = ['w1 w2 w3', 'w4 w5 w6 w7', 'w8 w9']
+
+    @classmethod
+    def setUpClass(cls):
+        cls._path = tempfile.mkdtemp()
+        fixtures.make_decoder_model(cls._path)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls._path, ignore_errors=True)
+
+    def _create_decoder(self, **kwargs):
+        decoder_ops = DecoderOptions()
+        decoder_ops.exact_match_shortcut = True
+        return fixtures.create_decoder(self._path, decoder_ops=decoder_ops, **kwargs)
+
+    def _translate(self, decoder, batch, suggestions=None):
+        return decoder.translate('en', 'it', batch, suggestions=suggestions, tuning_epochs=5,
+                                 tuning_learning_rate=.1)
+
+    def test_tuned_model_is_never_quantized(self):
+        for quantize in [None, 'int8']:
+            expected = _dump(self._translate(self._create_decoder(quantize=quantize), self.BATCH))
+
+            decoder = self._create_decoder(quantize=quantize)
+
+            # (1) tuned request, (2) every segment is an exact match (the tuned model is kept), (3) plain request
+            tuned = self._translate(decoder, self.BATCH, [_suggestion('w1 w2', 'w10 w11 w12'),
+                                                          _suggestion('w4 w5 w6', 'w13 w14')])
+            self.assertNotEqual(expected, _dump(tuned), msg='tuning does not change the output')
+
+            matches = self._translate(decoder, self.BATCH[:1], [_suggestion('w1 w2', 'w10 w11 w12'),
+                                                                _suggestion('w1  w2 w3', 'w20 w21')])
+            self.assertEqual(['w20 w21'], [t.text for t in matches])
+            self.assertEqual([1.], [t.score for t in matches])
+
+            self.assertEqual(expected, _dump(self._translate(decoder, self.BATCH)), msg='quantize = %s' % quantize)
+
+
+@unittest.skipIf(fixtures is None, 'mmt package not available: %s' % _import_error)
+class TranslationCacheTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls._path = tempfile.mkdtemp()
+        fixtures.make_decoder_model(cls._path)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls._path, ignore_errors=True)
+
+    def test_sizeof_alignment(self):
+        decoder = fixtures.create_decoder(self._path, cache_max_entries=100, cache_max_bytes=10 ** 6)
+        cache = decoder._cache
+
+        translation, = decoder.translate('en', 'it', ['w1 w2 w3 w4'])
+        text_size = 64 + 2 * len(translation.text)
+
+        # the deferred alignment holds the attention matrix (source x target sub-words)
+        nbytes = translation._alignment.nbytes
+        self.assertGreaterEqual(nbytes, 4 * 4 * len(translation.text.split()))
+        self.assertEqual(text_size + nbytes, cache.currsize)
+
+        alignment = translation.alignment
+        self.assertGreater(len(alignment), 0)
+        self.assertEqual(text_size + 64 * len(alignment), TranslationCache._sizeof(translation))
+
+        # without alignment only the text is cached
+        translation, = decoder.translate('en', 'it', ['w5 w6'], alignment=False)
+        self.assertIsNone(translation.alignment)
+        self.assertEqual(text_size + nbytes + 64 + 2 * len(translation.text), cache.currsize)
+
+    def test_attention_exceeds_budget(self):
+        translation, = fixtures.create_decoder(self._path).translate('en', 'it', ['w1 w2 w3 w4'])
+        text_size = 64 + 2 * len(translation.text)
+
+        # the text alone fits the budget, together with the attention matrix it does not
+        budget = text_size + translation._alignment.nbytes - 1
+        decoder = fixtures.create_decoder(self._path, cache_max_entries=100, cache_max_bytes=budget)
+
+        decoder.translate('en', 'it', ['w1 w2 w3 w4'])
+        self.assertEqual(0, len(decoder._cache))
+
+        decoder.translate('en', 'it', ['w1 w2 w3 w4'], alignment=False)
+        self.assertEqual(1, len(decoder._cache))
+        self.assertEqual(text_size, decoder._cache.currsize)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,156 @@
+import argparse
+import itertools
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir, os.pardir, 'main', 'python')))
+
+_import_error = None
+try:
+    import torch
+    from fairseq.data import Dictionary
+    from fairseq.models.transformer import TransformerModel, base_architecture
+    from fairseq.sequence_generator import SequenceGenerator
+    from mmt.generator import BeamSearch
+except ImportError as e:  # torch and fairseq are not installed
+    BeamSearch = None
+    _import_error = str(e)
+
+
+def _make_model(seed, vocab_size=200, dim=32, layers=2, share=True, eos_words=20):
+    # a small random transformer with sharper output distributions, EOS takes the probability of the first
+    # "eos_words" words (if not None) so that hypotheses of different lengths are finalized at different steps
+    torch.manual_seed(seed)
+
+    dictionary = Dictionary()
+    for i in range(vocab_size - len(dictionary)):
+        dictionary.add_symbol('w%d' % i)
+
+    task = argparse.Namespace(source_dictionary=dictionary, target_dictionary=dictionary)
+    args = argparse.Namespace(encoder_embed_dim=dim, encoder_ffn_embed_dim=2 * dim, encoder_layers=layers,
+                              encoder_attention_heads=4, decoder_embed_dim=dim, decoder_ffn_embed_dim=2 * dim,
+                              decoder_layers=layers, decoder_attention_heads=4, share_all_embeddings=share,
+                              share_decoder_input_output_embed=share, max_source_positions=1024,
+                              max_target_positions=1024, dropout=0.)
+    base_architecture(args)
+
+    model = TransformerModel.build_model(args, task)
+    model.eval()
+
+    with torch.no_grad():
+        for p in model.parameters():
+            p.mul_(3.)
+
+    model.make_generation_fast_(beamable_mm_beam_size=None, need_attn=True)
+    if eos_words is None:
+        return model, dictionary
+
+    get_normalized_probs = model.get_normalized_probs
+    eos, words = dictionary.eos(), slice(dictionary.nspecial, dictionary.nspecial + eos_words)
+
+    def _get_normalized_probs(net_output, log_probs, sample=None):
+        probs = get_normalized_probs(net_output, log_probs, sample)
+        probs[..., eos] = torch.logsumexp(probs[..., words], -1) if log_probs else probs[..., words].sum(-1)
+        return probs
+
+    model.get_normalized_probs = _get_normalized_probs
+
+    return model, dictionary
+
+
+def _make_sample(dictionary, batch_size, seed, with_unk=False):
+    generator = torch.Generator().manual_seed(seed)
+    low = dictionary.unk() if with_unk else dictionary.nspecial
+
+    sequences = []
+    for _ in range(batch_size):
+        length = int(torch.randint(2, 12, (1,), generator=generator))
+        tokens = torch.randint(low, len(dictionary), (length,), generator=generator)
+        sequences.append(torch.cat([tokens, torch.LongTensor([dictionary.eos()])]))
+
+    # left padded, as done by the decoder
+    max_length = max(len(s) for s in sequences)
+    src_tokens = dictionary.pad() * torch.ones(batch_size, max_length, dtype=torch.long)
+    for i, sequence in enumerate(sequences):
+        src_tokens[i, max_length - len(sequence):] = sequence
+
+    return {'net_input': {'src_tokens': src_tokens, 'src_lengths': torch.LongTensor([len(s) for s in sequences])}}
+
+
+@unittest.skipIf(BeamSearch is None, 'torch or fairseq not available: %s' % _import_error)
+class BeamSearchTest(unittest.TestCase):
+    """
+    BeamSearch must return the same hypotheses of fairseq SequenceGenerator (as configured by MMTDecoder), the
+    reference is the fairseq version pinned in requirements.txt. Only the fields used by the decoder are compared:
+    tokens, score and attention.
+    """
+
+    def _assert_equal(self, model, dictionary, sample, **kwargs):
+        expected = SequenceGenerator(dictionary, stop_early=True, sampling=False, sampling_topk=-1, temperature=1,
+                                     diverse_beam_groups=1, diverse_beam_strength=0.5, **kwargs)
+        actual = BeamSearch(dictionary, **kwargs)
+
+        expected = expected.generate([model], sample)
+        actual = actual.generate([model], sample)
+
+        self.assertEqual(len(expected), len(actual))
+        for i, (expected_hypos, actual_hypos) in enumerate(zip(expected, actual)):
+            msg = 'sentence = %d, %r' % (i, kwargs)
+
+            self.assertEqual(len(expected_hypos), len(actual_hypos), msg=msg)
+            for expected_hypo, actual_hypo in zip(expected_hypos, actual_hypos):
+                self.assertEqual(expected_hypo['tokens'].tolist(), actual_hypo['tokens'].tolist(), msg=msg)
+                self.assertAlmostEqual(float(expected_hypo['score']), float(actual_hypo['score']), places=4, msg=msg)
+                self.assertEqual(expected_hypo['attention'].size(), actual_hypo['attention'].size(), msg=msg)
+                self.assertTrue(torch.allclose(expected_hypo['attention'], actual_hypo['attention'], atol=1e-5),
+                                msg=msg)
+
+    def test_beam_and_max_len(self):
+        for seed, share in enumerate([True, False]):
+            model, dictionary = _make_model(seed, share=share)
+
+            for beam_size, batch_size, max_len_b in itertools.product([1, 2, 5], [1, 3, 8], [1, 3, 10, 30]):
+                sample = _make_sample(dictionary, batch_size, seed=100 * seed + batch_size)
+                self._assert_equal(model, dictionary, sample, beam_size=beam_size, max_len_a=0, max_len_b=max_len_b,
+                                   min_len=1)
+
+    def test_max_len_a(self):
+        model, dictionary = _make_model(2)
+
+        for beam_size, max_len_a in itertools.product([1, 4], [.5, 1.2]):
+            sample = _make_sample(dictionary, 4, seed=3)
+            self._assert_equal(model, dictionary, sample, beam_size=beam_size, max_len_a=max_len_a, max_len_b=2,
+                               min_len=1)
+
+    def test_min_len(self):
+        model, dictionary = _make_model(3)
+
+        for beam_size, min_len in itertools.product([1, 4], [2, 5, 10]):
+            sample = _make_sample(dictionary, 4, seed=4)
+            self._assert_equal(model, dictionary, sample, beam_size=beam_size, max_len_a=0, max_len_b=12,
+                               min_len=min_len)
+
+    def test_unk_penalty(self):
+        model, dictionary = _make_model(4)
+
+        with torch.no_grad():  # make UNK a likely candidate, so that the penalty changes the results
+            weight = model.decoder.embed_tokens.weight
+            weight[dictionary.unk()] = weight[dictionary.nspecial:].sum(0) * .1
+
+        for beam_size, unk_penalty in itertools.product([1, 4], [-2., 0., 1., 100.]):
+            sample = _make_sample(dictionary, 4, seed=5, with_unk=True)
+            self._assert_equal(model, dictionary, sample, beam_size=beam_size, max_len_a=0, max_len_b=10,
+                               min_len=1, unk_penalty=unk_penalty)
+
+    def test_normalize_scores_and_len_penalty(self):
+        model, dictionary = _make_model(5)
+
+        for normalize_scores, len_penalty in [(False, 1.), (True, .5), (True, 2.)]:
+            sample = _make_sample(dictionary, 4, seed=6)
+            self._assert_equal(model, dictionary, sample, beam_size=4, max_len_a=0, max_len_b=10, min_len=1,
+                               normalize_scores=normalize_scores, len_penalty=len_penalty)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,126 @@
+import math
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir, os.pardir, 'main', 'python')))
+
+_import_error = None
+try:
+    import onnxruntime  # noqa
+    import torch
+    import fixtures
+    from mmt import onnxmodel
+    from mmt.decoder import DecoderOptions
+    from mmt.generator import BeamSearch
+    from mmt.onnxmodel import ONNXDecoder, ONNXModel
+    from test_generator import _make_model, _make_sample
+except ImportError as e:  # torch, fairseq or onnxruntime are not installed
+    ONNXModel = None
+    _import_error = str(e)
+
+
+@unittest.skipIf(ONNXModel is None, 'torch, fairseq or onnxruntime not available: %s' % _import_error)
+class ONNXModelTest(unittest.TestCase):
+    def setUp(self):
+        # the manifest describes the checkpoint files, their content is not read by the export
+        self._path = tempfile.mkdtemp()
+        for filename in ['model.pt', 'model.vcb']:
+            with open(os.path.join(self._path, filename), 'wb') as stream:
+                stream.write(b'checkpoint')
+
+    def tearDown(self):
+        shutil.rmtree(self._path, ignore_errors=True)
+
+    def _export(self, model):
+        ONNXModel.export(model, self._path)
+        return ONNXModel.load(self._path, model.max_decoder_positions(), num_threads=1)
+
+    def test_parity(self):
+        for seed, (share, normalize_before) in enumerate([(True, False), (False, False), (True, True)]):
+            model, dictionary = _make_model(seed, share=share, eos_words=None)
+            for layer in model.encoder.layers + model.decoder.layers:
+                layer.normalize_before = normalize_before
+
+            onnx_model = self._export(model)
+
+            for beam_size, batch_size, max_len_b in [(1, 1, 5), (1, 4, 20), (4, 1, 20), (4, 6, 10)]:
+                sample = _make_sample(dictionary, batch_size, seed=100 * seed + batch_size)
+                generator = BeamSearch(dictionary, beam_size=beam_size, max_len_a=0, max_len_b=max_len_b)
+
+                expected = generator.generate([model], sample)
+                actual = generator.generate([onnx_model], sample)
+
+                for i, (expected_hypos, actual_hypos) in enumerate(zip(expected, actual)):
+                    msg = 'seed = %d, beam = %d, sentence = %d' % (seed, beam_size, i)
+
+                    self.assertEqual(len(expected_hypos), len(actual_hypos), msg=msg)
+                    for expected_hypo, actual_hypo in zip(expected_hypos, actual_hypos):
+                        self.assertEqual(expected_hypo['tokens'].tolist(), actual_hypo['tokens'].tolist(), msg=msg)
+                        self.assertTrue(math.isclose(expected_hypo['score'], actual_hypo['score'],
+                                                     rel_tol=1e-4, abs_tol=1e-3), msg=msg)
+                        self.assertTrue(torch.allclose(expected_hypo['attention'], actual_hypo['attention'],
+                                                       atol=1e-4), msg=msg)
+
+    def test_manifest(self):
+        model, _ = _make_model(0, eos_words=None)
+        embeddings_size = model.encoder.embed_tokens.num_embeddings
+
+        self.assertFalse(ONNXModel.is_valid(self._path, embeddings_size))
+        self._export(model)
+        self.assertTrue(ONNXModel.is_valid(self._path, embeddings_size))
+
+        # resized embeddings (i.e. a new checkpoint with a larger vocabulary in the same decoder)
+        self.assertFalse(ONNXModel.is_valid(self._path, embeddings_size + 8))
+
+        # model.pt replaced after the export
+        model_pt = os.path.join(self._path, 'model.pt')
+        stat = os.stat(model_pt)
+        os.utime(model_pt, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+        self.assertTrue(ONNXModel.exists(self._path))
+        self.assertFalse(ONNXModel.is_valid(self._path, embeddings_size))
+
+        # graphs exported without manifest
+        self._export(model)
+        os.remove(os.path.join(self._path, ONNXModel.MANIFEST_FILENAME))
+        self.assertFalse(ONNXModel.is_valid(self._path, embeddings_size))
+
+
+@unittest.skipIf(ONNXModel is None, 'torch, fairseq or onnxruntime not available: %s' % _import_error)
+class ONNXDecoderTest(unittest.TestCase):
+    BATCH = ['w1 w2 w3', 'w4 w5']
+
+    def setUp(self):
+        self._path = tempfile.mkdtemp()
+        fixtures.make_decoder_model(self._path)
+        onnxmodel.export(self._path)
+
+    def tearDown(self):
+        shutil.rmtree(self._path, ignore_errors=True)
+
+    def _translate(self, decoder):
+        return [(t.text, round(t.score, 4)) for t in decoder.translate('en', 'it', self.BATCH, alignment=False)]
+
+    def test_stale_graphs_fallback(self):
+        decoder_ops = DecoderOptions()
+        decoder_ops.generator = 'builtin'
+        expected = self._translate(fixtures.create_decoder(self._path, decoder_ops=decoder_ops))
+
+        model_pt = os.path.join(self._path, 'en__it', 'model.pt')
+        stat = os.stat(model_pt)
+        os.utime(model_pt, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+
+        decoder = fixtures.create_decoder(self._path, decoder_class=ONNXDecoder)
+
+        # every request decoded with PyTorch is logged, not only the first one
+        for _ in range(2):
+            with self.assertLogs('ONNXDecoder', level='WARNING') as logs:
+                self.assertEqual(expected, self._translate(decoder))
+            self.assertEqual(1, len(logs.output))
+            self.assertIn('do not match the checkpoint', logs.output[0])
+
+
+if __name__ == '__main__':
+    unittest.main()
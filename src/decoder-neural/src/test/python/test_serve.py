@@ -0,0 +1,218 @@
+import json
+import math
+import os
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+import unittest
+
+MAIN_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir, os.pardir, 'main', 'python'))
+sys.path.insert(0, MAIN_PATH)
+
+_import_error = None
+try:
+    import fixtures
+except ImportError as e:  # torch and fairseq are not installed
+    fixtures = None
+    _import_error = str(e)
+
+
+class _BinaryReader(object):
+    # decodes the TranslationResponse binary encoding (see TranslationResponse.to_bytes in mmt/utils.py)
+
+    def __init__(self, data):
+        self._data = data
+        self._offset = 0
+
+    def unpack(self, fmt):
+        values = struct.unpack_from(fmt, self._data, self._offset)
+        self._offset += struct.calcsize(fmt)
+        return values
+
+    def string(self):
+        size, = self.unpack('>I')
+        return self.unpack('>%ds' % size)[0].decode('utf-8')
+
+    def translation(self):
+        # the same fields of the JSON encoding
+        obj = {'text': self.string()}
+
+        score, = self.unpack('>f')
+        if not math.isnan(score):
+            obj['s'] = score
+
+        size, = self.unpack('>i')
+        if size >= 0:
+            obj['a'] = [list(self.unpack('>%di' % size)), list(self.unpack('>%di' % size))]
+
+        nbest = [self.translation() for _ in range(self.unpack('>I')[0])]
+        if len(nbest) > 0:
+            obj['nbest'] = nbest
+
+        return obj
+
+    def response(self):
+        kind, request_id = self.unpack('>Bq')
+        request_id = None if request_id < 0 else request_id
+
+        if kind == 0:
+            return request_id, {'success': False, 'type': self.string(), 'msg': self.string()}
+
+        if kind == 2:
+            response = {'success': True}
+            response.update(json.loads(self.string()))
+            return request_id, response
+
+        data = [self.translation() for _ in range(self.unpack('>I')[0])]
+        stats = {}
+        for _ in range(self.unpack('>I')[0]):
+            name = self.string()
+            stats[name], = self.unpack('>d')
+
+        return request_id, {'success': True, 'data': data, 'stats': stats}
+
+
+@unittest.skipIf(fixtures is None, 'mmt package not available: %s' % _import_error)
+class ServeTest(unittest.TestCase):
+    """
+    Runs the decoder process ("__main__.py") on a tiny model and talks to it as the engine would, over both
+    protocols: the binary one must carry the same translations of the JSON one.
+    """
+
+    REQUESTS = [
+        {'q': 'w1 w2 w3\nw4 w5', 'sl': 'en', 'tl': 'it', 'id': 7},
+        {'q': 'w6 w7', 'sl': 'en', 'tl': 'it', 'a': False, 'n': 3, 'id': 8},
+        {'q': 'w8', 'sl': 'en', 'tl': 'it'},
+        {'command': 'metrics', 'id': 10},
+        {'q': 'w9', 'sl': 'en', 'tl': 'de', 'id': 11},  # an error makes the decoder exit
+    ]
+
+    @classmethod
+    def setUpClass(cls):
+        cls._path = tempfile.mkdtemp()
+        fixtures.make_decoder_model(cls._path)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls._path, ignore_errors=True)
+
+    def _start(self, protocol, *args):
+        process = subprocess.Popen([sys.executable, os.path.join(MAIN_PATH, '__main__.py'), self._path,
+                                    '--protocol', protocol, '--log-level', 'error'] + list(args),
+                                   stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        self.addCleanup(process.wait, 60)
+        self.addCleanup(process.stdin.close)
+        self.addCleanup(process.stdout.close)
+
+        return process, process.stdout.readline().decode('utf-8').rstrip('\n')
+
+    def _serve_json(self, requests, *args, ahead=False):
+        # if "ahead" is True all requests are written before reading the first response
+        process, ready = self._start('json', *args)
+        self.assertEqual('READY', ready)
+
+        if ahead:
+            process.stdin.write(b''.join((json.dumps(request) + '\n').encode('utf-8') for request in requests))
+            process.stdin.flush()
+
+        responses = []
+        for request in requests:
+            if not ahead:
+                process.stdin.write((json.dumps(request) + '\n').encode('utf-8'))
+                process.stdin.flush()
+
+            response = json.loads(process.stdout.readline().decode('utf-8'))
+            responses.append((response.pop('id', None), response))
+
+        return responses
+
+    def _serve_binary(self):
+        process, ready = self._start('binary')
+        self.assertEqual('READY binary', ready)
+
+        responses = []
+        for request in self.REQUESTS:
+            payload = json.dumps(request).encode('utf-8')
+            process.stdin.write(struct.pack('>I', len(payload)) + payload)
+            process.stdin.flush()
+
+            size, = struct.unpack('>I', process.stdout.read(4))
+            responses.append(_BinaryReader(process.stdout.read(size)).response())
+
+        return responses
+
+    def test_binary_matches_json(self):
+        expected = self._serve_json(self.REQUESTS)
+        actual = self._serve_binary()
+
+        self.assertEqual([r.get('id') for r in self.REQUESTS], [request_id for request_id, _ in actual])
+        self.assertEqual([request_id for request_id, _ in expected], [request_id for request_id, _ in actual])
+
+        for request, (_, expected_response), (_, actual_response) in zip(self.REQUESTS, expected, actual):
+            msg = json.dumps(request)
+            self.assertEqual(expected_response['success'], actual_response['success'], msg=msg)
+
+            if not expected_response['success']:
+                self.assertEqual(expected_response['type'], actual_response['type'], msg=msg)
+            elif 'command' in request:
+                self.assertEqual(expected_response.keys(), actual_response.keys(), msg=msg)
+                self.assertEqual(3, actual_response['metrics']['requests'], msg=msg)
+            else:
+                self.assertEqual(expected_response['stats'].keys(), actual_response['stats'].keys(), msg=msg)
+                self.assertEqual(len(expected_response['data']), len(actual_response['data']), msg=msg)
+                for e, a in zip(expected_response['data'], actual_response['data']):
+                    self._assert_translation_equal(e, a, msg=msg)
+
+    def _assert_translation_equal(self, expected, actual, msg):
+        self.assertEqual(expected.keys(), actual.keys(), msg=msg)
+        self.assertEqual(expected['text'], actual['text'], msg=msg)
+        self.assertAlmostEqual(expected['s'], actual['s'], places=4, msg=msg)
+        self.assertEqual(expected.get('a'), actual.get('a'), msg=msg)
+
+        self.assertEqual(len(expected.get('nbest', [])), len(actual.get('nbest', [])), msg=msg)
+        for e, a in zip(expected.get('nbest', []), actual.get('nbest', [])):
+            self._assert_translation_equal(e, a, msg=msg)
+
+    def test_coalesce_with_one_request_in_flight(self):
+        # the requests queue holds a single request, the model thread still collects groups larger than that
+        requests = [{'q': 'w%d w%d' % (i, i + 1), 'sl': 'en', 'tl': 'it', 'id': i} for i in range(8)]
+
+        expected = self._serve_json(requests)
+        actual = self._serve_json(requests, '--max-in-flight', '1', '--coalesce-max-tokens', '100',
+                                  '--coalesce-max-wait', '2000', ahead=True)
+
+        self.assertEqual([request_id for request_id, _ in expected], [request_id for request_id, _ in actual])
+        self.assertEqual([[e['text'] for e in response['data']] for _, response in expected],
+                         [[e['text'] for e in response['data']] for _, response in actual])
+
+        self.assertEqual(1, max(response['stats']['batch_size'] for _, response in expected))
+        self.assertEqual(len(requests), actual[0][1]['stats']['batch_size'])
+
+    def test_invalid_profile_command(self):
+        profile_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, profile_dir, True)
+
+        invalid_args = [{'requests': [1]}, {'requests': None}, {'requests': {}}, {'requests': True},
+                        {'requests': 'many'}, {'requests': -1}, {'requests': 1e400}, {'threshold': [5]},
+                        {'threshold': 'slow'}, {'threshold': -5}]
+        requests = [dict(command='profile', id=i, **args) for i, args in enumerate(invalid_args)]
+        requests += [{'command': 'profile', 'requests': '2', 'threshold': 5.5, 'id': 100},
+                     {'q': 'w1 w2', 'sl': 'en', 'tl': 'it', 'id': 101}]
+
+        responses = self._serve_json(requests, '--profile-dir', profile_dir)
+
+        for request, (request_id, response) in zip(requests, responses):
+            self.assertEqual(request['id'], request_id)
+
+        for request, (_, response) in zip(requests[:-2], responses[:-2]):
+            self.assertFalse(response['success'], msg=json.dumps(request))
+            self.assertEqual('ValueError', response['type'], msg=json.dumps(request))
+
+        self.assertEqual({'remaining': 2, 'threshold': .0055, 'path': profile_dir}, responses[-2][1]['profile'])
+        self.assertTrue(responses[-1][1]['success'])
+
+
+if __name__ == '__main__':
+    unittest.main()
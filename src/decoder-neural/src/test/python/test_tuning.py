@@ -0,0 +1,60 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir, os.pardir, 'main', 'python')))
+
+_import_error = None
+try:
+    import fixtures
+    from fairseq.models.transformer import TransformerModel
+    from mmt.tuning import Tuner, TuningOptions
+except ImportError as e:  # torch and fairseq are not installed
+    fixtures = None
+    _import_error = str(e)
+
+
+@unittest.skipIf(fixtures is None, 'mmt package not available: %s' % _import_error)
+class TuningScopeTest(unittest.TestCase):
+    def setUp(self):
+        self._path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self._path, ignore_errors=True)
+
+    def _create_tuner(self, scope, share_all_embeddings):
+        fixtures.make_decoder_model(self._path, share_all_embeddings=share_all_embeddings)
+        checkpoints = fixtures.load_checkpoints(self._path)
+        checkpoint = checkpoints.load('en', 'it')
+
+        model = TransformerModel.build_model(checkpoints.args, checkpoint.task)
+        model.load_state_dict(checkpoint.state, strict=True)
+
+        tuning_ops = TuningOptions()
+        tuning_ops.tuning_scope = scope
+
+        return Tuner(checkpoints.args, checkpoint.task, model, tuning_ops), model
+
+    def test_decoder_scope_with_shared_embeddings(self):
+        tuner, model = self._create_tuner('decoder', share_all_embeddings=True)
+        names = tuner.tunable_parameter_names()
+
+        # the embeddings shared with the encoder are named after it, but they are decoder parameters too
+        self.assertIs(model.encoder.embed_tokens.weight, model.decoder.embed_tokens.weight)
+        self.assertIn('encoder.embed_tokens.weight', names)
+
+        expected = set([id(param) for param in model.decoder.parameters()])
+        self.assertEqual(expected, set([id(param) for name, param in model.named_parameters() if name in names]))
+        self.assertFalse(any(name.startswith('encoder.layers.') for name in names))
+
+    def test_decoder_scope_without_shared_embeddings(self):
+        tuner, model = self._create_tuner('decoder', share_all_embeddings=False)
+        names = tuner.tunable_parameter_names()
+
+        self.assertEqual(set([name for name, _ in model.named_parameters() if name.startswith('decoder.')]), names)
+
+
+if __name__ == '__main__':
+    unittest.main()